@@ -2,12 +2,21 @@
 // จัดการ communication กับ Groq API ทั้งหมด
 // Groq ใช้ OpenAI-compatible API format
 
+const http = require('http');
 const https = require('https');
 
 const API_KEY = process.env.GROQ_API_KEY;
-const MODEL = 'llama-3.3-70b-versatile'; // Model ดีสุดของ Groq
+const MODEL = process.env.LLM_MODEL || 'llama-3.3-70b-versatile'; // Model ดีสุดของ Groq
 const BASE_URL = 'https://api.groq.com';
 
+// ตั้ง LLM_API_URL เพื่อใช้ server ของโมเดลที่ fine-tune เอง (scripts/server.py)
+// เช่น LLM_API_URL=http://127.0.0.1:8000/v1/chat/completions
+// และ LLM_MODEL=chatbot (ชื่อจาก --model-name) หรือชื่อ adapter ที่ลงทะเบียนด้วย --adapter
+// ชื่ออื่นที่ server ไม่รู้จัก (รวมถึง default ด้านบน) จะใช้โมเดลหลัก
+const CHAT_COMPLETIONS_URL = new URL(
+  process.env.LLM_API_URL || `${BASE_URL}/openai/v1/chat/completions`
+);
+
 // ─── Helper: ส่ง HTTP POST ───────────────────────────────────
 function makeApiCall(messages) {
   return new Promise((resolve, reject) => {
@@ -19,8 +28,9 @@ function makeApiCall(messages) {
     });
 
     const options = {
-      hostname: 'api.groq.com',
-      path: '/openai/v1/chat/completions',
+      hostname: CHAT_COMPLETIONS_URL.hostname,
+      port: CHAT_COMPLETIONS_URL.port || undefined,
+      path: CHAT_COMPLETIONS_URL.pathname,
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
@@ -29,7 +39,8 @@ function makeApiCall(messages) {
       }
     };
 
-    const req = https.request(options, (res) => {
+    const client = CHAT_COMPLETIONS_URL.protocol === 'http:' ? http : https;
+    const req = client.request(options, (res) => {
       let data = '';
       res.on('data', (chunk) => { data += chunk; });
       res.on('end', () => {
@@ -2,7 +2,12 @@
 ไฟล์สำหรับเตรียมข้อมูลสำหรับการเทรน
 """
 import json
+import multiprocessing
+import os
+from collections import deque
 from datasets import Dataset, DatasetDict
+from dedup import dedup_features, deduplicate, group_split
+from prompt_template import format_example
 
 def load_raw_data(filepath):
     """โหลดข้อมูลดิบ"""
@@ -12,41 +17,237 @@ def load_raw_data(filepath):
 
 def format_instruction(sample):
     """แปลงข้อมูลเป็น instruction format"""
-    return f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
-
-### Instruction:
-{sample['instruction']}
-
-### Input:
-{sample['input']}
-
-### Response:
-{sample['output']}"""
-
-def prepare_dataset(raw_data_path, output_path):
-    """เตรียม dataset"""
-    # โหลดข้อมูล
-    raw_data = load_raw_data(raw_data_path)
-    
-    # Format data
-    formatted_data = [{"text": format_instruction(item)} for item in raw_data]
-    
-    # สร้าง dataset
-    dataset = Dataset.from_list(formatted_data)
-    
+    return format_example(sample['instruction'], sample['input'], sample['output'])
+
+def iter_json_array(filepath, chunk_size=1 << 20):
+    """
+    อ่าน JSON array ทีละ record โดยไม่โหลดทั้งไฟล์เข้า memory
+    """
+    decoder = json.JSONDecoder()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size)
+        pos = 0
+        started = False
+        eof = not buffer
+        while True:
+            # ข้ามช่องว่างและ ',' ระหว่าง record
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+                pos += 1
+
+            if pos < len(buffer):
+                if not started:
+                    if buffer[pos] != '[':
+                        raise ValueError(f"{filepath} is not a JSON array")
+                    started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == ']':
+                    return
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                    yield record
+                    continue
+                except json.JSONDecodeError:
+                    # record ยังไม่ครบ อ่านเพิ่ม
+                    if eof:
+                        raise
+            elif eof:
+                return
+
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+def iter_raw_batches(filepath, batch_size):
+    """
+    อ่านไฟล์ข้อมูลดิบเป็น batch
+
+    .jsonl: batch เป็นบรรทัดดิบ (worker เป็นคน parse)
+    .json: batch เป็น record ที่ parse แล้ว (อ่าน array แบบ streaming)
+    """
+    is_jsonl = filepath.endswith(".jsonl")
+    batch = []
+    if is_jsonl:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    batch.append(line)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+    else:
+        for record in iter_json_array(filepath):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def format_batch(batch):
+    """Parse (ถ้าเป็นบรรทัด JSONL) และ format ทั้ง batch (รันใน worker process)"""
+    return [
+        {"text": format_instruction(json.loads(item) if isinstance(item, str) else item)}
+        for item in batch
+    ]
+
+def generate_formatted_records(raw_data_path, num_proc, batch_size, file_signature=None):
+    """
+    Generator ของ record ที่ format แล้ว ตามลำดับเดิมของไฟล์
+
+    ส่ง batch ให้ worker pool โดยจำกัดจำนวน batch ที่ค้างอยู่ เพื่อให้ memory คงที่ไม่ว่าไฟล์จะใหญ่แค่ไหน
+    file_signature ใช้เป็นส่วนหนึ่งของ fingerprint ของ datasets cache เท่านั้น
+    """
+    batches = iter_raw_batches(raw_data_path, batch_size)
+    if num_proc <= 1:
+        for batch in batches:
+            yield from format_batch(batch)
+        return
+
+    with multiprocessing.Pool(num_proc) as pool:
+        in_flight = deque()
+        for batch in batches:
+            in_flight.append(pool.apply_async(format_batch, (batch,)))
+            if len(in_flight) >= num_proc * 2:
+                yield from in_flight.popleft().get()
+        while in_flight:
+            yield from in_flight.popleft().get()
+
+def load_tokenizer(tokenizer):
+    """โหลด tokenizer จากชื่อหรือ path (None หรือ "" = ไม่กรองความยาว)"""
+    if not tokenizer or not isinstance(tokenizer, str):
+        return tokenizer or None
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(tokenizer)
+
+def filter_records(dataset, num_proc, dedup=True, tokenizer=None, max_tokens=512, near_dup_threshold=0.8,
+                   group_threshold=0.5, index_path=None):
+    """
+    ตัด record ที่ยาวเกิน max_tokens, ซ้ำ และเกือบซ้ำ (ดู dedup.py) แล้วแบ่ง train/test
+
+    Returns:
+        (DatasetDict, report)
+    """
+    features = dataset.map(
+        dedup_features,
+        batched=True,
+        num_proc=num_proc if len(dataset) >= num_proc * 1000 else None,
+        fn_kwargs={"tokenizer": tokenizer, "with_minhash": dedup},
+        remove_columns=dataset.column_names,
+        desc="Dedup features",
+    )
+    keep, groups, report = deduplicate(
+        features,
+        threshold=near_dup_threshold,
+        group_threshold=group_threshold,
+        max_tokens=max_tokens if tokenizer is not None else None,
+        index_path=index_path,
+    )
+
+    if not dedup:
+        return dataset.select(keep).train_test_split(test_size=0.1, seed=42), report
+
+    # record ที่คล้ายกันอยู่กลุ่มเดียวกัน และแต่ละกลุ่มอยู่ใน split เดียว
+    train_positions, test_positions = group_split(groups, test_size=0.1, seed=42)
+    report["test_groups"] = int(len(set(groups[test_positions].tolist())))
+    split = DatasetDict({
+        "train": dataset.select(keep[train_positions]),
+        "test": dataset.select(keep[test_positions]),
+    })
+    return split, report
+
+def print_filter_report(report):
+    removed = report["records_removed"]
+    print(f"Records: {report['records_in']} -> {report['records_out']} "
+          f"(exact duplicates: {removed['exact_duplicate']}, near duplicates: {removed['near_duplicate']}, "
+          f"too long: {removed['too_long']})")
+    print(f"Similarity groups: {report['groups']} (largest: {report['largest_group']} records)")
+    if "tokens_in" in report:
+        tokens = report["tokens_removed"]
+        print(f"Tokens removed: {report['tokens_removed_total']} of {report['tokens_in']} "
+              f"(exact duplicates: {tokens['exact_duplicate']}, near duplicates: {tokens['near_duplicate']}, "
+              f"too long: {tokens['too_long']})")
+
+def prepare_dataset(raw_data_path, output_path, num_proc=None, batch_size=1000, max_shard_size="500MB",
+                    dedup=True, tokenizer=None, max_tokens=512, near_dup_threshold=0.8, group_threshold=0.5,
+                    dedup_index_path=None):
+    """
+    เตรียม dataset
+
+    อ่านไฟล์ดิบ (.json array หรือ .jsonl) แบบ streaming, format ใน worker pool
+    และเขียน Arrow ลง disk ระหว่างทาง memory จึงไม่โตตามขนาด corpus
+
+    ถ้า dedup หรือมี tokenizer จะตัด record ที่ซ้ำ/เกือบซ้ำ และที่ยาวเกิน max_tokens ก่อนแบ่ง train/test
+    แล้วแบ่งทีละกลุ่มของ record ที่คล้ายกัน (ดู dedup.py) รายงานบันทึกที่ output_path/dedup_report.json
+    ถ้าปิดทั้งสองอย่าง ผลเท่ากับ train_test_split ของทั้งไฟล์
+
+    Args:
+        num_proc: จำนวน worker process (None = จำนวน CPU)
+        batch_size: จำนวน record ต่อ batch ที่ส่งให้ worker
+        max_shard_size: ขนาดสูงสุดของแต่ละ shard ที่บันทึก
+        dedup: ตัด exact/near duplicate
+        tokenizer: tokenizer หรือชื่อ/path ของโมเดลฐาน สำหรับกรองความยาว (None = ไม่กรอง)
+        max_tokens: จำนวน token สูงสุดของ record (max_length ของ tokenize_dataset)
+        near_dup_threshold: Jaccard ขั้นต่ำที่ถือว่าเกือบซ้ำ
+        group_threshold: Jaccard ขั้นต่ำที่ record ต้องอยู่ split เดียวกัน
+        dedup_index_path: ไฟล์ sqlite ของ LSH index (None = ไฟล์ชั่วคราว)
+    """
+    num_proc = num_proc or os.cpu_count() or 1
+    stat = os.stat(raw_data_path)
+
+    # สร้าง dataset (เขียนเป็น Arrow ทีละ batch)
+    dataset = Dataset.from_generator(
+        generate_formatted_records,
+        gen_kwargs={
+            "raw_data_path": raw_data_path,
+            "num_proc": num_proc,
+            "batch_size": batch_size,
+            # ต้องไม่เป็น list เพราะ datasets จะแยก list ใน gen_kwargs เป็นหลาย shard
+            "file_signature": f"{os.path.abspath(raw_data_path)}:{stat.st_size}:{stat.st_mtime}",
+        },
+    )
+
     # แบ่ง train/validation
-    dataset = dataset.train_test_split(test_size=0.1, seed=42)
-    
+    tokenizer = load_tokenizer(tokenizer)
+    report = None
+    if dedup or tokenizer is not None:
+        dataset, report = filter_records(
+            dataset,
+            num_proc,
+            dedup=dedup,
+            tokenizer=tokenizer,
+            max_tokens=max_tokens,
+            near_dup_threshold=near_dup_threshold,
+            group_threshold=group_threshold,
+            index_path=dedup_index_path,
+        )
+    else:
+        dataset = dataset.train_test_split(test_size=0.1, seed=42)
+
     # บันทึก
-    dataset.save_to_disk(output_path)
+    dataset.save_to_disk(output_path, max_shard_size=max_shard_size)
     print(f"Dataset saved to {output_path}")
+    if report is not None:
+        with open(os.path.join(output_path, "dedup_report.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print_filter_report(report)
     print(f"Train samples: {len(dataset['train'])}")
     print(f"Validation samples: {len(dataset['test'])}")
-    
+
     return dataset
 
+def main(raw_data_path="data/raw_data.json", output_path="data/processed_dataset", num_proc=None, dedup=True,
+         tokenizer=None, max_tokens=512, near_dup_threshold=0.8):
+    return prepare_dataset(
+        raw_data_path=raw_data_path,
+        output_path=output_path,
+        num_proc=num_proc,
+        dedup=dedup,
+        tokenizer=tokenizer,
+        max_tokens=max_tokens,
+        near_dup_threshold=near_dup_threshold,
+    )
+
 if __name__ == "__main__":
-    dataset = prepare_dataset(
-        raw_data_path="data/raw_data.json",
-        output_path="data/processed_dataset"
-    )
\ No newline at end of file
+    dataset = main()
@@ -6,19 +6,40 @@ from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     TrainingArguments,
-    Trainer,
     DataCollatorForLanguageModeling
 )
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 from datasets import load_from_disk
+import json
 import os
+import random
+import tempfile
+from device import resolve_device
+from packing import PackedDataCollator, pack_examples, padding_stats
+from token_artifact import load_or_build_token_artifact
+from training_telemetry import (
+    TelemetryCallback,
+    TelemetryCollator,
+    TelemetryTrainer,
+    autotune_candidates,
+    is_out_of_memory,
+    memory_budget_mb,
+    print_autotune,
+    print_summary,
+    recommend,
+)
 
 class LLMFineTuner:
-    def __init__(self, model_name, output_dir):
+    def __init__(self, model_name, output_dir, device="auto"):
         self.model_name = model_name
         self.output_dir = output_dir
+        # CUDA: โหลดแบบ int8 (bitsandbytes) + fp16, CPU: fp32 (เช่นโมเดลเล็กสำหรับทดสอบ)
+        self.device = resolve_device(device)
         self.tokenizer = None
         self.model = None
+        self.packing_mode = "max_length"
+        self.padding_report = None
+        self.telemetry_summary = None
         
     def load_model(self):
         """โหลดโมเดลและ tokenizer"""
@@ -28,18 +49,23 @@ class LLMFineTuner:
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.tokenizer.padding_side = "right"
         
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model_name,
-            load_in_8bit=True,
-            device_map="auto",
-            torch_dtype=torch.float16,
-        )
+        if self.device == "cuda":
+            from transformers import BitsAndBytesConfig
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.model_name,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                device_map="auto",
+                torch_dtype=torch.float16,
+            )
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
         
         print("Model loaded successfully!")
         
     def setup_lora(self):
         """ตั้งค่า LoRA"""
-        self.model = prepare_model_for_kbit_training(self.model)
+        if self.device == "cuda":
+            self.model = prepare_model_for_kbit_training(self.model)
         
         lora_config = LoraConfig(
             r=16,
@@ -53,87 +79,324 @@ class LLMFineTuner:
         self.model = get_peft_model(self.model, lora_config)
         self.model.print_trainable_parameters()
         
-    def tokenize_dataset(self, dataset):
-        """Tokenize dataset"""
+    def tokenize_dataset(self, dataset, mode="max_length", max_length=512, batch_size=4):
+        """
+        Tokenize dataset
+        
+        Args:
+            mode: "max_length" = pad ทุก example ถึง max_length (แบบเดิม)
+                  "dynamic" = ไม่ pad ตอน tokenize ให้ collator pad ตาม batch และจัด batch ตามความยาว
+                  "packed" = รวมหลาย example ให้เต็ม max_length โดย attention ไม่ข้าม example
+            batch_size: ขนาด batch ที่ใช้ประมาณ padding ของโหมด dynamic
+        """
+        if mode not in ("max_length", "dynamic", "packed"):
+            raise ValueError(f"Unknown tokenization mode: {mode}")
+        
+        # token artifact (token_artifact.py) มี input_ids อยู่แล้ว ไม่ต้องเรียก tokenizer ซ้ำ
+        pretokenized = "input_ids" in dataset["train"].column_names
+        pad_id = self.tokenizer.pad_token_id
+        
         def tokenize_function(examples):
-            result = self.tokenizer(
-                examples["text"],
-                truncation=True,
-                max_length=512,
-                padding="max_length",
-            )
-            result["labels"] = result["input_ids"].copy()
+            if pretokenized:
+                input_ids = [ids[:max_length] for ids in examples["input_ids"]]
+                if mode == "max_length":
+                    # pad ด้านขวาเหมือน tokenizer (padding_side = "right")
+                    result = {
+                        "input_ids": [ids + [pad_id] * (max_length - len(ids)) for ids in input_ids],
+                        "attention_mask": [[1] * len(ids) + [0] * (max_length - len(ids)) for ids in input_ids],
+                    }
+                else:
+                    result = {"input_ids": input_ids, "attention_mask": [[1] * len(ids) for ids in input_ids]}
+            else:
+                result = self.tokenizer(
+                    examples["text"],
+                    truncation=True,
+                    max_length=max_length,
+                    padding="max_length" if mode == "max_length" else False,
+                )
+            if mode == "max_length":
+                result["labels"] = result["input_ids"].copy()
+            # โหมด dynamic: ความยาวต่างกันต่อ example ให้ collator สร้าง labels หลัง pad (pad = -100)
             return result
         
+        def pack_function(examples):
+            if pretokenized:
+                input_ids = examples["input_ids"]
+            else:
+                input_ids = self.tokenizer(examples["text"], truncation=True, max_length=max_length)["input_ids"]
+            return pack_examples(input_ids, max_length)
+        
         tokenized = dataset.map(
-            tokenize_function,
+            pack_function if mode == "packed" else tokenize_function,
             batched=True,
             remove_columns=dataset["train"].column_names
         )
+        
+        self.packing_mode = mode
+        self.padding_report = self.padding_report_for(tokenized["train"], mode, max_length, batch_size)
+        print(f"Tokenization mode: {mode}")
+        print(f"  Padding ratio (max_length baseline): {self.padding_report['baseline_padding_ratio']:.2%}")
+        print(f"  Padding ratio ({mode}): {self.padding_report['padding_ratio']:.2%}")
         return tokenized
     
-    def train(self, train_dataset, eval_dataset, num_epochs=3):
-        """เทรนโมเดล"""
-        training_args = TrainingArguments(
+    def padding_report_for(self, train_dataset, mode, max_length, batch_size):
+        """
+        คำนวณสัดส่วน padding ของ train set เทียบกับการ pad ทุก example ถึง max_length
+        """
+        def batch_padded_lengths(ordered):
+            # collator pad ถึงแถวที่ยาวที่สุดของ batch
+            return [
+                max(ordered[start:start + batch_size]) * len(ordered[start:start + batch_size])
+                for start in range(0, len(ordered), batch_size)
+            ]
+        
+        if mode == "packed":
+            real_lengths = [sum(seq_lens) for seq_lens in train_dataset["seq_lens"]]
+            num_examples = sum(len(seq_lens) for seq_lens in train_dataset["seq_lens"])
+            # แถวที่ pack แล้วถูกสุ่มเข้า batch ประมาณด้วยการสลับลำดับแบบเดียวกับ sampler (seed ของ TrainingArguments)
+            ordered = list(real_lengths)
+            random.Random(42).shuffle(ordered)
+            padded_lengths = batch_padded_lengths(ordered)
+        else:
+            if mode == "max_length":
+                real_lengths = [sum(mask) for mask in train_dataset["attention_mask"]]
+                padded_lengths = [max_length] * len(real_lengths)
+            else:
+                real_lengths = [len(ids) for ids in train_dataset["input_ids"]]
+                # group_by_length จัด example ยาวใกล้กันไว้ batch เดียวกัน ประมาณด้วยการเรียงตามความยาว
+                padded_lengths = batch_padded_lengths(sorted(real_lengths, reverse=True))
+            num_examples = len(real_lengths)
+        
+        report = padding_stats(real_lengths, padded_lengths)
+        baseline = padding_stats(real_lengths, [max_length * num_examples])
+        report["mode"] = mode
+        report["num_examples"] = num_examples
+        report["num_sequences"] = len(real_lengths)
+        report["baseline_total_tokens"] = baseline["total_tokens"]
+        report["baseline_padding_ratio"] = baseline["padding_ratio"]
+        return report
+    
+    def training_arguments(self, num_epochs=3, batch_size=4, gradient_accumulation_steps=4, **overrides):
+        """TrainingArguments ของการเทรน (overrides ใช้กับรอบ probe ของ autotune)"""
+        kwargs = dict(
             output_dir=self.output_dir,
             num_train_epochs=num_epochs,
-            per_device_train_batch_size=4,
-            per_device_eval_batch_size=4,
-            gradient_accumulation_steps=4,
+            per_device_train_batch_size=batch_size,
+            per_device_eval_batch_size=batch_size,
+            gradient_accumulation_steps=gradient_accumulation_steps,
             warmup_steps=100,
             learning_rate=2e-4,
-            fp16=True,
+            fp16=self.device == "cuda",
+            use_cpu=self.device == "cpu",
             logging_steps=10,
-            evaluation_strategy="steps",
+            eval_strategy="steps",
             eval_steps=50,
             save_steps=100,
             save_total_limit=2,
             load_best_model_at_end=True,
+            # โหมด packed ต้องเก็บคอลัมน์ seq_lens ไว้ให้ collator สร้าง attention mask
+            remove_unused_columns=self.packing_mode != "packed",
+            # TelemetryCollator นับ token ใน process หลัก
+            dataloader_num_workers=0,
         )
-        
-        data_collator = DataCollatorForLanguageModeling(
+        # โหมด dynamic: จัด example ยาวใกล้กันไว้ batch เดียวกัน ลด padding
+        # (transformers 5 ย้าย group_by_length ไปเป็น train_sampling_strategy)
+        if "train_sampling_strategy" in TrainingArguments.__dataclass_fields__:
+            kwargs["train_sampling_strategy"] = "group_by_length" if self.packing_mode == "dynamic" else "random"
+        else:
+            kwargs["group_by_length"] = self.packing_mode == "dynamic"
+        kwargs.update(overrides)
+        return TrainingArguments(**kwargs)
+    
+    def data_collator(self):
+        if self.packing_mode == "packed":
+            return PackedDataCollator(self.tokenizer, dtype=self.model.dtype)
+        return DataCollatorForLanguageModeling(
             tokenizer=self.tokenizer,
             mlm=False
         )
+    
+    def train(self, train_dataset, eval_dataset, num_epochs=3, batch_size=4, gradient_accumulation_steps=4):
+        """
+        เทรนโมเดล
         
-        trainer = Trainer(
+        telemetry ของแต่ละ optimizer step บันทึกที่ output_dir/telemetry.jsonl และสรุปที่ telemetry_summary.json
+        """
+        training_args = self.training_arguments(num_epochs, batch_size, gradient_accumulation_steps)
+        data_collator = TelemetryCollator(self.data_collator())
+        telemetry = TelemetryCallback(data_collator, path=os.path.join(self.output_dir, "telemetry.jsonl"))
+        
+        trainer = TelemetryTrainer(
             model=self.model,
             args=training_args,
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
             data_collator=data_collator,
+            callbacks=[telemetry],
         )
         
         print("Starting training...")
-        trainer.train()
+        train_result = trainer.train()
+        self.report_throughput(train_result.metrics, num_epochs)
+        self.report_telemetry(telemetry)
         
         # บันทึกโมเดล
         trainer.save_model(os.path.join(self.output_dir, "final_model"))
         self.tokenizer.save_pretrained(os.path.join(self.output_dir, "final_model"))
         print("Training completed!")
+    
+    def report_telemetry(self, telemetry):
+        self.telemetry_summary = telemetry.summary()
+        if not self.telemetry_summary:
+            return
+        print_summary(self.telemetry_summary)
+        with open(os.path.join(self.output_dir, "telemetry_summary.json"), "w", encoding="utf-8") as f:
+            json.dump(self.telemetry_summary, f, indent=2)
+    
+    def autotune(self, train_dataset, candidates=None, probe_steps=3, max_memory_mb=None):
+        """
+        ลอง (batch size, gradient accumulation) แต่ละชุด probe_steps optimizer step (+1 step warmup)
+        แล้วเลือกชุดที่ effective tokens/sec สูงสุดที่หน่วยความจำไม่เกิน max_memory_mb
+        
+        weights ของ adapter ถูกคืนค่าหลังแต่ละ probe ทุก config จึงเริ่มจาก weights เดียวกัน และการเทรนจริงไม่ได้รับผลจาก autotune
+        
+        Args:
+            candidates: list ของ (batch_size, gradient_accumulation_steps)
+                        (None = ทุกชุดที่ effective batch size เท่ากับค่า default 4 x 4)
+            max_memory_mb: budget ของหน่วยความจำ (None = 90% ของ GPU หรือ RAM)
+        
+        Returns:
+            (recommended, results): recommended เป็น dict ของ config ที่เลือก (None ถ้าไม่มีชุดไหนพอดี)
+        """
+        candidates = candidates or autotune_candidates()
+        trainable = {
+            name: parameter.detach().clone()
+            for name, parameter in self.model.named_parameters()
+            if parameter.requires_grad
+        }
+        results = []
+        budget = None
+        timeline_path = os.path.join(self.output_dir, "autotune_telemetry.jsonl")
+        os.makedirs(self.output_dir, exist_ok=True)
+        open(timeline_path, "w").close()
+        
+        for batch_size, gradient_accumulation_steps in candidates:
+            result = {"batch_size": batch_size, "gradient_accumulation_steps": gradient_accumulation_steps}
+            data_collator = TelemetryCollator(self.data_collator())
+            telemetry = TelemetryCallback(data_collator, tags=dict(result))
+            with tempfile.TemporaryDirectory(prefix="autotune_") as probe_dir:
+                args = self.training_arguments(
+                    batch_size=batch_size,
+                    gradient_accumulation_steps=gradient_accumulation_steps,
+                    output_dir=probe_dir,
+                    max_steps=probe_steps + telemetry.warmup_steps,
+                    warmup_steps=0,
+                    eval_strategy="no",
+                    save_strategy="no",
+                    load_best_model_at_end=False,
+                    logging_strategy="no",
+                    report_to=[],
+                    disable_tqdm=True,
+                )
+                budget = budget or max_memory_mb or memory_budget_mb(args.device)
+                trainer = TelemetryTrainer(
+                    model=self.model,
+                    args=args,
+                    train_dataset=train_dataset,
+                    data_collator=data_collator,
+                    callbacks=[telemetry],
+                )
+                try:
+                    trainer.train()
+                    result.update(telemetry.summary())
+                    result["fits"] = result["peak_memory_mb"] <= budget
+                except RuntimeError as error:
+                    if not is_out_of_memory(error):
+                        raise
+                    result.update(fits=False, error="out of memory")
+                finally:
+                    del trainer
+                    self.model.zero_grad(set_to_none=True)
+                    with torch.no_grad():
+                        for name, parameter in self.model.named_parameters():
+                            if name in trainable:
+                                parameter.copy_(trainable[name])
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+            
+            with open(timeline_path, "a", encoding="utf-8") as f:
+                for record in telemetry.records:
+                    f.write(json.dumps(record) + "\n")
+            results.append(result)
+        
+        best = recommend(results)
+        print_autotune(results, best)
+        with open(os.path.join(self.output_dir, "autotune.json"), "w", encoding="utf-8") as f:
+            json.dump({"max_memory_mb": budget, "recommended": best, "results": results}, f, indent=2)
+        return best, results
+    
+    def report_throughput(self, train_metrics, num_epochs):
+        """
+        แสดง tokens/sec ทั้งแบบรวม padding และแบบ effective (เฉพาะ token จริง)
+        เทียบกับจำนวน token ที่โหมด max_length จะต้องประมวลผล
+        """
+        if not self.padding_report or not train_metrics.get("train_runtime"):
+            return
+        
+        runtime = train_metrics["train_runtime"]
+        report = dict(self.padding_report)
+        report["train_runtime"] = runtime
+        report["tokens_per_sec"] = report["total_tokens"] * num_epochs / runtime
+        report["effective_tokens_per_sec"] = report["real_tokens"] * num_epochs / runtime
+        
+        print(f"Throughput ({report['mode']}):")
+        print(f"  Tokens/sec (incl. padding): {report['tokens_per_sec']:.1f}")
+        print(f"  Effective tokens/sec: {report['effective_tokens_per_sec']:.1f}")
+        print(f"  Padding ratio: {report['padding_ratio']:.2%} "
+              f"(max_length baseline: {report['baseline_padding_ratio']:.2%})")
+        
+        with open(os.path.join(self.output_dir, "throughput.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
 
-def main():
+def main(dataset_path="data/processed_dataset", model_name="meta-llama/Llama-2-7b-hf", output_dir="./results",
+         num_epochs=3, mode="max_length", device="auto", batch_size=4, gradient_accumulation_steps=4, autotune=False):
     # โหลด dataset
-    dataset = load_from_disk("data/processed_dataset")
+    dataset = load_from_disk(dataset_path)
     
     # สร้าง fine-tuner
     fine_tuner = LLMFineTuner(
-        model_name="meta-llama/Llama-2-7b-hf",
-        output_dir="./results"
+        model_name=model_name,
+        output_dir=output_dir,
+        device=device,
     )
     
     # โหลดโมเดล
     fine_tuner.load_model()
     fine_tuner.setup_lora()
     
-    # Tokenize dataset
-    tokenized_dataset = fine_tuner.tokenize_dataset(dataset)
+    # Pre-tokenize ครั้งเดียว (ใช้ร่วมกับ 03_evaluate_model.py และข้ามได้ถ้าไม่มีอะไรเปลี่ยน)
+    token_dataset = load_or_build_token_artifact(dataset, fine_tuner.tokenizer, max_length=512)
+    
+    # Tokenize dataset ("max_length" | "dynamic" | "packed")
+    tokenized_dataset = fine_tuner.tokenize_dataset(token_dataset, mode=mode, batch_size=batch_size)
+    
+    # เลือก batch size / gradient accumulation ที่เร็วที่สุดที่ memory พอ (effective batch size เท่าเดิม)
+    if autotune:
+        best, _ = fine_tuner.autotune(
+            tokenized_dataset["train"],
+            candidates=autotune_candidates(batch_size, gradient_accumulation_steps),
+        )
+        if best is not None:
+            batch_size = best["batch_size"]
+            gradient_accumulation_steps = best["gradient_accumulation_steps"]
     
     # เทรน
     fine_tuner.train(
         train_dataset=tokenized_dataset["train"],
         eval_dataset=tokenized_dataset["test"],
-        num_epochs=3
+        num_epochs=num_epochs,
+        batch_size=batch_size,
+        gradient_accumulation_steps=gradient_accumulation_steps,
     )
 
 if __name__ == "__main__":
@@ -2,206 +2,735 @@
 ไฟล์สำหรับประเมินประสิทธิภาพของโมเดลที่เทรนแล้ว
 """
 import torch
-import json
 import numpy as np
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
-from datasets import load_from_disk, load_metric
+from transformers import AutoTokenizer, StoppingCriteriaList
+from datasets import load_from_disk
 from tqdm import tqdm
-import pandas as pd
-from datetime import datetime
 import os
+import time
+from prompt_template import build_prompt, parse_example, response_char_offset
+from prefix_cache import PrefixCache
+from token_artifact import load_or_build_token_artifact, response_token_start
+from eval_metrics import ROUGE_TYPES, MetricsEngine
+from eval_report import perplexity_metrics, print_metrics_summary, save_results
+from response_cache import adapter_identity
+from result_log import LoggedResults, ResultLog, evaluation_fingerprint
+from instrumentation import Instrumentation
+from kv_cache import kv_bytes_per_token
+from device import load_model, resolve_model_paths
+from stopping import STOP_SEQUENCE, STOP_SEQUENCES, StopSequenceCriteria, truncate_at_stop
+from adaptive_eval import AdaptiveStopper, stratified_order
+
+# เป้าความกว้าง CI (high - low) ของโหมด adaptive
+DEFAULT_CI_TARGETS = {"perplexity": 1.0, "rougeL": 0.05}
+# พารามิเตอร์ generate ของการประเมิน (generate_samples ใช้ค่านี้ และอยู่ใน fingerprint ของ result log)
+GENERATION_PARAMS = {"max_tokens": 256, "temperature": 0.7, "top_p": 0.9, "do_sample": True}
+
+def make_length_buckets(lengths, token_budget, max_new_tokens=256, max_batch_size=32):
+    """
+    จัดกลุ่ม sample ตามความยาว prompt ให้แต่ละ batch ไม่เกิน token budget
+    
+    Args:
+        lengths: ความยาว prompt (จำนวน token) ของแต่ละ sample
+        token_budget: จำนวน token สูงสุดต่อ batch นับเป็น (prompt ยาวสุด + max_new_tokens) x จำนวนแถว
+        max_new_tokens: จำนวน token ที่จะ generate ต่อแถว
+        max_batch_size: จำนวนแถวสูงสุดต่อ batch
+    
+    Returns:
+        list ของ list index (batch ที่ยาวที่สุดมาก่อน เพื่อให้ OOM เกิดตั้งแต่ต้น)
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+    
+    batches = []
+    current = []
+    for idx in order:
+        # เรียงจากยาวไปสั้น แถวแรกของ batch จึงเป็นแถวที่ยาวที่สุดเสมอ
+        longest = lengths[current[0]] if current else lengths[idx]
+        if current and ((len(current) + 1) * (longest + max_new_tokens) > token_budget or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+    
+    return batches
+
+
+def load_test_dataset(test_dataset, num_samples=None):
+    """
+    โหลด test dataset จาก path หรือ Dataset และจำกัดจำนวน samples
+    """
+    if isinstance(test_dataset, str):
+        dataset = load_from_disk(test_dataset)
+        if "test" in dataset:
+            dataset = dataset["test"]
+    else:
+        dataset = test_dataset
+    
+    # จำกัดจำนวน samples ถ้าต้องการ
+    if num_samples:
+        dataset = dataset.select(range(min(num_samples, len(dataset))))
+    
+    return dataset
+
+
+def prepare_samples(dataset):
+    """
+    แปลง dataset เป็น list ของ sample dict
+    
+    ถ้า dataset เป็น token artifact (มีคอลัมน์ input_ids) จะใช้ field และ token ที่เตรียมไว้
+    โดยไม่ต้อง parse text หรือ tokenize ใหม่ ไม่เช่นนั้น field token จะเป็น None
+    """
+    columns = dataset.column_names
+    if "input_ids" in columns and "prompt_input_ids" in columns:
+        return [
+            {
+                "text": sample["text"],
+                "instruction": sample["instruction"],
+                "input": sample["input"],
+                "expected_output": sample["output"],
+                "input_ids": sample["input_ids"],
+                "response_start": sample["response_start"],
+                "prompt_input_ids": sample["prompt_input_ids"],
+            }
+            for sample in dataset
+        ]
+    
+    samples = []
+    for sample in dataset:
+        instruction, input_text, expected_output = parse_example(sample["text"])
+        samples.append({
+            "text": sample["text"],
+            "instruction": instruction,
+            "input": input_text,
+            "expected_output": expected_output,
+            "input_ids": None,
+            "response_start": None,
+            "prompt_input_ids": None,
+        })
+    return samples
+
+
+def make_evaluation_fingerprint(base_model_name, adapter_path, dataset, response_only, precision,
+                                stop_sequences=STOP_SEQUENCES, generation_params=None):
+    """
+    fingerprint ของ config การประเมิน ใช้เป็น key ของ result log (resume ได้เฉพาะ config เดียวกัน)
+    รวม stop sequence และพารามิเตอร์ generate ที่ใช้จริง (None = GENERATION_PARAMS)
+    """
+    return evaluation_fingerprint({
+        "base_model": base_model_name,
+        "adapter": adapter_identity(adapter_path or base_model_name),
+        "dataset": getattr(dataset, "_fingerprint", None),
+        "num_samples": len(dataset),
+        "response_only": response_only,
+        "precision": precision,
+        "stop_sequences": list(stop_sequences),
+        "generation": dict(generation_params or GENERATION_PARAMS),
+    })
+
+
+def prompt_lengths(samples, tokenizer, sample_ids):
+    """ความยาว prompt (token) ของ samples ที่ระบุ ใช้ token จาก artifact ถ้ามี"""
+    if samples[0]["prompt_input_ids"] is not None:
+        return [len(samples[idx]["prompt_input_ids"]) for idx in sample_ids]
+    return [
+        len(ids) for ids in tokenizer(
+            [build_prompt(samples[idx]["instruction"], samples[idx]["input"]) for idx in sample_ids],
+            truncation=True,
+            max_length=512,
+        )["input_ids"]
+    ]
+
 
 class ModelEvaluator:
-    def __init__(self, base_model_name, adapter_path, output_dir="./evaluation_results"):
+    def __init__(self, base_model_name, adapter_path, output_dir="./evaluation_results", load_in_8bit=True,
+                 instrumentation=None, device="auto", precision=None, num_threads=None, compile_model=False,
+                 stop_sequences=STOP_SEQUENCES):
         """
         Initialize Model Evaluator
         
         Args:
             base_model_name: ชื่อโมเดลฐาน
-            adapter_path: path ของ LoRA adapter ที่เทรนแล้ว
+            adapter_path: path ของ LoRA adapter ที่เทรนแล้ว หรือโมเดลที่ merge แล้วจาก 05_export_merged_model.py
             output_dir: directory สำหรับบันทึกผลการประเมิน
+            load_in_8bit: ใช้ precision int8 (bitsandbytes บน CUDA, dynamic quantization บน CPU)
+                ไม่มีผลถ้าระบุ precision
+            instrumentation: Instrumentation สำหรับจับเวลาแต่ละ phase ของ generate (None = ปิด)
+            device, precision, num_threads, compile_model: ดู device.load_model
+            stop_sequences: หยุด generate แต่ละแถวเมื่อเจอ text เหล่านี้ (default คือ marker "### " ของ template)
         """
+        self.base_model_name = base_model_name
+        self.adapter_path = adapter_path
         self.output_dir = output_dir
         os.makedirs(output_dir, exist_ok=True)
         
         print("Loading tokenizer...")
-        self.tokenizer = AutoTokenizer.from_pretrained(adapter_path)
-        
-        print("Loading base model...")
-        base_model = AutoModelForCausalLM.from_pretrained(
-            base_model_name,
-            load_in_8bit=True,
-            device_map="auto",
-            torch_dtype=torch.float16,
+        model_path, adapter_path = resolve_model_paths(base_model_name, adapter_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(adapter_path or model_path)
+        
+        print("Loading base model and fine-tuned adapter...")
+        if precision is None:
+            precision = "int8" if load_in_8bit else "auto"
+        self.model, self.device_info = load_model(
+            model_path,
+            adapter_path,
+            device=device,
+            precision=precision,
+            num_threads=num_threads,
+            compile_model=compile_model,
         )
         
-        print("Loading fine-tuned adapter...")
-        self.model = PeftModel.from_pretrained(base_model, adapter_path)
-        self.model.eval()
+        # KV cache ของ preamble ที่ทุก prompt ใช้ร่วมกัน
+        self.prefix_cache = PrefixCache(self.model, self.tokenizer)
+        
+        self.instrumentation = instrumentation or Instrumentation(enabled=False)
+        self.kv_bytes_per_token = kv_bytes_per_token(self.model)
+        
+        self.stop_sequences = tuple(stop_sequences)
+        # จำนวนแถวที่หยุดที่ stop sequence และ token ที่ไม่ต้อง generate (สะสมจนกว่าจะ reset)
+        self.stop_sequence_stops = 0
+        self.tokens_saved = 0
         
         print("Model loaded successfully!")
         
+    def build_prompt(self, instruction, input_text):
+        """
+        สร้าง prompt ตาม Alpaca template (ไม่รวมส่วน response)
+        """
+        return build_prompt(instruction, input_text)
+    
     def generate_response(self, instruction, input_text, max_tokens=256, temperature=0.7):
         """
         Generate response จากโมเดล
         """
-        prompt = f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
-
-### Instruction:
-{instruction}
-
-### Input:
-{input_text}
-
-### Response:
-"""
+        responses, _ = self.generate_batch([(instruction, input_text)], max_tokens, temperature)
+        return responses[0]
+    
+    def generate_batch(self, pairs, max_tokens=256, temperature=0.7, prompt_ids=None, top_p=0.9, do_sample=True):
+        """
+        Generate response หลาย samples ใน model.generate ครั้งเดียว (left padding)
         
-        inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512).to("cuda")
+        Args:
+            pairs: list ของ (instruction, input_text)
+            prompt_ids: token ของ prompt ที่ tokenize ไว้แล้ว (จาก token artifact) ถ้ามีจะไม่ tokenize ใหม่
         
-        with torch.no_grad():
+        Returns:
+            (responses, generated_token_counts) เรียงตามลำดับของ pairs
+        """
+        # preamble ที่ทุก prompt ใช้ร่วมกันมาจาก prefix cache ส่วนที่เหลือ pad ให้ token ใหม่ต่อท้าย prompt ทุกแถว
+        with self.instrumentation.phase("tokenize"):
+            if prompt_ids is not None:
+                inputs = self.prefix_cache.prepare_token_inputs(prompt_ids)
+            else:
+                prompts = [self.build_prompt(instruction, input_text) for instruction, input_text in pairs]
+                inputs = self.prefix_cache.prepare_inputs(prompts, max_length=512)
+        
+        # แต่ละแถวหยุดเองเมื่อเจอ stop sequence ทั้ง batch จบเมื่อทุกแถวหยุด
+        prompt_length = inputs["input_ids"].shape[1]
+        stop_criteria = StopSequenceCriteria(self.tokenizer, prompt_length, self.stop_sequences)
+        criteria = [stop_criteria]
+        step_timer = self.instrumentation.step_timer()
+        if step_timer is not None:
+            criteria.append(step_timer)
+        
+        with self.instrumentation.phase("generate"), torch.no_grad():
             outputs = self.model.generate(
                 **inputs,
                 max_new_tokens=max_tokens,
                 temperature=temperature,
-                top_p=0.9,
-                do_sample=True,
+                top_p=top_p,
+                do_sample=do_sample,
                 pad_token_id=self.tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList(criteria),
             )
-        
-        full_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        response = full_response.split("### Response:")[-1].strip()
-        return response
+        if step_timer is not None:
+            step_timer.finish()
+        
+        # decode เฉพาะ token ใหม่ แล้วตัดที่ stop sequence
+        new_tokens = outputs[:, prompt_length:]
+        with self.instrumentation.phase("detokenize"):
+            responses = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        with self.instrumentation.phase("postprocess"):
+            responses = [truncate_at_stop(response, self.stop_sequences).strip() for response in responses]
+        
+        # นับ token ที่ generate จริง (ไม่นับ pad ของแถวที่หยุดก่อน)
+        stops = stop_criteria.finish(max_tokens)
+        token_counts = [stop["generated_tokens"] for stop in stops] or [new_tokens.shape[1]] * len(responses)
+        for stop in stops:
+            if stop["finish_reason"] == STOP_SEQUENCE:
+                self.stop_sequence_stops += 1
+                self.tokens_saved += stop["tokens_saved"]
+        
+        if self.instrumentation.enabled:
+            for prompt_tokens, generated_tokens in zip(inputs["attention_mask"].sum(dim=-1).tolist(), token_counts):
+                self.instrumentation.record_request(
+                    prompt_tokens,
+                    generated_tokens,
+                    (prompt_tokens + generated_tokens) * self.kv_bytes_per_token,
+                )
+        
+        return responses, token_counts
     
-    def calculate_perplexity(self, text):
+    def calculate_perplexity(self, text, response_only=False):
         """
         คำนวณ perplexity ของ text
         Perplexity ต่ำ = โมเดลมั่นใจในการ predict
         """
-        inputs = self.tokenizer(text, return_tensors="pt", truncation=True, max_length=512).to("cuda")
+        return self.score_batch([text], response_only=response_only)[0]
+    
+    def score_batch(self, texts, response_only=False):
+        """
+        คำนวณ perplexity ของหลาย text ใน forward pass เดียว
+        
+        Args:
+            texts: list ของ text เต็ม (prompt + response)
+            response_only: True = คิดเฉพาะ token หลัง "### Response:"
+        
+        Returns:
+            list ของ perplexity ตามลำดับของ texts
+        """
+        encoded = self.tokenizer(
+            texts,
+            truncation=True,
+            max_length=512,
+            return_offsets_mapping=response_only,
+        )
+        response_starts = None
+        if response_only:
+            response_starts = [
+                response_token_start(offsets, response_char_offset(text))
+                for offsets, text in zip(encoded["offset_mapping"], texts)
+            ]
+        return self.score_token_batch(encoded["input_ids"], response_starts)
+    
+    def score_token_batch(self, input_ids, response_starts=None):
+        """
+        คำนวณ perplexity จาก token ที่ tokenize แล้วใน forward pass เดียว
+        
+        ใช้ right padding (ตำแหน่ง token จริงไม่เลื่อน) และไม่นับ token ที่เป็น padding
+        แถวที่ไม่มี token ให้คิด (เช่น response_only และ response ถูกตัดหมดที่ 512 token) ได้ nan
+        
+        Args:
+            input_ids: list ของ list token id
+            response_starts: index ของ token แรกของคำตอบในแต่ละแถว (None = คิดทุก token)
+        """
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        longest = max(len(ids) for ids in input_ids)
+        padded = torch.full((len(input_ids), longest), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(input_ids), longest), dtype=torch.long)
+        # mask ของ token ที่จะคิด log-likelihood (เลื่อน 1 ตำแหน่งเหมือน labels ของ causal LM)
+        score_mask = torch.zeros((len(input_ids), longest), dtype=torch.long)
+        for row, ids in enumerate(input_ids):
+            padded[row, :len(ids)] = torch.tensor(ids)
+            attention_mask[row, :len(ids)] = 1
+            start = response_starts[row] if response_starts is not None else 0
+            score_mask[row, start:len(ids)] = 1
+        
+        padded = padded.to(self.model.device)
+        attention_mask = attention_mask.to(self.model.device)
+        score_mask = score_mask[:, 1:].to(self.model.device)
         
         with torch.no_grad():
-            outputs = self.model(**inputs, labels=inputs["input_ids"])
-            loss = outputs.loss
-            perplexity = torch.exp(loss)
+            logits = self.model(input_ids=padded, attention_mask=attention_mask).logits[:, :-1]
+            labels = padded[:, 1:]
+            
+            perplexities = []
+            # ทีละแถว เพื่อไม่ต้องสร้าง log-softmax ขนาด batch x seq x vocab พร้อมกัน
+            for row in range(logits.shape[0]):
+                token_nll = torch.nn.functional.cross_entropy(
+                    logits[row].float(), labels[row], reduction="none"
+                )
+                mask = score_mask[row].float()
+                if not mask.sum():
+                    perplexities.append(float("nan"))
+                    continue
+                mean_nll = (token_nll * mask).sum() / mask.sum()
+                perplexities.append(torch.exp(mean_nll).item())
+        
+        return perplexities
+    
+    def score_dataset(self, test_dataset, num_samples=None, batch_token_budget=16384, max_batch_size=32, response_only=False):
+        """
+        คำนวณเฉพาะ perplexity ของ dataset (ไม่ generate) แบบ batched
+        
+        Returns:
+            list ของ results ที่มี sample_id, instruction, input, expected_output, perplexity
+        """
+        dataset = self.load_test_dataset(test_dataset, num_samples)
+        print(f"\nScoring perplexity on {len(dataset)} samples...")
         
-        return perplexity.item()
+        samples = self.prepare_samples(dataset)
+        if samples and samples[0]["input_ids"] is not None:
+            lengths = [len(sample["input_ids"]) for sample in samples]
+        else:
+            lengths = [
+                len(ids) for ids in self.tokenizer([sample["text"] for sample in samples], truncation=True, max_length=512)["input_ids"]
+            ]
+        batches = make_length_buckets(lengths, batch_token_budget, max_new_tokens=0, max_batch_size=max_batch_size)
+        
+        perplexities = [None] * len(samples)
+        start_time = time.perf_counter()
+        with tqdm(total=len(samples)) as progress:
+            for batch in batches:
+                scores = self.score_samples([samples[idx] for idx in batch], response_only=response_only)
+                for idx, perplexity in zip(batch, scores):
+                    perplexities[idx] = perplexity
+                progress.update(len(batch))
+        
+        elapsed = time.perf_counter() - start_time
+        self.last_throughput = {
+            "generation_mode": "perplexity_only",
+            "generation_seconds": elapsed,
+            "samples_per_sec": len(samples) / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_sec": sum(lengths) / elapsed if elapsed > 0 else 0.0,
+        }
+        print(f"Scoring throughput: {self.last_throughput['samples_per_sec']:.2f} samples/sec, "
+              f"{self.last_throughput['tokens_per_sec']:.2f} tokens/sec")
+        
+        results = []
+        for idx, sample in enumerate(samples):
+            results.append({
+                "sample_id": idx,
+                "instruction": sample["instruction"],
+                "input": sample["input"],
+                "expected_output": sample["expected_output"],
+                "perplexity": perplexities[idx],
+            })
+        
+        return results
+    
+    def prepare_samples(self, dataset):
+        """แปลง dataset เป็น list ของ sample dict (ดู prepare_samples)"""
+        return prepare_samples(dataset)
     
-    def evaluate_on_dataset(self, test_dataset, num_samples=None):
+    def score_samples(self, samples, response_only=False):
+        """คำนวณ perplexity ของ samples (ใช้ token จาก artifact ถ้ามี)"""
+        if samples[0]["input_ids"] is not None:
+            response_starts = [sample["response_start"] for sample in samples] if response_only else None
+            return self.score_token_batch([sample["input_ids"] for sample in samples], response_starts)
+        return self.score_batch([sample["text"] for sample in samples], response_only=response_only)
+    
+    def generate_samples(self, samples):
+        """Generate response ของ samples ใน batch เดียว (ใช้ token ของ prompt จาก artifact ถ้ามี)"""
+        prompt_ids = None
+        if samples[0]["prompt_input_ids"] is not None:
+            prompt_ids = [sample["prompt_input_ids"] for sample in samples]
+        return self.generate_batch(
+            [(sample["instruction"], sample["input"]) for sample in samples],
+            prompt_ids=prompt_ids,
+            **GENERATION_PARAMS,
+        )
+    
+    def load_test_dataset(self, test_dataset, num_samples=None):
+        """
+        โหลด test dataset จาก path หรือ Dataset และจำกัดจำนวน samples
+        """
+        return load_test_dataset(test_dataset, num_samples)
+    
+    def parse_sample(self, text):
+        """
+        แยก instruction, input, expected output ออกจาก text ของ sample
+        """
+        return parse_example(text)
+    
+    def evaluation_fingerprint(self, dataset, response_only=False):
+        """
+        fingerprint ของ config การประเมิน ใช้เป็น key ของ result log (resume ได้เฉพาะ config เดียวกัน)
+        """
+        return make_evaluation_fingerprint(
+            self.base_model_name, self.adapter_path, dataset, response_only, self.device_info.get("precision"),
+            self.stop_sequences, GENERATION_PARAMS,
+        )
+    
+    def evaluate_on_dataset(self, test_dataset, num_samples=None, batch_token_budget=None, max_batch_size=32, response_only=False,
+                            streaming_metrics=False, metrics_num_proc=None, result_log=None, resume=False):
         """
         ประเมินโมเดลบน test dataset
         
         Args:
             test_dataset: dataset สำหรับทดสอบ
             num_samples: จำนวน sample ที่จะประเมิน (None = ทั้งหมด)
+            batch_token_budget: จำนวน token สูงสุดต่อ batch (prompt ที่ pad แล้ว + max_tokens ต่อแถว)
+                None = generate ทีละ sample แบบเดิม
+            max_batch_size: จำนวนแถวสูงสุดต่อ batch ในโหมด batched
+            response_only: คิด perplexity เฉพาะ token ของ response
+            streaming_metrics: คำนวณ metrics ใน process pool ระหว่าง generate
+                ผลอยู่ใน self.last_metrics (เท่ากับ calculate_metrics(results) + confidence interval)
+            metrics_num_proc: จำนวน worker process ของ metrics (None = ไม่เกิน eval_metrics.DEFAULT_NUM_PROC)
+            result_log: path ของ JSONL ที่บันทึกผลทีละ sample ทันทีที่เสร็จ (None = เก็บใน memory)
+            resume: ข้าม sample ที่มีผลใน result_log แล้ว (config เดียวกัน)
+        
+        Returns:
+            list ของ results หรือ LoggedResults ที่อ่านจาก result_log ตามลำดับ sample_id
         """
-        results = []
-        
         # โหลดข้อมูล
-        if isinstance(test_dataset, str):
-            dataset = load_from_disk(test_dataset)
-            if "test" in dataset:
-                dataset = dataset["test"]
-        else:
-            dataset = test_dataset
-        
-        # จำกัดจำนวน samples ถ้าต้องการ
-        if num_samples:
-            dataset = dataset.select(range(min(num_samples, len(dataset))))
+        dataset = self.load_test_dataset(test_dataset, num_samples)
         
         print(f"\nEvaluating on {len(dataset)} samples...")
         
-        for idx, sample in enumerate(tqdm(dataset)):
-            # Extract instruction, input, expected output
-            text = sample["text"]
-            parts = text.split("### ")
-            
-            instruction = ""
-            input_text = ""
-            expected_output = ""
-            
-            for part in parts:
-                if part.startswith("Instruction:"):
-                    instruction = part.replace("Instruction:", "").strip()
-                elif part.startswith("Input:"):
-                    input_text = part.replace("Input:", "").strip()
-                elif part.startswith("Response:"):
-                    expected_output = part.replace("Response:", "").strip()
-            
-            # Generate prediction
-            predicted_output = self.generate_response(instruction, input_text)
-            
-            # Calculate perplexity
-            perplexity = self.calculate_perplexity(text)
-            
-            # เก็บผลลัพธ์
-            results.append({
+        samples = self.prepare_samples(dataset)
+        pending = list(range(len(samples)))
+        results = [None] * len(samples)
+        log = None
+        if result_log:
+            log = ResultLog(result_log, self.evaluation_fingerprint(dataset, response_only))
+            if resume:
+                completed = log.completed_ids()
+                pending = [idx for idx in pending if idx not in completed]
+                print(f"Resuming from {result_log}: {len(samples) - len(pending)} samples already evaluated")
+        
+        engine = MetricsEngine(len(samples), num_proc=metrics_num_proc) if streaming_metrics else None
+        if engine is not None and log is not None and resume:
+            for result in log.results():
+                engine.add(result["sample_id"], result["expected_output"], result["predicted_output"], result["perplexity"])
+        
+        def finish(idx, prediction, perplexity):
+            sample = samples[idx]
+            result = {
                 "sample_id": idx,
-                "instruction": instruction,
-                "input": input_text,
-                "expected_output": expected_output,
-                "predicted_output": predicted_output,
+                "instruction": sample["instruction"],
+                "input": sample["input"],
+                "expected_output": sample["expected_output"],
+                "predicted_output": prediction,
                 "perplexity": perplexity,
-            })
-        
+            }
+            if log is not None:
+                log.append(result)
+            else:
+                results[idx] = result
+            if engine is not None:
+                engine.add(idx, sample["expected_output"], prediction, perplexity)
+        
+        generated_tokens = 0
+        self.stop_sequence_stops = 0
+        self.tokens_saved = 0
+        start_time = time.perf_counter()
+        
+        if batch_token_budget and pending:
+            lengths = prompt_lengths(samples, self.tokenizer, pending)
+            batches = [
+                [pending[position] for position in bucket]
+                for bucket in make_length_buckets(lengths, batch_token_budget, max_new_tokens=256, max_batch_size=max_batch_size)
+            ]
+            print(f"Batched generation: {len(batches)} batches (token budget {batch_token_budget})")
+            
+            with tqdm(total=len(pending)) as progress:
+                for batch in batches:
+                    batch_samples = [samples[idx] for idx in batch]
+                    responses, token_counts = self.generate_samples(batch_samples)
+                    # perplexity ของทั้ง batch ใน forward pass เดียว
+                    scores = self.score_samples(batch_samples, response_only=response_only)
+                    for idx, response, perplexity in zip(batch, responses, scores):
+                        finish(idx, response, perplexity)
+                    generated_tokens += sum(token_counts)
+                    progress.update(len(batch))
+        else:
+            for idx in tqdm(pending):
+                responses, token_counts = self.generate_samples([samples[idx]])
+                perplexity = self.score_samples([samples[idx]], response_only=response_only)[0]
+                finish(idx, responses[0], perplexity)
+                generated_tokens += token_counts[0]
+        
+        elapsed = time.perf_counter() - start_time
+        self.last_throughput = {
+            "generation_mode": "batched" if batch_token_budget else "serial",
+            "generation_seconds": elapsed,
+            "samples_per_sec": len(pending) / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_sec": generated_tokens / elapsed if elapsed > 0 else 0.0,
+            "stop_sequence_stops": self.stop_sequence_stops,
+            "tokens_saved": self.tokens_saved,
+            **self.prefix_cache.stats(),
+        }
+        print(f"Generation throughput ({self.last_throughput['generation_mode']}): "
+              f"{self.last_throughput['samples_per_sec']:.2f} samples/sec, "
+              f"{self.last_throughput['tokens_per_sec']:.2f} tokens/sec, "
+              f"{self.tokens_saved} tokens saved by stop sequences")
+        
+        if engine is not None:
+            with engine:
+                self.last_metrics = engine.compute()
+                self.last_metrics.update(engine.confidence_intervals())
+        
+        if log is not None:
+            log.close()
+            return log.results()
         return results
     
-    def calculate_metrics(self, results):
+    def evaluate_adaptive(self, test_dataset, ci_targets=None, max_samples=None, max_seconds=None,
+                          max_generated_tokens=None, min_samples=30, check_every=16, num_strata=5, seed=42,
+                          batch_token_budget=None, max_batch_size=32, response_only=False, metrics_num_proc=None,
+                          result_log=None, resume=False):
         """
-        คำนวณ metrics ต่างๆ จากผลการประเมิน
+        ประเมินแบบ adaptive (ดู adaptive_eval.py): สุ่ม sample แบบ stratified ตามความยาวคำตอบอ้างอิง
+        ประเมินทีละ check_every sample แล้วหยุดเมื่อ CI ของทุก metric ใน ci_targets แคบพอหรือถึง budget
+        
+        Args:
+            ci_targets: {metric: ความกว้าง CI สูงสุด} (perplexity, rouge1, rouge2, rougeL)
+            max_samples, max_seconds, max_generated_tokens: budget (None = ไม่จำกัด)
+            min_samples: จำนวน sample ขั้นต่ำก่อนเริ่มตรวจ CI
+            check_every: จำนวน sample ที่ generate ระหว่างการตรวจแต่ละครั้ง
+            num_strata: จำนวนชั้นของความยาว
+            batch_token_budget, max_batch_size, response_only, metrics_num_proc, result_log, resume:
+                ดู evaluate_on_dataset (resume เดินตามลำดับ stratified เดิม และใช้ผลใน log ของการประเมินเต็มได้)
+        
+        Returns:
+            results ของ sample ที่ประเมิน (ตามลำดับ sample_id)
+            self.last_metrics มี metrics, bootstrap CI และ stratified mean/CI (adaptive_*)
         """
-        metrics = {}
-        
-        # Average Perplexity
-        perplexities = [r["perplexity"] for r in results]
-        metrics["avg_perplexity"] = np.mean(perplexities)
-        metrics["std_perplexity"] = np.std(perplexities)
-        metrics["min_perplexity"] = np.min(perplexities)
-        metrics["max_perplexity"] = np.max(perplexities)
-        
-        # Response Length Statistics
-        pred_lengths = [len(r["predicted_output"].split()) for r in results]
-        expected_lengths = [len(r["expected_output"].split()) for r in results]
-        
-        metrics["avg_pred_length"] = np.mean(pred_lengths)
-        metrics["avg_expected_length"] = np.mean(expected_lengths)
-        
-        # คำนวณ BLEU score (ถ้าต้องการ - ต้อง install sacrebleu)
-        try:
-            from sacrebleu import corpus_bleu
-            predictions = [r["predicted_output"] for r in results]
-            references = [[r["expected_output"]] for r in results]
-            bleu = corpus_bleu(predictions, references)
-            metrics["bleu_score"] = bleu.score
-        except ImportError:
-            print("Warning: sacrebleu not installed. Skipping BLEU score calculation.")
-            metrics["bleu_score"] = None
-        
-        # คำนวณ ROUGE score (ถ้าต้องการ - ต้อง install rouge-score)
-        try:
-            from rouge_score import rouge_scorer
-            scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
-            
-            rouge1_scores = []
-            rouge2_scores = []
-            rougeL_scores = []
-            
-            for result in results:
-                scores = scorer.score(result["expected_output"], result["predicted_output"])
-                rouge1_scores.append(scores['rouge1'].fmeasure)
-                rouge2_scores.append(scores['rouge2'].fmeasure)
-                rougeL_scores.append(scores['rougeL'].fmeasure)
+        ci_targets = dict(ci_targets or {})
+        unknown = set(ci_targets) - {"perplexity", *ROUGE_TYPES}
+        if unknown:
+            raise ValueError(f"ci_targets รองรับเฉพาะ perplexity, {', '.join(ROUGE_TYPES)} (ได้ {sorted(unknown)})")
+        
+        dataset = self.load_test_dataset(test_dataset)
+        samples = self.prepare_samples(dataset)
+        # ความยาวคำตอบอ้างอิง (token จาก artifact ถ้ามี ไม่เช่นนั้นนับคำ)
+        lengths = [
+            len(sample["input_ids"]) - sample["response_start"] if sample["input_ids"] is not None
+            else len(sample["expected_output"].split())
+            for sample in samples
+        ]
+        order, strata, sizes = stratified_order(lengths, num_strata=num_strata, seed=seed)
+        stopper = AdaptiveStopper(
+            strata,
+            sizes,
+            ci_targets,
+            min_samples=min_samples,
+            max_samples=max_samples,
+            max_seconds=max_seconds,
+            max_generated_tokens=max_generated_tokens,
+        )
+        print(f"\nAdaptive evaluation on up to {min(len(samples), max_samples or len(samples))} of {len(samples)} "
+              f"samples ({len(sizes)} strata, CI targets {ci_targets or 'none'})...")
+        
+        log = None
+        completed = set()
+        if result_log:
+            log = ResultLog(result_log, self.evaluation_fingerprint(dataset, response_only))
+            if resume:
+                completed = log.completed_ids()
+        
+        capacity = min(len(samples), max_samples or len(samples))
+        engine = MetricsEngine(capacity, num_proc=metrics_num_proc)
+        # sample_id ตามลำดับที่ประเมิน (ตำแหน่งใน engine)
+        evaluated = []
+        results = {}
+        
+        def finish(idx, prediction, perplexity):
+            sample = samples[idx]
+            result = {
+                "sample_id": idx,
+                "instruction": sample["instruction"],
+                "input": sample["input"],
+                "expected_output": sample["expected_output"],
+                "predicted_output": prediction,
+                "perplexity": perplexity,
+            }
+            if log is not None:
+                log.append(result)
+            else:
+                results[idx] = result
+            engine.add(len(evaluated), sample["expected_output"], prediction, perplexity)
+            evaluated.append(idx)
+        
+        def metric_values():
+            # รอ ROUGE ของทุก sample ที่ generate แล้ว (ใช้เวลาน้อยเทียบกับ generate)
+            engine.flush()
+            count = len(evaluated)
+            ids = np.asarray(evaluated, dtype=np.int64)
+            perplexity = engine.perplexity[:count]
+            scored = ~np.isnan(perplexity)
+            values = {"perplexity": (ids[scored], perplexity[scored])}
+            if engine.use_rouge:
+                scored = engine.completed[:count]
+                for name in ROUGE_TYPES:
+                    values[name] = (ids[scored], engine.rouge[name][:count][scored])
+            return values
+        
+        generated_tokens = 0
+        generated_samples = 0
+        self.stop_sequence_stops = 0
+        self.tokens_saved = 0
+        start_time = time.perf_counter()
+        position = 0
+        
+        with engine:
+            while True:
+                batch = []
+                while position < len(order) and len(batch) < check_every and len(evaluated) + len(batch) < capacity:
+                    idx = int(order[position])
+                    position += 1
+                    if idx in completed:
+                        logged = LoggedResults(log.path, {idx: log.offsets[idx]})[0]
+                        engine.add(len(evaluated), logged["expected_output"], logged["predicted_output"], logged["perplexity"])
+                        evaluated.append(idx)
+                    else:
+                        batch.append(idx)
+                
+                if batch and batch_token_budget:
+                    lengths = prompt_lengths(samples, self.tokenizer, batch)
+                    groups = [
+                        [batch[offset] for offset in bucket]
+                        for bucket in make_length_buckets(lengths, batch_token_budget, max_new_tokens=256, max_batch_size=max_batch_size)
+                    ]
+                else:
+                    groups = [[idx] for idx in batch]
+                for group in groups:
+                    group_samples = [samples[idx] for idx in group]
+                    responses, token_counts = self.generate_samples(group_samples)
+                    scores = self.score_samples(group_samples, response_only=response_only)
+                    for idx, response, perplexity in zip(group, responses, scores):
+                        finish(idx, response, perplexity)
+                    generated_tokens += sum(token_counts)
+                    generated_samples += len(group)
+                
+                stopper.update(metric_values())
+                print(stopper.progress(len(evaluated)))
+                if stopper.should_stop(len(evaluated), generated_tokens, remaining=position < len(order)):
+                    break
             
-            metrics["rouge1"] = np.mean(rouge1_scores)
-            metrics["rouge2"] = np.mean(rouge2_scores)
-            metrics["rougeL"] = np.mean(rougeL_scores)
-        except ImportError:
-            print("Warning: rouge-score not installed. Skipping ROUGE score calculation.")
-            metrics["rouge1"] = None
-            metrics["rouge2"] = None
-            metrics["rougeL"] = None
+            # ค่าประมาณสุดท้ายใช้ ROUGE ของทุก sample ที่ประเมิน
+            engine.truncate(len(evaluated))
+            stopper.update(metric_values())
+            self.last_metrics = engine.compute()
+            self.last_metrics.update(engine.confidence_intervals())
+            self.last_metrics.update(stopper.report(len(evaluated), len(samples)))
+        
+        elapsed = time.perf_counter() - start_time
+        self.last_throughput = {
+            "generation_mode": "adaptive",
+            "generation_seconds": elapsed,
+            "samples_per_sec": generated_samples / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_sec": generated_tokens / elapsed if elapsed > 0 else 0.0,
+            "generated_tokens": generated_tokens,
+            "stop_sequence_stops": self.stop_sequence_stops,
+            "tokens_saved": self.tokens_saved,
+            **self.prefix_cache.stats(),
+        }
+        print(f"Adaptive evaluation stopped by {stopper.reason} after {len(evaluated)} of {len(samples)} samples "
+              f"({generated_samples} generated, {elapsed:.1f}s)")
+        
+        if log is not None:
+            log.close()
+            return LoggedResults(log.path, {idx: log.offsets[idx] for idx in evaluated})
+        return [results[idx] for idx in sorted(evaluated)]
+    
+    def calculate_metrics(self, results, num_proc=None):
+        """
+        คำนวณ metrics ต่างๆ จากผลการประเมิน
         
-        return metrics
+        ROUGE/BLEU ต่อ sample คำนวณใน process pool ของ MetricsEngine (num_proc=None = ไม่เกิน eval_metrics.DEFAULT_NUM_PROC)
+        """
+        with MetricsEngine(len(results), num_proc=num_proc) as engine:
+            for idx, result in enumerate(results):
+                engine.add(idx, result["expected_output"], result["predicted_output"], result["perplexity"])
+            return engine.compute()
+    
+    def calculate_perplexity_metrics(self, results):
+        """
+        คำนวณสถิติ perplexity (ใช้ได้กับผลจาก score_dataset ที่ไม่มี predicted_output)
+        """
+        return perplexity_metrics(results)
     
     def manual_evaluation_samples(self, results, num_samples=5):
         """
@@ -226,126 +755,149 @@ class ModelEvaluator:
     
     def save_results(self, results, metrics, filename_prefix="evaluation"):
         """
-        บันทึกผลการประเมิน
-        """
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # บันทึกผล results ทั้งหมด
-        results_df = pd.DataFrame(results)
-        results_file = os.path.join(self.output_dir, f"{filename_prefix}_results_{timestamp}.csv")
-        results_df.to_csv(results_file, index=False, encoding='utf-8-sig')
-        print(f"\nResults saved to: {results_file}")
-        
-        # บันทึก metrics
-        metrics_file = os.path.join(self.output_dir, f"{filename_prefix}_metrics_{timestamp}.json")
-        with open(metrics_file, 'w', encoding='utf-8') as f:
-            json.dump(metrics, f, indent=2, ensure_ascii=False)
-        print(f"Metrics saved to: {metrics_file}")
-        
-        # สร้างรายงานสรุป
-        report_file = os.path.join(self.output_dir, f"{filename_prefix}_report_{timestamp}.txt")
-        with open(report_file, 'w', encoding='utf-8') as f:
-            f.write("="*80 + "\n")
-            f.write("MODEL EVALUATION REPORT\n")
-            f.write("="*80 + "\n\n")
-            f.write(f"Evaluation Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Number of Samples: {len(results)}\n\n")
-            
-            f.write("METRICS:\n")
-            f.write("-"*80 + "\n")
-            for key, value in metrics.items():
-                if value is not None:
-                    if isinstance(value, float):
-                        f.write(f"{key}: {value:.4f}\n")
-                    else:
-                        f.write(f"{key}: {value}\n")
-            
-            f.write("\n" + "="*80 + "\n")
-            f.write("SAMPLE PREDICTIONS\n")
-            f.write("="*80 + "\n\n")
-            
-            # เพิ่มตัวอย่าง 5 samples
-            for i, result in enumerate(results[:5]):
-                f.write(f"\n--- Sample {i+1} ---\n")
-                f.write(f"Instruction: {result['instruction']}\n")
-                f.write(f"Input: {result['input']}\n")
-                f.write(f"Expected: {result['expected_output']}\n")
-                f.write(f"Predicted: {result['predicted_output']}\n")
-                f.write(f"Perplexity: {result['perplexity']:.2f}\n")
-                f.write("-"*80 + "\n")
-        
-        print(f"Report saved to: {report_file}")
-        
-        return results_file, metrics_file, report_file
+        บันทึกผลการประเมินลง output_dir (ดู eval_report.save_results)
+        """
+        return save_results(self.output_dir, results, metrics, filename_prefix)
     
     def print_metrics_summary(self, metrics):
         """
         แสดงสรุป metrics
         """
-        print("\n" + "="*80)
-        print("EVALUATION METRICS SUMMARY")
-        print("="*80)
-        
-        print(f"\nPerplexity:")
-        print(f"  Average: {metrics['avg_perplexity']:.4f}")
-        print(f"  Std Dev: {metrics['std_perplexity']:.4f}")
-        print(f"  Min: {metrics['min_perplexity']:.4f}")
-        print(f"  Max: {metrics['max_perplexity']:.4f}")
-        
-        print(f"\nResponse Length:")
-        print(f"  Avg Predicted: {metrics['avg_pred_length']:.2f} words")
-        print(f"  Avg Expected: {metrics['avg_expected_length']:.2f} words")
-        
-        if metrics.get('bleu_score'):
-            print(f"\nBLEU Score: {metrics['bleu_score']:.4f}")
-        
-        if metrics.get('rouge1'):
-            print(f"\nROUGE Scores:")
-            print(f"  ROUGE-1: {metrics['rouge1']:.4f}")
-            print(f"  ROUGE-2: {metrics['rouge2']:.4f}")
-            print(f"  ROUGE-L: {metrics['rougeL']:.4f}")
-        
-        print("="*80 + "\n")
+        print_metrics_summary(metrics)
 
 
-def main():
+def main(base_model="meta-llama/Llama-2-7b-hf", adapter_path="./results/final_model",
+         test_dataset_path="data/processed_dataset", num_samples=100, batch_token_budget=16384,
+         perplexity_only=False, response_only_perplexity=False,
+         result_log="./evaluation_results/model_evaluation_log.jsonl", resume=True, device="auto", precision=None,
+         output_dir="./evaluation_results", num_workers=1, scaling=None, adaptive=False, ci_targets=None,
+         max_seconds=None, max_generated_tokens=None, min_samples=30):
     """
     Main function สำหรับรัน evaluation
+    
+    Args:
+        base_model: โมเดลฐานที่ใช้เทรน
+        adapter_path: path ของโมเดลที่เทรนแล้ว (หรือ ./results/merged_model ที่ merge แล้ว)
+        test_dataset_path: path ของ test dataset
+        num_samples: จำนวน samples ที่จะประเมิน (None = ทั้งหมด)
+        batch_token_budget: token ต่อ batch สำหรับ batched generation (None = ทีละ sample)
+        perplexity_only: True = คำนวณเฉพาะ perplexity ไม่ generate
+        response_only_perplexity: True = คิด perplexity เฉพาะ token ของ response
+        result_log: บันทึกผลทีละ sample (None = เก็บใน memory)
+        resume: ข้าม sample ที่มีผลใน result_log แล้ว (config เดียวกัน)
+        device: auto, cuda หรือ cpu
+        precision: None = int8 (bitsandbytes บน CUDA, dynamic quantization บน CPU), หรือ fp16/bf16/fp32
+        output_dir: directory สำหรับบันทึกผลการประเมิน
+        num_workers: มากกว่า 1 = ประเมินแบบ data parallel ด้วย worker process (ดู sharded_eval)
+        scaling: list ของจำนวน worker สำหรับวัด scaling efficiency แทนการประเมินปกติ
+        adaptive: สุ่ม sample แบบ stratified และหยุดเมื่อ CI แคบพอ (num_samples เป็น budget สูงสุด)
+        ci_targets: {metric: ความกว้าง CI สูงสุด} ของโหมด adaptive (None = DEFAULT_CI_TARGETS)
+        max_seconds, max_generated_tokens: budget ของโหมด adaptive
+        min_samples: จำนวน sample ขั้นต่ำก่อนหยุดด้วย CI
     """
-    # Configuration
-    BASE_MODEL = "meta-llama/Llama-2-7b-hf"  # เปลี่ยนตามโมเดลที่ใช้
-    ADAPTER_PATH = "./results/final_model"    # path ของโมเดลที่เทรนแล้ว
-    TEST_DATASET_PATH = "data/processed_dataset"  # path ของ test dataset
-    NUM_SAMPLES = 100  # จำนวน samples ที่จะประเมิน (None = ทั้งหมด)
+    if adaptive and (perplexity_only or scaling or num_workers > 1):
+        raise ValueError("โหมด adaptive ใช้กับ perplexity_only, scaling หรือ num_workers > 1 ไม่ได้")
+    
+    if scaling or (num_workers > 1 and not perplexity_only):
+        from sharded_eval import evaluate_sharded, scaling_study
+        
+        sharded_kwargs = {
+            "base_model": base_model,
+            "adapter_path": adapter_path,
+            "test_dataset_path": test_dataset_path,
+            "num_samples": num_samples,
+            "batch_token_budget": batch_token_budget,
+            "response_only": response_only_perplexity,
+            "device": device,
+            "precision": precision,
+            "output_dir": output_dir,
+        }
+        if scaling:
+            scaling_study(scaling, **sharded_kwargs)
+            return
+        
+        results, metrics = evaluate_sharded(num_workers=num_workers, result_log=result_log, resume=resume,
+                                            **sharded_kwargs)
+        print_metrics_summary(metrics)
+        print("\nSaving results...")
+        save_results(output_dir, results, metrics, filename_prefix="model_evaluation")
+        print("\nEvaluation completed!")
+        return
     
     # สร้าง evaluator
     evaluator = ModelEvaluator(
-        base_model_name=BASE_MODEL,
-        adapter_path=ADAPTER_PATH,
-        output_dir="./evaluation_results"
-    )
-    
-    # ประเมินโมเดล
-    print("\nStarting evaluation...")
-    results = evaluator.evaluate_on_dataset(
-        test_dataset=TEST_DATASET_PATH,
-        num_samples=NUM_SAMPLES
+        base_model_name=base_model,
+        adapter_path=adapter_path,
+        output_dir=output_dir,
+        instrumentation=Instrumentation(),
+        device=device,
+        precision=precision,
     )
     
-    # คำนวณ metrics
-    print("\nCalculating metrics...")
-    metrics = evaluator.calculate_metrics(results)
+    # token artifact เดียวกับที่ใช้เทรน (tokenize ใหม่เฉพาะเมื่อ tokenizer/template/max_length เปลี่ยน)
+    test_dataset = load_or_build_token_artifact(test_dataset_path, evaluator.tokenizer, max_length=512)["test"]
     
-    # แสดงสรุป metrics
-    evaluator.print_metrics_summary(metrics)
-    
-    # แสดงตัวอย่าง predictions
-    evaluator.manual_evaluation_samples(results, num_samples=5)
+    if perplexity_only:
+        print("\nStarting perplexity scoring...")
+        results = evaluator.score_dataset(
+            test_dataset=test_dataset,
+            num_samples=num_samples,
+            batch_token_budget=batch_token_budget or 16384,
+            response_only=response_only_perplexity,
+        )
+        metrics = evaluator.calculate_perplexity_metrics(results)
+        metrics.update(evaluator.last_throughput)
+        evaluator.print_metrics_summary(metrics)
+    elif adaptive:
+        print("\nStarting adaptive evaluation...")
+        results = evaluator.evaluate_adaptive(
+            test_dataset=test_dataset,
+            ci_targets=DEFAULT_CI_TARGETS if ci_targets is None else ci_targets,
+            max_samples=num_samples,
+            max_seconds=max_seconds,
+            max_generated_tokens=max_generated_tokens,
+            min_samples=min_samples,
+            batch_token_budget=batch_token_budget,
+            response_only=response_only_perplexity,
+            result_log=result_log,
+            resume=resume,
+        )
+        metrics = dict(evaluator.last_metrics)
+        metrics.update(evaluator.last_throughput)
+        evaluator.print_metrics_summary(metrics)
+        evaluator.manual_evaluation_samples(results, num_samples=5)
+    else:
+        # ประเมินโมเดล
+        print("\nStarting evaluation...")
+        results = evaluator.evaluate_on_dataset(
+            test_dataset=test_dataset,
+            num_samples=num_samples,
+            batch_token_budget=batch_token_budget,
+            response_only=response_only_perplexity,
+            streaming_metrics=True,
+            result_log=result_log,
+            resume=resume,
+        )
+        
+        # metrics คำนวณระหว่าง generate แล้ว (เท่ากับ evaluator.calculate_metrics(results) + confidence interval)
+        metrics = dict(evaluator.last_metrics)
+        metrics.update(evaluator.last_throughput)
+        
+        # แสดงสรุป metrics
+        evaluator.print_metrics_summary(metrics)
+        
+        # แสดงตัวอย่าง predictions
+        evaluator.manual_evaluation_samples(results, num_samples=5)
     
     # บันทึกผลลัพธ์
     print("\nSaving results...")
     evaluator.save_results(results, metrics, filename_prefix="model_evaluation")
     
+    # เวลาแต่ละ phase ของ generate (tokenize/prefill/decode/detokenize/postprocess)
+    phase_file = os.path.join(evaluator.output_dir, "model_evaluation_phases.json")
+    evaluator.instrumentation.dump_json(phase_file)
+    print(f"Phase timings saved to: {phase_file}")
+    
     print("\nEvaluation completed!")
 
 
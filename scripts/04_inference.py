@@ -1,57 +1,414 @@
 """
 ไฟล์สำหรับทดสอบโมเดลที่เทรนแล้ว
 """
+import contextlib
+import threading
+import time
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+from transformers import AutoTokenizer, StoppingCriteriaList
+from adapters import AdapterRegistry
+from device import is_merged_model, load_model, resolve_model_paths
+from streaming import TokenStreamer
+from instrumentation import TOKEN_BUCKETS, Instrumentation
+from kv_cache import kv_bytes_per_token
+from prompt_template import build_prompt
+from prefix_cache import PrefixCache
+from response_cache import ResponseCache, adapter_identity, make_cache_key, model_identity
+from speculative import PROMPT_LOOKUP, RATIO_BUCKETS, TOKENS_PER_PASS_BUCKETS, SpeculationTracker, SpeculativeDecoder
+from sessions import SUMMARY_INSTRUCTION, WINDOW, SessionStore
+from stopping import STOP_SEQUENCES, StopSequenceCriteria, StopSequenceFilter, resolve_stop_sequences, truncate_at_stop
 
 class ChatBot:
-    def __init__(self, base_model_name, adapter_path):
-        self.tokenizer = AutoTokenizer.from_pretrained(adapter_path)
+    def __init__(self, base_model_name, adapter_path, load_in_8bit=True, response_cache=None, instrumentation=None,
+                 device="auto", precision=None, num_threads=None, compile_model=False, speculative=None,
+                 num_draft_tokens=10, adapters=None, adapter_memory_mb=256, stop_sequences=STOP_SEQUENCES,
+                 session_max_prompt_tokens=1536, session_memory_mb=512, session_idle_seconds=1800,
+                 history_strategy=WINDOW):
+        """
+        Args:
+            adapter_path: path ของ LoRA adapter หรือโมเดลที่ merge แล้วจาก 05_export_merged_model.py
+                (None = base_model_name เป็นโมเดลที่ merge แล้ว)
+            load_in_8bit: ใช้ precision int8 (bitsandbytes บน CUDA, dynamic quantization บน CPU)
+                ไม่มีผลถ้าระบุ precision
+            response_cache: ResponseCache สำหรับคำถามซ้ำ (None = ไม่ใช้ cache)
+            instrumentation: Instrumentation สำหรับจับเวลาแต่ละ phase (None = ปิด)
+            device, precision, num_threads, compile_model: ดู device.load_model
+            speculative: speculative decoding สำหรับ generate_response/stream_response
+                None = ปิด, "prompt_lookup" = draft จาก n-gram ใน prompt
+                หรือ path ของ draft model ขนาดเล็กที่ใช้ tokenizer เดียวกัน
+            num_draft_tokens: จำนวน token ที่ draft เสนอต่อรอบ
+            adapters: dict ชื่อ -> path ของ LoRA adapter เพิ่มเติม (output_dir ของ LLMFineTuner) บนโมเดลฐานเดียวกัน
+                แต่ละ request เลือกด้วย adapter=ชื่อ (None = adapter_path) ต้องไม่ใช่โมเดลที่ merge แล้ว
+            adapter_memory_mb: หน่วยความจำรวมของ adapter ที่โหลดพร้อมกัน (เกินแล้ว unload ตัวที่ไม่ได้ใช้นานที่สุด)
+            stop_sequences: หยุด generate เมื่อเจอ text เหล่านี้ (default คือ marker "### " ของ template)
+            session_max_prompt_tokens, session_memory_mb, session_idle_seconds: ดู sessions.SessionStore
+            history_strategy: "window" (ตัด turn เก่าทิ้ง) หรือ "summarize" (ให้โมเดลสรุป turn เก่า)
+                เมื่อ history ของ session ยาวเกิน session_max_prompt_tokens
+        """
+        model_path, adapter_path = resolve_model_paths(base_model_name, adapter_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(adapter_path or model_path)
         
-        base_model = AutoModelForCausalLM.from_pretrained(
-            base_model_name,
-            load_in_8bit=True,
-            device_map="auto",
+        if precision is None:
+            precision = "int8" if load_in_8bit else "auto"
+        self.model, self.device_info = load_model(
+            model_path,
+            adapter_path,
+            device=device,
+            precision=precision,
+            num_threads=num_threads,
+            compile_model=compile_model,
         )
         
-        self.model = PeftModel.from_pretrained(base_model, adapter_path)
-        self.model.eval()
+        # KV cache ของ preamble ที่ทุก prompt ใช้ร่วมกัน
+        self.prefix_cache = PrefixCache(self.model, self.tokenizer)
         
-    def generate_response(self, instruction, input_text, max_tokens=256):
-        """Generate response"""
-        prompt = f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
-
-### Instruction:
-{instruction}
-
-### Input:
-{input_text}
-
-### Response:
-"""
+        self.response_cache = response_cache
+        self.model_id = model_identity(model_path, self.device_info["precision"])
+        self.adapter_id = adapter_identity(adapter_path or model_path)
         
-        inputs = self.tokenizer(prompt, return_tensors="pt").to("cuda")
+        self.instrumentation = instrumentation or Instrumentation(enabled=False)
+        self.kv_bytes_per_token = kv_bytes_per_token(self.model)
         
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=max_tokens,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True,
+        self.speculative = None
+        if speculative == PROMPT_LOOKUP:
+            self.speculative = SpeculativeDecoder(PROMPT_LOOKUP, num_draft_tokens)
+        elif speculative is not None:
+            draft_model, _ = load_model(
+                speculative,
+                None,
+                device=self.device_info["device"],
+                precision=self.device_info["precision"],
             )
+            self.speculative = SpeculativeDecoder(draft_model, num_draft_tokens)
+        # ผลของ speculative decoding ของ request ล่าสุด (acceptance rate, speedup)
+        self.last_speculation = None
+        
+        self.stop_sequences = tuple(stop_sequences)
+        # finish_reason, generated_tokens และ tokens_saved ของ request ล่าสุด
+        self.last_stop = None
+        
+        # บทสนทนาหลาย turn (generate_response/stream_response ที่ส่ง session_id)
+        self.sessions = SessionStore(
+            self.tokenizer,
+            max_prompt_tokens=session_max_prompt_tokens,
+            max_memory_mb=session_memory_mb,
+            idle_seconds=session_idle_seconds,
+            strategy=history_strategy,
+            summarize=self.summarize_history,
+        )
+        
+        self.adapters = None
+        if adapters:
+            self.adapters = AdapterRegistry(self.model, adapter_memory_mb, prefix_cache=self.prefix_cache)
+            for name, path in adapters.items():
+                self.adapters.register(name, path)
+        
+    def build_prompt(self, instruction, input_text):
+        """สร้าง prompt ตาม Alpaca template"""
+        return build_prompt(instruction, input_text)
+    
+    def cache_key(self, instruction, input_text, max_tokens, temperature, top_p, do_sample, cache_sampled,
+                  adapter=None, stop_sequences=None, history=None):
+        """
+        key ของ response cache หรือ None ถ้าไม่ควร cache
+        (sampling ให้คำตอบต่างกันทุกครั้ง จึง cache เฉพาะเมื่อผู้เรียกยินยอมด้วย cache_sampled)
+        history: turn ก่อนหน้าที่อยู่ใน prompt [(instruction, input, response)] (คำถามเดียวกันต่าง history เป็นคนละ key)
+        """
+        if self.response_cache is None or (do_sample and not cache_sampled):
+            return None
+        params = {"max_tokens": max_tokens, "do_sample": do_sample}
+        if history:
+            params["history"] = [list(turn) for turn in history]
+        if do_sample:
+            params.update({"temperature": temperature, "top_p": top_p})
+        if stop_sequences is not None and tuple(stop_sequences) != self.stop_sequences:
+            params["stop"] = list(stop_sequences)
+        adapter_id = self.adapter_id
+        if adapter is not None and self.adapters is not None:
+            adapter_id = self.adapters.identity(adapter) or adapter_id
+        return make_cache_key(instruction, input_text, adapter_id, params, self.model_id)
+    
+    def summarize_history(self, text, adapter=None, max_tokens=128):
+        """สรุป turn เก่าของ session ที่ยาวเกิน budget (history_strategy="summarize")"""
+        return self.generate_response(SUMMARY_INSTRUCTION, text, max_tokens=max_tokens, do_sample=False,
+                                      use_speculative=False, adapter=adapter)
+    
+    def prepare_inputs(self, prompt, adapter_name, session=None, adapter=None, speculate=False):
+        """
+        inputs ของ model.generate: KV ของ preamble จาก prefix cache หรือ KV ของ turn ก่อนหน้าใน session
+
+        speculate=True (assisted generation) ไม่แนบ KV ที่คำนวณไว้: assisted generation ที่เริ่มจาก past_key_values
+        ให้ token ต่างจาก greedy ปกติ จึง prefill ทั้ง prompt
+        """
+        if session is None:
+            if speculate:
+                return self.tokenizer([prompt], return_tensors="pt").to(self.model.device)
+            return self.prefix_cache.prepare_inputs([prompt], adapter=adapter_name)
+        return self.sessions.prepare_inputs(session, prompt, self.prefix_cache, self.session_adapter_key(adapter),
+                                            adapter_name, reuse_cache=not speculate)
+    
+    def session_adapter_key(self, adapter):
+        """adapter ที่ใช้คำนวณ KV ของ session (KV ของ adapter อื่นหรือ weights เก่าใช้ซ้ำไม่ได้)"""
+        if adapter is None or self.adapters is None:
+            return None
+        return adapter, self.adapters.identity(adapter)
+    
+    @contextlib.contextmanager
+    def use_adapter(self, adapter):
+        """โหลด adapter (ถ้ายังไม่โหลด) และกันไม่ให้ถูก unload ระหว่าง generate คืนชื่อสำหรับ adapter_names"""
+        if self.adapters is None:
+            if adapter is not None:
+                raise ValueError("ChatBot นี้ไม่ได้เปิด multi-adapter (ส่ง adapters ตอนสร้าง)")
+            yield None
+            return
+        name = self.adapters.acquire(adapter)
+        try:
+            yield name
+        finally:
+            self.adapters.release(name)
+    
+    def generate_response(self, instruction, input_text, max_tokens=256, temperature=0.7, top_p=0.9,
+                          do_sample=True, cache_sampled=False, use_speculative=True, adapter=None, stop=None,
+                          session_id=None):
+        """
+        Generate response
+        
+        use_speculative=False ปิด speculative decoding เฉพาะ request นี้ (ใช้เป็น baseline ของ speedup)
+        adapter: ชื่อ adapter ที่ลงทะเบียนไว้ (None = adapter_path)
+        stop: stop sequence เพิ่มเติมของ request นี้ (str หรือ list) ผลอยู่ใน self.last_stop
+        session_id: ต่อบทสนทนาของ session นี้ (history + KV cache ของ turn ก่อนหน้า ไม่ใช้ response cache)
+            turn ที่ใช้ speculative decoding ไม่ใช้และไม่เก็บ KV ของ session
+        """
+        stop_sequences = resolve_stop_sequences(stop, self.stop_sequences)
+        speculate = self.speculative is not None and use_speculative
+        session = self.sessions.get(session_id) if session_id is not None else None
+        key = None
+        if session is None:
+            key = self.cache_key(instruction, input_text, max_tokens, temperature, top_p, do_sample, cache_sampled,
+                                 adapter, stop_sequences)
+        if key is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
         
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        response = response.split("### Response:")[-1].strip()
+        if session is not None:
+            prompt = self.sessions.build_prompt(session, instruction, input_text, adapter)
+        else:
+            prompt = self.build_prompt(instruction, input_text)
+        
+        with self.use_adapter(adapter) as adapter_name:
+            with self.instrumentation.phase("tokenize"):
+                inputs = self.prepare_inputs(prompt, adapter_name, session, adapter, speculate)
+            generate_kwargs = self.generate_kwargs(do_sample, temperature, top_p, inputs, use_speculative, adapter_name,
+                                                   stop_sequences)
+            
+            with self.instrumentation.phase("generate"), torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_tokens,
+                    do_sample=do_sample,
+                    return_dict_in_generate=session is not None,
+                    **generate_kwargs,
+                )
+        sequences = outputs.sequences if session is not None else outputs
+        prompt_length = inputs["input_ids"].shape[1]
+        self.finish_generation(generate_kwargs, inputs, sequences.shape[1] - prompt_length, max_tokens)
+        
+        # decode เฉพาะ token ใหม่ ("### Response:" ที่โมเดล generate เองจึงไม่ทำให้ตัดผิดที่)
+        with self.instrumentation.phase("detokenize"):
+            response = self.tokenizer.decode(sequences[0, prompt_length:], skip_special_tokens=True)
+        with self.instrumentation.phase("postprocess"):
+            response = truncate_at_stop(response, stop_sequences).strip()
+        
+        if session is not None:
+            self.sessions.update(session, instruction, input_text, response, sequences[0].tolist(),
+                                 None if speculate else outputs.past_key_values, self.session_adapter_key(adapter))
+        if key is not None:
+            self.response_cache.put(key, response)
         return response
+    
+    def generate_kwargs(self, do_sample, temperature, top_p, inputs=None, use_speculative=True, adapter_name=None,
+                        stop_sequences=None):
+        """
+        sampling parameters, step timer ของ instrumentation, speculative decoding, adapter และ stop sequence
+        สำหรับ model.generate (ติดตามผลของ speculative decoding และหยุดที่ stop sequence เมื่อส่ง inputs มา)
+        """
+        kwargs = {"temperature": temperature, "top_p": top_p} if do_sample else {}
+        if adapter_name is not None:
+            kwargs["adapter_names"] = [adapter_name]
+        self.last_speculation = None
+        self.last_stop = None
+        criteria = []
+        step_timer = self.instrumentation.step_timer()
+        if step_timer is not None:
+            criteria.append(step_timer)
+        if self.speculative is not None and inputs is not None:
+            criteria.append(self.speculative.tracker(self.model, inputs["input_ids"].shape[1], use_speculative))
+            if use_speculative:
+                kwargs.update(self.speculative.generate_kwargs())
+        if inputs is not None and stop_sequences:
+            criteria.append(StopSequenceCriteria(self.tokenizer, inputs["input_ids"].shape[1], stop_sequences))
+        if criteria:
+            kwargs["stopping_criteria"] = StoppingCriteriaList(criteria)
+        return kwargs
+    
+    def finish_generation(self, generate_kwargs, inputs, generated_tokens, max_tokens):
+        """บันทึกเวลา decode, จำนวน token, ขนาด KV cache, ผลของ speculative decoding และ token ที่ stop sequence ประหยัดได้"""
+        timers = []
+        for criteria in generate_kwargs.get("stopping_criteria", []):
+            if isinstance(criteria, SpeculationTracker):
+                self.last_speculation = self.speculative.finish(criteria)
+                if "method" in self.last_speculation:
+                    self.instrumentation.observe(
+                        "speculative_acceptance_rate", self.last_speculation["acceptance_rate"], RATIO_BUCKETS
+                    )
+                    self.instrumentation.observe(
+                        "speculative_tokens_per_pass", self.last_speculation["tokens_per_pass"], TOKENS_PER_PASS_BUCKETS
+                    )
+            elif isinstance(criteria, StopSequenceCriteria):
+                self.last_stop = next(iter(criteria.finish(max_tokens)), None)
+                if self.last_stop is not None and self.last_stop["tokens_saved"]:
+                    self.instrumentation.observe("stop_tokens_saved", self.last_stop["tokens_saved"], TOKEN_BUCKETS)
+            else:
+                timers.append(criteria)
+        if not self.instrumentation.enabled:
+            return
+        for criteria in timers:
+            criteria.finish()
+        prompt_tokens = int(inputs["attention_mask"].sum())
+        self.instrumentation.record_request(
+            prompt_tokens,
+            generated_tokens,
+            (prompt_tokens + generated_tokens) * self.kv_bytes_per_token,
+        )
+    
+    def profile_response(self, instruction, input_text, trace_path, **kwargs):
+        """
+        Generate response หนึ่งครั้งภายใต้ torch.profiler แล้วบันทึก Chrome trace ลง trace_path
+        (ไม่ใช้ response cache เพื่อให้ trace มีการ generate จริง)
+        """
+        response_cache, self.response_cache = self.response_cache, None
+        try:
+            with self.instrumentation.profile(trace_path):
+                return self.generate_response(instruction, input_text, **kwargs)
+        finally:
+            self.response_cache = response_cache
+    
+    def stream_response(self, instruction, input_text, max_tokens=256, temperature=0.7, top_p=0.9,
+                        do_sample=True, cache_sampled=False, use_speculative=True, adapter=None, stop=None,
+                        session_id=None):
+        """
+        Generate response แบบ streaming
+        
+        Yields:
+            dict ของแต่ละ chunk: text, num_tokens, time_to_first_token, token_latency
+            (ถ้าเจอใน response cache จะได้ chunk เดียวที่มี cached=True)
+            ผลของ speculative decoding อยู่ใน self.last_speculation และผลของ stop sequence อยู่ใน self.last_stop
+            หลัง stream จบ (text ตั้งแต่ stop sequence ไม่ถูกส่งออก)
+            session_id: ดู generate_response (turn ถูกบันทึกเมื่ออ่าน stream จนจบ)
+        """
+        start_time = time.perf_counter()
+        stop_sequences = resolve_stop_sequences(stop, self.stop_sequences)
+        speculate = self.speculative is not None and use_speculative
+        session = self.sessions.get(session_id) if session_id is not None else None
+        key = None
+        if session is None:
+            key = self.cache_key(instruction, input_text, max_tokens, temperature, top_p, do_sample, cache_sampled,
+                                 adapter, stop_sequences)
+        if key is not None:
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                elapsed = time.perf_counter() - start_time
+                yield {
+                    "text": cached,
+                    "num_tokens": 0,
+                    "time_to_first_token": elapsed,
+                    "token_latency": 0.0,
+                    "cached": True,
+                }
+                return
+        
+        if session is not None:
+            prompt = self.sessions.build_prompt(session, instruction, input_text, adapter)
+        else:
+            prompt = self.build_prompt(instruction, input_text)
+        # adapter ถูกปล่อยเมื่อ thread ที่ generate จบ (แม้ผู้อ่าน stream จะหยุดอ่านก่อน)
+        adapter_scope = contextlib.ExitStack()
+        adapter_name = adapter_scope.enter_context(self.use_adapter(adapter))
+        try:
+            with self.instrumentation.phase("tokenize"):
+                inputs = self.prepare_inputs(prompt, adapter_name, session, adapter, speculate)
+        except BaseException:
+            adapter_scope.close()
+            raise
+        generate_kwargs = self.generate_kwargs(do_sample, temperature, top_p, inputs, use_speculative, adapter_name,
+                                               stop_sequences)
+        streamer = TokenStreamer(self.tokenizer, instrumentation=self.instrumentation,
+                                 stop_filter=StopSequenceFilter(stop_sequences))
+        result = {}
+        
+        def run_generate():
+            try:
+                with self.instrumentation.phase("generate"), torch.no_grad():
+                    result["outputs"] = self.model.generate(
+                        **inputs,
+                        max_new_tokens=max_tokens,
+                        do_sample=do_sample,
+                        streamer=streamer,
+                        return_dict_in_generate=session is not None,
+                        **generate_kwargs,
+                    )
+                self.finish_generation(generate_kwargs, inputs, streamer.num_tokens, max_tokens)
+            except Exception as e:
+                streamer.error(e)
+            finally:
+                adapter_scope.close()
+        
+        thread = threading.Thread(target=run_generate, daemon=True)
+        thread.start()
+        
+        # ตัดช่องว่างหน้า response เหมือน .strip() ใน generate_response
+        started = False
+        response = ""
+        for chunk in streamer:
+            if not started:
+                chunk["text"] = chunk["text"].lstrip()
+                if not chunk["text"]:
+                    continue
+                started = True
+            response += chunk["text"]
+            yield chunk
+        
+        thread.join()
+        
+        if session is not None and "outputs" in result:
+            outputs = result["outputs"]
+            self.sessions.update(session, instruction, input_text, response.strip(), outputs.sequences[0].tolist(),
+                                 None if speculate else outputs.past_key_values, self.session_adapter_key(adapter))
+        if key is not None:
+            self.response_cache.put(key, response.strip())
 
-def main():
-    # โหลดโมเดล
+def main(base_model_name="meta-llama/Llama-2-7b-hf", adapter_path=None, device="auto", precision=None,
+         speculative=None, num_draft_tokens=10, multi_turn=False, history_strategy=WINDOW, response_cache=True,
+         response_cache_path=None, greedy=False):
+    # โหลดโมเดล (adapter_path=None ใช้โมเดลที่ merge แล้วจาก 05_export_merged_model.py ถ้ามี
+    # เริ่มเร็วกว่าและไม่มี matmul ของ LoRA)
+    if adapter_path is None:
+        merged_model_path = "./results/merged_model"
+        adapter_path = merged_model_path if is_merged_model(merged_model_path) else "./results/final_model"
     chatbot = ChatBot(
-        base_model_name="meta-llama/Llama-2-7b-hf",
-        adapter_path="./results/final_model"
+        base_model_name=base_model_name,
+        adapter_path=adapter_path,
+        device=device,
+        precision=precision,
+        speculative=speculative,
+        num_draft_tokens=num_draft_tokens,
+        history_strategy=history_strategy,
+        # cache ใช้กับคำถามเดี่ยวเท่านั้น (turn ใน session ไม่ใช้ cache) และ greedy เท่านั้น (sampling ไม่ cache)
+        response_cache=ResponseCache(disk_path=response_cache_path) if response_cache else None,
     )
+    # multi_turn: ทุก turn อยู่ใน session เดียวกัน พิมพ์ 'reset' เพื่อเริ่มบทสนทนาใหม่
+    session_id = "terminal" if multi_turn else None
     
     # ทดสอบ
     while True:
@@ -59,11 +416,36 @@ def main():
         instruction = input("Instruction: ")
         if instruction.lower() == 'quit':
             break
+        if multi_turn and instruction.lower() == 'reset':
+            chatbot.sessions.reset(session_id)
+            continue
             
         user_input = input("Input: ")
         
-        response = chatbot.generate_response(instruction, user_input)
-        print(f"\nResponse: {response}")
+        print("\nResponse: ", end="", flush=True)
+        chunk = None
+        for chunk in chatbot.stream_response(instruction, user_input, do_sample=not greedy, session_id=session_id):
+            print(chunk["text"], end="", flush=True)
+        print()
+        
+        if chunk is not None and chunk.get("cached"):
+            print("[response cache hit]")
+        elif chunk is not None:
+            print(f"[TTFT: {chunk['time_to_first_token'] * 1000:.0f} ms, tokens: {chunk['num_tokens']}]")
+        if chatbot.last_stop is not None and chatbot.last_stop["tokens_saved"]:
+            print(f"[stopped at stop sequence, saved {chatbot.last_stop['tokens_saved']} tokens]")
+        if multi_turn:
+            session = chatbot.sessions.get(session_id)
+            if session.last_prefill is not None:
+                print(f"[session: {len(session.turns)} turns, prompt {session.last_prefill['prompt_tokens']} tokens, "
+                      f"reused {session.last_prefill['reused_tokens']} from KV cache]")
+        speculation = chatbot.last_speculation
+        if speculation is not None and "method" in speculation:
+            speedup = f"{speculation['speedup']:.2f}x" if speculation["speedup"] else "n/a"
+            if speculation["speedup"] and not speculation["speedup_measured"]:
+                speedup += " (est.)"
+            print(f"[speculative: acceptance {speculation['acceptance_rate']:.0%}, "
+                  f"{speculation['tokens_per_pass']:.2f} tokens/pass, speedup {speedup}]")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""
+ไฟล์สำหรับ merge LoRA adapter เข้า weights ของโมเดลฐาน แล้ว export เป็น safetensors ไฟล์เดียวพร้อม tokenizer
+
+โมเดลที่ merge แล้วโหลดได้โดยไม่ต้องผ่าน PeftModel (ไม่มี matmul ของ LoRA ทุก forward)
+และ safetensors ถูก memory-map ตอนโหลด หลาย worker process บนเครื่องเดียวกันจึงอ่านจาก page cache ชุดเดียวกัน
+
+ตัวอย่าง:
+    python scripts/05_export_merged_model.py --base-model meta-llama/Llama-2-7b-hf \
+        --adapter-path ./results/final_model --output-dir ./results/merged_model
+"""
+import argparse
+import json
+import os
+import time
+
+from response_cache import adapter_identity
+
+
+def export_merged_model(base_model_name, adapter_path, output_dir, dtype="fp16"):
+    """
+    Merge adapter เข้าโมเดลฐานบน CPU แล้วบันทึกลง output_dir
+
+    Args:
+        dtype: dtype ของ weights ที่บันทึก (fp16, bf16, fp32)
+
+    Returns:
+        path ของ output_dir
+    """
+    # import ตอนใช้งานจริง --help จึงไม่ต้องรอโหลด torch/transformers
+    import torch
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    from device import DTYPES, MERGED_MODEL_META
+
+    start_time = time.perf_counter()
+    print(f"Loading base model {base_model_name} ({dtype})...")
+    base_model = AutoModelForCausalLM.from_pretrained(
+        base_model_name,
+        torch_dtype=DTYPES[dtype],
+        low_cpu_mem_usage=True,
+    )
+
+    print(f"Merging adapter {adapter_path}...")
+    model = PeftModel.from_pretrained(base_model, adapter_path)
+    model = model.merge_and_unload()
+    model.eval()
+
+    os.makedirs(output_dir, exist_ok=True)
+    # max_shard_size ใหญ่พอให้ได้ไฟล์เดียว (model.safetensors)
+    model.save_pretrained(output_dir, safe_serialization=True, max_shard_size="1000GB")
+    tokenizer = AutoTokenizer.from_pretrained(adapter_path)
+    tokenizer.save_pretrained(output_dir)
+
+    meta = {
+        "base_model": base_model_name,
+        "adapter_path": os.path.abspath(adapter_path),
+        "adapter_id": adapter_identity(adapter_path),
+        "dtype": dtype,
+        "torch": torch.__version__,
+    }
+    with open(os.path.join(output_dir, MERGED_MODEL_META), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    print(f"Merged model saved to {output_dir} in {time.perf_counter() - start_time:.1f}s")
+    return output_dir
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge LoRA adapter เข้าโมเดลฐานแล้ว export เป็น safetensors")
+    parser.add_argument("--base-model", default="meta-llama/Llama-2-7b-hf")
+    parser.add_argument("--adapter-path", default="./results/final_model")
+    parser.add_argument("--output-dir", default="./results/merged_model")
+    parser.add_argument("--dtype", default="fp16", choices=["bf16", "fp16", "fp32"])
+    args = parser.parse_args(argv)
+
+    export_merged_model(args.base_model, args.adapter_path, args.output_dir, dtype=args.dtype)
+
+
+if __name__ == "__main__":
+    main()
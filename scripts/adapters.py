@@ -0,0 +1,143 @@
+"""
+ไฟล์สำหรับ serve LoRA adapter หลายตัวบนโมเดลฐานชุดเดียว
+
+โมเดลฐานโหลดครั้งเดียว adapter แต่ละตัว (output_dir ของ LLMFineTuner) ใช้หน่วยความจำแค่ระดับ MB
+request ในแต่ละแถวของ batch เลือก adapter ของตัวเองได้ (adapter_names ของ PEFT) จึงอยู่ใน batch เดียวกันได้
+adapter ที่ไม่ได้ใช้นานที่สุดถูก unload เมื่อเกิน memory budget (LRU) และโหลดกลับเมื่อมี request ใหม่
+"""
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from peft import PeftModel
+
+from response_cache import adapter_identity
+
+# ชื่อที่ PEFT ใช้กับแถวที่ไม่ใช้ adapter ใน batch ที่มีหลาย adapter
+BASE_ADAPTER = "__base__"
+
+
+def adapter_nbytes(model, name):
+    """หน่วยความจำของ weights ของ adapter name ใน PeftModel"""
+    marker = f".{name}."
+    return sum(
+        parameter.numel() * parameter.element_size()
+        for parameter_name, parameter in model.named_parameters()
+        if marker in parameter_name
+    )
+
+
+class AdapterRegistry:
+    """
+    รายชื่อ adapter ที่ลงทะเบียนไว้ และ adapter ที่โหลดอยู่ใน PeftModel
+
+    adapter ที่อยู่ในโมเดลตั้งแต่แรก (เช่น "default" จาก device.load_model) ถูก pin ไว้ไม่ถูก unload
+    adapter ที่มี request ใช้อยู่ (acquire แล้วยังไม่ release) ก็ไม่ถูก unload
+
+    Args:
+        model: PeftModel ที่ยังไม่ได้ merge adapter
+        max_memory_mb: หน่วยความจำรวมของ adapter ที่โหลดได้
+        prefix_cache: PrefixCache ที่ต้องลบ KV ของ adapter ที่ถูก unload หรือเปลี่ยน path
+    """
+
+    def __init__(self, model, max_memory_mb=256, prefix_cache=None):
+        if not isinstance(model, PeftModel):
+            raise ValueError("multi-adapter ต้องใช้ PeftModel ที่ไม่ได้ merge (ใช้โมเดลที่ merge แล้วหรือ CPU int8 ไม่ได้)")
+        self.model = model
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.prefix_cache = prefix_cache
+        self.paths = {}
+        self.loaded = OrderedDict()
+        self.pinned = set(model.peft_config)
+        self.in_use = Counter()
+        self.lock = threading.Lock()
+        # adapter ของ request ที่ไม่ได้ระบุ
+        self.default = model.active_adapter
+        self.loads = 0
+        self.evictions = 0
+        for name in model.peft_config:
+            self.loaded[name] = adapter_nbytes(model, name)
+
+    def register(self, name, path):
+        """ลงทะเบียน adapter (ยังไม่โหลดจนกว่าจะมี request ใช้)"""
+        if name == BASE_ADAPTER or name in self.pinned:
+            raise ValueError(f"ชื่อ adapter {name!r} ถูกใช้แล้ว")
+        if not os.path.isfile(os.path.join(path, "adapter_config.json")):
+            raise ValueError(f"{path} ไม่ใช่ LoRA adapter (ไม่มี adapter_config.json)")
+        with self.lock:
+            if self.paths.get(name) not in (None, path) and name in self.loaded and not self.in_use[name]:
+                self._unload(name)
+            self.paths[name] = path
+
+    def names(self):
+        return list(self.pinned) + sorted(self.paths)
+
+    def identity(self, name):
+        """fingerprint ของ adapter สำหรับ key ของ response cache (None = adapter ที่ pin ไว้)"""
+        if name in self.paths:
+            return adapter_identity(self.paths[name])
+        if name == BASE_ADAPTER:
+            return BASE_ADAPTER
+        if name in self.pinned:
+            return None
+        raise KeyError(f"ไม่รู้จัก adapter {name!r}")
+
+    def acquire(self, name):
+        """
+        โหลด adapter name (ถ้ายังไม่โหลด) และนับว่ามี request ใช้อยู่ ต้องเรียก release เมื่อใช้เสร็จ
+
+        Returns:
+            ชื่อที่ใช้กับ adapter_names ของ PEFT (name=None คือ adapter default)
+        """
+        with self.lock:
+            if name is None:
+                name = self.default
+            if name == BASE_ADAPTER:
+                return name
+            if name not in self.loaded:
+                if name not in self.paths:
+                    raise KeyError(f"ไม่รู้จัก adapter {name!r}")
+                self.model.load_adapter(self.paths[name], adapter_name=name)
+                self.model.eval()
+                self.loaded[name] = adapter_nbytes(self.model, name)
+                self.loads += 1
+            self.loaded.move_to_end(name)
+            self.in_use[name] += 1
+            self._evict()
+            return name
+
+    def release(self, name):
+        with self.lock:
+            if name == BASE_ADAPTER:
+                return
+            self.in_use[name] -= 1
+            if self.in_use[name] <= 0:
+                del self.in_use[name]
+            self._evict()
+
+    def memory_bytes(self):
+        return sum(self.loaded.values())
+
+    def _evict(self):
+        while self.memory_bytes() > self.max_memory_bytes:
+            candidates = [name for name in self.loaded if name not in self.pinned and not self.in_use[name]]
+            if not candidates:
+                break
+            self._unload(candidates[0])
+            self.evictions += 1
+
+    def _unload(self, name):
+        self.model.delete_adapter(name)
+        del self.loaded[name]
+        if self.prefix_cache is not None:
+            self.prefix_cache.discard_adapter(name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "adapters_registered": len(self.paths) + len(self.pinned),
+                "adapters_loaded": len(self.loaded),
+                "adapter_memory_mb": self.memory_bytes() / (1024 * 1024),
+                "adapter_loads": self.loads,
+                "adapter_evictions": self.evictions,
+            }
@@ -0,0 +1,177 @@
+"""
+ไฟล์สำหรับการประเมินแบบ adaptive: สุ่ม sample แบบแบ่งชั้น (stratified) แล้วหยุดเมื่อ confidence interval แคบพอ
+
+sample ถูกแบ่งชั้นตามความยาวของคำตอบอ้างอิง (perplexity และ ROUGE ขึ้นกับความยาว)
+ลำดับที่ประเมินสลับชั้นตามสัดส่วน ทุกช่วงต้นของลำดับจึงมีสัดส่วนแต่ละชั้นใกล้เคียงทั้ง dataset
+ค่าประมาณเป็น stratified mean และ CI แบบ normal approximation พร้อม finite population correction
+(ประเมินครบทั้ง dataset แล้ว CI กว้างเป็นศูนย์)
+
+หยุดเมื่อ CI (high - low) ของทุก metric ใน ci_targets ไม่เกินเป้า หรือเมื่อถึง budget
+(จำนวน sample, เวลา หรือจำนวน token ที่ generate)
+"""
+import time
+from statistics import NormalDist
+
+import numpy as np
+
+# เหตุผลที่หยุด
+CI_TARGET = "ci_target"
+MAX_SAMPLES = "max_samples"
+MAX_SECONDS = "max_seconds"
+MAX_GENERATED_TOKENS = "max_generated_tokens"
+EXHAUSTED = "exhausted"
+
+
+def parse_ci_targets(items):
+    """แปลง ["rougeL=0.05", "perplexity=1"] เป็น {"rougeL": 0.05, "perplexity": 1.0}"""
+    targets = {}
+    for item in items or ():
+        name, sep, width = item.partition("=")
+        if not sep:
+            raise ValueError(f"ci target ต้องอยู่ในรูป METRIC=WIDTH (ได้ {item!r})")
+        targets[name.strip()] = float(width)
+    return targets
+
+
+def stratified_order(lengths, num_strata=5, seed=42):
+    """
+    ลำดับการประเมินแบบ stratified random
+
+    แบ่งชั้นตาม quantile ของ lengths สุ่มลำดับภายในชั้น แล้วเรียงทุก sample ตาม (ลำดับในชั้น + u) / ขนาดชั้น
+    (u สุ่มต่อชั้น) จึงได้ลำดับที่สลับชั้นตามสัดส่วน
+
+    Returns:
+        (order, strata, sizes): ลำดับ index, ชั้นของแต่ละ index และจำนวน sample ของแต่ละชั้น
+    """
+    lengths = np.asarray(lengths, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    edges = np.unique(np.quantile(lengths, np.linspace(0, 1, num_strata + 1)[1:-1])) if len(lengths) else []
+    strata = np.searchsorted(edges, lengths, side="right")
+    sizes = np.bincount(strata, minlength=len(edges) + 1)
+
+    keys = np.empty(len(lengths))
+    for stratum, size in enumerate(sizes):
+        members = np.flatnonzero(strata == stratum)
+        if not size:
+            continue
+        keys[rng.permutation(members)] = (np.arange(size) + rng.random()) / size
+    order = np.argsort(keys, kind="stable")
+    return order, strata, sizes
+
+
+def stratified_interval(values, strata, sizes, confidence=0.95):
+    """
+    stratified mean และ CI ของค่าเฉลี่ยทั้ง dataset จาก sample ที่ประเมินแล้ว
+
+    Args:
+        values: ค่า metric ของ sample ที่ประเมินแล้ว
+        strata: ชั้นของแต่ละค่า
+        sizes: จำนวน sample ของแต่ละชั้นทั้ง dataset
+
+    Returns:
+        (mean, low, high) หรือ None ถ้ายังมีค่าไม่ถึง 2 ค่า
+    """
+    values = np.asarray(values, dtype=np.float64)
+    strata = np.asarray(strata)
+    if len(values) < 2:
+        return None
+    pooled_var = values.var(ddof=1)
+    observed = [stratum for stratum in range(len(sizes)) if np.any(strata == stratum)]
+    # ชั้นที่ยังไม่มี sample: ถ่วงน้ำหนักใหม่เฉพาะชั้นที่มี
+    total = sum(sizes[stratum] for stratum in observed)
+
+    mean = 0.0
+    variance = 0.0
+    for stratum in observed:
+        stratum_values = values[strata == stratum]
+        n, size = len(stratum_values), sizes[stratum]
+        weight = size / total
+        var = stratum_values.var(ddof=1) if n >= 2 else pooled_var
+        mean += weight * stratum_values.mean()
+        variance += weight ** 2 * (1.0 - n / size) * var / n
+    half_width = NormalDist().inv_cdf(0.5 + confidence / 2) * np.sqrt(max(variance, 0.0))
+    return float(mean), float(mean - half_width), float(mean + half_width)
+
+
+class AdaptiveStopper:
+    """
+    ตัดสินว่าจะหยุดการประเมินหรือไม่จากค่าประมาณของ sample ที่ประเมินแล้วและ budget
+
+    Args:
+        strata, sizes: จาก stratified_order
+        ci_targets: {metric: ความกว้าง CI สูงสุด} เช่น {"perplexity": 1.0, "rougeL": 0.05}
+        min_samples: จำนวน sample ขั้นต่ำก่อนเริ่มตรวจ CI
+        max_samples, max_seconds, max_generated_tokens: budget (None = ไม่จำกัด)
+    """
+
+    def __init__(self, strata, sizes, ci_targets, min_samples=30, max_samples=None, max_seconds=None,
+                 max_generated_tokens=None, confidence=0.95):
+        self.strata = np.asarray(strata)
+        self.sizes = sizes
+        self.ci_targets = dict(ci_targets)
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.max_seconds = max_seconds
+        self.max_generated_tokens = max_generated_tokens
+        self.confidence = confidence
+        self.start = time.perf_counter()
+        self.intervals = {}
+        self.reason = None
+
+    def update(self, metric_values):
+        """
+        Args:
+            metric_values: {metric: (sample_ids, values)} ของ sample ที่มีค่าแล้ว
+        """
+        self.intervals = {}
+        for name, (sample_ids, values) in metric_values.items():
+            interval = stratified_interval(values, self.strata[sample_ids], self.sizes, self.confidence)
+            if interval is not None:
+                self.intervals[name] = interval
+
+    def widths(self):
+        return {name: high - low for name, (_, low, high) in self.intervals.items()}
+
+    def should_stop(self, num_evaluated, generated_tokens, remaining):
+        """คืนเหตุผลที่หยุด หรือ None ถ้ายังต้องประเมินต่อ"""
+        widths = self.widths()
+        if (
+            self.ci_targets
+            and num_evaluated >= self.min_samples
+            and all(name in widths and widths[name] <= target for name, target in self.ci_targets.items())
+        ):
+            self.reason = CI_TARGET
+        elif not remaining:
+            self.reason = EXHAUSTED
+        elif self.max_samples is not None and num_evaluated >= self.max_samples:
+            self.reason = MAX_SAMPLES
+        elif self.max_seconds is not None and time.perf_counter() - self.start >= self.max_seconds:
+            self.reason = MAX_SECONDS
+        elif self.max_generated_tokens is not None and generated_tokens >= self.max_generated_tokens:
+            self.reason = MAX_GENERATED_TOKENS
+        return self.reason
+
+    def progress(self, num_evaluated):
+        widths = self.widths()
+        parts = [
+            f"{name} {self.intervals[name][0]:.4f} ±{widths[name] / 2:.4f}"
+            + (f" (target width {self.ci_targets[name]})" if name in self.ci_targets else "")
+            for name in self.intervals
+        ]
+        return f"[adaptive] {num_evaluated} samples: " + ", ".join(parts)
+
+    def report(self, num_evaluated, dataset_size):
+        """ค่าที่ใส่ใน metrics: stratified mean/CI ของแต่ละ metric และเหตุผลที่หยุด"""
+        report = {
+            "adaptive_stop_reason": self.reason,
+            "adaptive_samples": num_evaluated,
+            "adaptive_dataset_size": dataset_size,
+            "adaptive_fraction": num_evaluated / dataset_size if dataset_size else 0.0,
+            "adaptive_strata": len(self.sizes),
+            "adaptive_confidence": self.confidence,
+        }
+        for name, (mean, low, high) in self.intervals.items():
+            report[f"{name}_stratified_mean"] = mean
+            report[f"{name}_stratified_ci_low"] = low
+            report[f"{name}_stratified_ci_high"] = high
+        return report
@@ -0,0 +1,544 @@
+"""
+ไฟล์สำหรับ benchmark inference/evaluation บน CPU ด้วยโมเดล Llama ขนาดเล็กที่สุ่ม weights และ LoRA adapter จำลอง
+
+วัด latency (p50/p95/p99), time to first token, tokens/sec, peak RSS และเวลาโหลดโมเดล
+ของแต่ละ scenario แล้วบันทึกเป็น JSON เพื่อเทียบสองรอบด้วย compare
+
+ตัวอย่าง:
+    python scripts/benchmark.py run --output benchmarks/baseline.json
+    python scripts/benchmark.py run --output benchmarks/current.json
+    python scripts/benchmark.py compare benchmarks/baseline.json benchmarks/current.json --threshold 0.1
+
+    # เทียบ tokens/sec ของแต่ละ precision/จำนวน thread/torch.compile บนเครื่องนี้
+    python scripts/benchmark.py configs --precisions fp32 bf16 int8 --threads 1 4 --compile
+"""
+import argparse
+import importlib
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+from prompt_template import PROMPT_PREAMBLE, format_example
+from scheduler import ContinuousBatchScheduler
+from speculative import PROMPT_LOOKUP, SpeculativeDecoder
+
+# ทิศทางของแต่ละ metric สำหรับ compare: True = ยิ่งน้อยยิ่งดี
+LOWER_IS_BETTER = {
+    "latency_p50": True,
+    "latency_p95": True,
+    "latency_p99": True,
+    "ttft_p50": True,
+    "ttft_p95": True,
+    "ttft_p99": True,
+    "load_seconds": True,
+    "peak_rss_mb": True,
+    "tokens_per_sec": False,
+    "samples_per_sec": False,
+    "acceptance_rate": False,
+    "speedup": False,
+}
+
+WORDS = ["สวัสดี", "ภาษาไทย", "คำถาม", "คำตอบ", "hello", "world", "the", "quick", "brown", "fox", "model", "data"]
+
+
+def build_tiny_model(output_dir, seed=0, hidden_size=64, num_layers=2, vocab_size=512):
+    """
+    สร้างโมเดล Llama ขนาดเล็ก (weights สุ่ม) + LoRA adapter จำลอง + tokenizer ใน output_dir
+
+    lm_head ของ EOS เป็นศูนย์ greedy decoding จึงไม่จบก่อน max_tokens และทุกรอบ generate จำนวน token เท่ากัน
+
+    Returns:
+        (base_model_path, adapter_path)
+    """
+    from peft import LoraConfig, get_peft_model
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    base_path = os.path.join(output_dir, "base")
+    adapter_path = os.path.join(output_dir, "adapter")
+
+    corpus = [PROMPT_PREAMBLE, "### Instruction:\n### Input:\n### Response:\n", " ".join(WORDS)] * 50
+    backend = Tokenizer(models.BPE())
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    backend.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<s>", "</s>", "<unk>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    ))
+    backend.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", 0)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token="<s>", eos_token="</s>", unk_token="<unk>")
+    tokenizer.pad_token = tokenizer.eos_token
+
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=2048,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(config)
+    with torch.no_grad():
+        model.lm_head.weight[tokenizer.eos_token_id].zero_()
+    model.save_pretrained(base_path)
+    tokenizer.save_pretrained(base_path)
+
+    peft_model = get_peft_model(model, LoraConfig(
+        r=4,
+        lora_alpha=8,
+        target_modules=["q_proj", "v_proj"],
+        task_type="CAUSAL_LM",
+        init_lora_weights=False,
+    ))
+    peft_model.save_pretrained(adapter_path)
+    tokenizer.save_pretrained(adapter_path)
+    return base_path, adapter_path
+
+
+def synthetic_example(rng, instruction_words=8, input_words=8, output_words=16):
+    """instruction/input/output สุ่มจากคำใน WORDS"""
+    return tuple(
+        " ".join(rng.choice(WORDS, size=count))
+        for count in (instruction_words, input_words, output_words)
+    )
+
+
+def synthetic_dataset(num_samples, seed=0):
+    """Dataset ในรูปแบบเดียวกับ 01_prepare_dataset (คอลัมน์ text)"""
+    from datasets import Dataset
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(num_samples):
+        instruction, input_text, output = synthetic_example(
+            rng, rng.integers(4, 16), rng.integers(0, 24), rng.integers(8, 32)
+        )
+        rows.append({"text": format_example(instruction, input_text, output)})
+    return Dataset.from_list(rows)
+
+
+def peak_rss_mb():
+    """peak RSS ของ process (high-water mark ตั้งแต่เริ่ม process)"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux รายงานเป็น KB, macOS เป็น byte
+    return usage / 1024 if sys.platform != "darwin" else usage / (1024 * 1024)
+
+
+def latency_stats(prefix, values):
+    """p50/p95/p99 และค่าเฉลี่ยของ list ของวินาที"""
+    values = [v for v in values if v is not None]
+    if not values:
+        return {}
+    return {
+        f"{prefix}_p50": float(np.percentile(values, 50)),
+        f"{prefix}_p95": float(np.percentile(values, 95)),
+        f"{prefix}_p99": float(np.percentile(values, 99)),
+        f"{prefix}_mean": float(np.mean(values)),
+    }
+
+
+def run_requests(chatbot, requests, max_tokens):
+    """ส่ง request ผ่าน ChatBot.stream_response ทีละตัว (greedy) วัด latency/TTFT/tokens"""
+    latencies, ttfts = [], []
+    total_tokens = 0
+    start = time.perf_counter()
+    for instruction, input_text in requests:
+        request_start = time.perf_counter()
+        ttft = None
+        num_tokens = 0
+        for chunk in chatbot.stream_response(instruction, input_text, max_tokens=max_tokens, do_sample=False):
+            if ttft is None:
+                ttft = chunk["time_to_first_token"]
+            num_tokens = chunk["num_tokens"]
+        latencies.append(time.perf_counter() - request_start)
+        ttfts.append(ttft)
+        total_tokens += num_tokens
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": len(requests),
+        **latency_stats("latency", latencies),
+        **latency_stats("ttft", ttfts),
+        "tokens_per_sec": total_tokens / elapsed if elapsed > 0 else 0.0,
+        "generated_tokens": total_tokens,
+    }
+
+
+def scenario_single_request(chatbot, args, rng):
+    requests = [synthetic_example(rng)[:2] for _ in range(args.num_requests)]
+    # warmup ไม่นับผล (สร้าง KV cache ของ preamble, โหลด kernel)
+    run_requests(chatbot, requests[:1], args.max_tokens)
+    return run_requests(chatbot, requests, args.max_tokens)
+
+
+def scenario_long_prompt(chatbot, args, rng):
+    requests = [
+        synthetic_example(rng, instruction_words=args.long_prompt_words // 2, input_words=args.long_prompt_words // 2)[:2]
+        for _ in range(max(1, args.num_requests // 2))
+    ]
+    result = run_requests(chatbot, requests, args.max_tokens)
+    result["prompt_tokens"] = int(np.mean([
+        len(chatbot.tokenizer(chatbot.build_prompt(*request))["input_ids"]) for request in requests
+    ]))
+    return result
+
+
+def scenario_concurrent(chatbot, args, rng):
+    """ส่ง request พร้อมกันเข้า ContinuousBatchScheduler แบบเดียวกับ server.py"""
+    scheduler = ContinuousBatchScheduler(
+        chatbot.model,
+        chatbot.tokenizer,
+        max_batch_size=args.concurrency,
+        prefix_cache=chatbot.prefix_cache,
+    )
+    scheduler.start()
+    try:
+        requests = [synthetic_example(rng)[:2] for _ in range(args.num_requests * args.concurrency)]
+        finished = threading.Semaphore(0)
+        latencies, ttfts = [], []
+        totals = {"tokens": 0}
+        lock = threading.Lock()
+
+        def make_callback(submit_time):
+            def callback(event):
+                if event["type"] == "token":
+                    return
+                with lock:
+                    latencies.append(time.perf_counter() - submit_time)
+                    if event["type"] == "done":
+                        ttfts.append(event["time_to_first_token"])
+                        totals["tokens"] += event["usage"]["completion_tokens"]
+                finished.release()
+            return callback
+
+        start = time.perf_counter()
+        for instruction, input_text in requests:
+            scheduler.submit(
+                chatbot.build_prompt(instruction, input_text),
+                max_tokens=args.max_tokens,
+                temperature=0.0,
+                callback=make_callback(time.perf_counter()),
+            )
+        for _ in requests:
+            finished.acquire()
+        elapsed = time.perf_counter() - start
+        stats = scheduler.stats()
+    finally:
+        scheduler.stop()
+
+    return {
+        "requests": len(requests),
+        "concurrency": args.concurrency,
+        **latency_stats("latency", latencies),
+        **latency_stats("ttft", ttfts),
+        "tokens_per_sec": totals["tokens"] / elapsed if elapsed > 0 else 0.0,
+        "generated_tokens": totals["tokens"],
+        "avg_batch_size": stats.get("avg_batch_size"),
+    }
+
+
+def scenario_speculative(chatbot, args, rng):
+    """
+    prompt lookup decoding เทียบกับ decoding ปกติบน request เดียวกัน (greedy)
+    input ยาวให้ draft มี n-gram ให้ลอก speedup = วินาทีต่อ token ของ decoding ปกติ / speculative
+    greedy ต้องได้คำตอบเหมือนกันทุกตัว (ไม่เช่นนั้น RuntimeError)
+    """
+    speculative, chatbot.speculative = chatbot.speculative, SpeculativeDecoder(PROMPT_LOOKUP, args.num_draft_tokens)
+    try:
+        requests = [synthetic_example(rng, input_words=48)[:2] for _ in range(args.num_requests)]
+        results = {False: [], True: []}
+        texts = {False: [], True: []}
+        for request in requests:
+            for use_speculative in (False, True):
+                text = "".join(
+                    chunk["text"]
+                    for chunk in chatbot.stream_response(*request, max_tokens=args.max_tokens, do_sample=False,
+                                                         use_speculative=use_speculative)
+                )
+                results[use_speculative].append(chatbot.last_speculation)
+                texts[use_speculative].append(text)
+    finally:
+        chatbot.speculative = speculative
+
+    mismatches = sum(plain != fast for plain, fast in zip(texts[False], texts[True]))
+    if mismatches:
+        raise RuntimeError(f"speculative greedy output ต่างจาก greedy ปกติ {mismatches}/{len(requests)} request")
+
+    def seconds_per_token(stats):
+        tokens = sum(item["decode_tokens"] for item in stats)
+        return sum(item["decode_seconds"] for item in stats) / tokens if tokens else 0.0
+
+    plain, fast = seconds_per_token(results[False]), seconds_per_token(results[True])
+    return {
+        "requests": len(requests),
+        "num_draft_tokens": args.num_draft_tokens,
+        "acceptance_rate": float(np.mean([item["acceptance_rate"] for item in results[True]])),
+        "tokens_per_pass": float(np.mean([item["tokens_per_pass"] for item in results[True]])),
+        "plain_decode_tokens_per_sec": 1.0 / plain if plain else 0.0,
+        "tokens_per_sec": 1.0 / fast if fast else 0.0,
+        "speedup": plain / fast if fast else 0.0,
+    }
+
+
+def scenario_batched_eval(evaluator, dataset, args):
+    start = time.perf_counter()
+    evaluator.evaluate_on_dataset(dataset, batch_token_budget=args.batch_token_budget)
+    elapsed = time.perf_counter() - start
+    throughput = evaluator.last_throughput
+    return {
+        "samples": len(dataset),
+        "latency_p50": elapsed,
+        "samples_per_sec": throughput["samples_per_sec"],
+        "tokens_per_sec": throughput["tokens_per_sec"],
+    }
+
+
+def scenario_perplexity_only(evaluator, dataset, args):
+    start = time.perf_counter()
+    evaluator.score_dataset(dataset, batch_token_budget=args.batch_token_budget)
+    elapsed = time.perf_counter() - start
+    throughput = evaluator.last_throughput
+    return {
+        "samples": len(dataset),
+        "latency_p50": elapsed,
+        "samples_per_sec": throughput["samples_per_sec"],
+        "tokens_per_sec": throughput["tokens_per_sec"],
+    }
+
+
+def run_benchmarks(args):
+    """รันทุก scenario ที่เลือกแล้วคืน dict ของผล"""
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    rng = np.random.default_rng(args.seed)
+    scenarios = {}
+
+    def record(name, fn):
+        print(f"Running scenario: {name}")
+        result = fn()
+        result["peak_rss_mb"] = peak_rss_mb()
+        scenarios[name] = result
+        print(f"  {json.dumps(result, ensure_ascii=False)}")
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        base_path, adapter_path = build_tiny_model(model_dir, seed=args.seed, hidden_size=args.hidden_size, num_layers=args.num_layers)
+
+        # ชื่อไฟล์ขึ้นต้นด้วยตัวเลข จึง import ด้วย importlib
+        inference = importlib.import_module("04_inference")
+        evaluation = importlib.import_module("03_evaluate_model")
+
+        start = time.perf_counter()
+        chatbot = inference.ChatBot(base_path, adapter_path, load_in_8bit=False)
+        scenarios["model_load"] = {"load_seconds": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb()}
+
+        selected = set(args.scenarios)
+        if "single" in selected:
+            record("single", lambda: scenario_single_request(chatbot, args, rng))
+        if "concurrent" in selected:
+            record("concurrent", lambda: scenario_concurrent(chatbot, args, rng))
+        if "long_prompt" in selected:
+            record("long_prompt", lambda: scenario_long_prompt(chatbot, args, rng))
+        if "speculative" in selected:
+            record("speculative", lambda: scenario_speculative(chatbot, args, rng))
+
+        if selected & {"batched_eval", "perplexity_only"}:
+            del chatbot
+            with tempfile.TemporaryDirectory() as output_dir:
+                start = time.perf_counter()
+                evaluator = evaluation.ModelEvaluator(base_path, adapter_path, output_dir=output_dir, load_in_8bit=False)
+                scenarios["evaluator_load"] = {"load_seconds": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb()}
+                dataset = synthetic_dataset(args.eval_samples, seed=args.seed)
+                if "batched_eval" in selected:
+                    record("batched_eval", lambda: scenario_batched_eval(evaluator, dataset, args))
+                if "perplexity_only" in selected:
+                    record("perplexity_only", lambda: scenario_perplexity_only(evaluator, dataset, args))
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "num_threads": torch.get_num_threads(),
+            "config": {key: value for key, value in vars(args).items() if key != "func"},
+        },
+        "scenarios": scenarios,
+    }
+
+
+def configs_command(args):
+    """วัด tokens/sec ของ ChatBot ในแต่ละ configuration (precision x threads x compile) บน device เดียว"""
+    inference = importlib.import_module("04_inference")
+    rng = np.random.default_rng(args.seed)
+    requests = [synthetic_example(rng)[:2] for _ in range(args.num_requests)]
+    configurations = list(itertools.product(args.precisions, args.threads or [None], [False, True] if args.compile else [False]))
+
+    rows = []
+    with tempfile.TemporaryDirectory() as model_dir:
+        if args.base_model:
+            base_path, adapter_path = args.base_model, args.adapter_path
+        else:
+            base_path, adapter_path = build_tiny_model(model_dir, seed=args.seed, hidden_size=args.hidden_size, num_layers=args.num_layers)
+
+        for precision, num_threads, compile_model in configurations:
+            print(f"Configuration: precision={precision}, threads={num_threads}, compile={compile_model}")
+            try:
+                chatbot = inference.ChatBot(
+                    base_path,
+                    adapter_path,
+                    device=args.device,
+                    precision=precision,
+                    num_threads=num_threads,
+                    compile_model=compile_model,
+                )
+            except (ValueError, ImportError, RuntimeError) as e:
+                print(f"  skipped: {e}")
+                continue
+            # warmup (รวม compile ครั้งแรกของ torch.compile)
+            run_requests(chatbot, requests[:1], args.max_tokens)
+            result = run_requests(chatbot, requests, args.max_tokens)
+            rows.append({**chatbot.device_info, **result, "peak_rss_mb": peak_rss_mb()})
+            del chatbot
+
+    print(f"\n{'device':<8}{'precision':<10}{'threads':>8}{'compile':>9}{'load s':>9}{'tok/s':>10}{'p50 s':>9}")
+    for row in rows:
+        print(f"{row['device']:<8}{row['precision']:<10}{row['num_threads']:>8}{str(row['compiled']):>9}"
+              f"{row['load_seconds']:>9.2f}{row['tokens_per_sec']:>10.1f}{row['latency_p50']:>9.3f}")
+    if rows:
+        best = max(rows, key=lambda row: row["tokens_per_sec"])
+        print(f"\nFastest: precision={best['precision']}, threads={best['num_threads']}, compile={best['compiled']}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"configurations": rows}, f, indent=2)
+        print(f"Configuration results saved to: {args.output}")
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    เทียบผล benchmark สองชุด
+
+    Returns:
+        list ของ dict: scenario, metric, baseline, current, change (สัดส่วน), regression (bool)
+        change เป็นบวกเมื่อแย่ลงเสมอ ไม่ว่า metric จะเป็นแบบยิ่งน้อยหรือยิ่งมากยิ่งดี
+    """
+    rows = []
+    for scenario, metrics in current["scenarios"].items():
+        base_metrics = baseline["scenarios"].get(scenario)
+        if base_metrics is None:
+            continue
+        for metric, value in metrics.items():
+            lower_is_better = LOWER_IS_BETTER.get(metric)
+            base_value = base_metrics.get(metric)
+            if lower_is_better is None or value is None or not base_value:
+                continue
+            change = (value - base_value) / base_value
+            if not lower_is_better:
+                change = -change
+            rows.append({
+                "scenario": scenario,
+                "metric": metric,
+                "baseline": base_value,
+                "current": value,
+                "change": change,
+                "regression": change > threshold,
+            })
+    return rows
+
+
+def run_command(args):
+    results = run_benchmarks(args)
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"Benchmark results saved to: {args.output}")
+
+
+def compare_command(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+
+    rows = compare_results(baseline, current, args.threshold)
+    print(f"{'scenario':<18}{'metric':<18}{'baseline':>12}{'current':>12}{'change':>10}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(f"{row['scenario']:<18}{row['metric']:<18}{row['baseline']:>12.4f}{row['current']:>12.4f}"
+              f"{row['change']:>+10.1%}{flag}")
+
+    regressions = [row for row in rows if row["regression"]]
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+    print("\nNo regressions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU benchmark ของ ChatBot และ ModelEvaluator")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="รัน benchmark และบันทึกผลเป็น JSON")
+    run.add_argument("--output", default="benchmarks/results.json")
+    run.add_argument("--scenarios", nargs="+",
+                     default=["single", "concurrent", "long_prompt", "speculative", "batched_eval", "perplexity_only"],
+                     choices=["single", "concurrent", "long_prompt", "speculative", "batched_eval", "perplexity_only"])
+    run.add_argument("--num-requests", type=int, default=8)
+    run.add_argument("--concurrency", type=int, default=4)
+    run.add_argument("--max-tokens", type=int, default=32)
+    run.add_argument("--long-prompt-words", type=int, default=300)
+    run.add_argument("--num-draft-tokens", type=int, default=10, help="token ที่ draft เสนอต่อรอบใน scenario speculative")
+    run.add_argument("--eval-samples", type=int, default=32)
+    run.add_argument("--batch-token-budget", type=int, default=8192)
+    run.add_argument("--hidden-size", type=int, default=64)
+    run.add_argument("--num-layers", type=int, default=2)
+    run.add_argument("--threads", type=int, default=None, help="torch.set_num_threads (None = ค่า default ของ torch)")
+    run.add_argument("--seed", type=int, default=0)
+    run.set_defaults(func=run_command)
+
+    configs = subparsers.add_parser("configs", help="เทียบ tokens/sec ของแต่ละ device/precision/threads/compile")
+    configs.add_argument("--base-model", default=None, help="โมเดลจริง (None = สร้างโมเดลเล็กสุ่ม weights)")
+    configs.add_argument("--adapter-path", default=None)
+    configs.add_argument("--device", default="auto", choices=["auto", "cuda", "cpu"])
+    configs.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "int8"],
+                         choices=["int8", "fp16", "bf16", "fp32"])
+    configs.add_argument("--threads", type=int, nargs="+", default=None)
+    configs.add_argument("--compile", action="store_true", help="วัดแบบมีและไม่มี torch.compile")
+    configs.add_argument("--num-requests", type=int, default=8)
+    configs.add_argument("--max-tokens", type=int, default=32)
+    configs.add_argument("--hidden-size", type=int, default=64)
+    configs.add_argument("--num-layers", type=int, default=2)
+    configs.add_argument("--seed", type=int, default=0)
+    configs.add_argument("--output", default=None)
+    configs.set_defaults(func=configs_command)
+
+    compare = subparsers.add_parser("compare", help="เทียบผลสองไฟล์ exit code 1 ถ้ามี regression")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.1, help="สัดส่วนที่แย่ลงได้ก่อนนับเป็น regression")
+    compare.set_defaults(func=compare_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
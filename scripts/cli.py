@@ -0,0 +1,240 @@
+"""
+CLI รวมของทุกขั้นตอน: prepare, train, eval, metrics, chat, serve, export
+
+torch/transformers/peft/datasets ถูก import เฉพาะใน subcommand ที่ใช้จริง
+`--help` และ `metrics` (คำนวณ metrics ใหม่จากผลที่บันทึกไว้ ไม่โหลดโมเดล) จึงเริ่มได้ทันที
+
+ตัวอย่าง:
+    python scripts/cli.py eval --num-samples 200 --precision bf16
+    python scripts/cli.py metrics ./evaluation_results/model_evaluation_log.jsonl
+    python scripts/cli.py --import-report serve --port 8000
+
+`--import-report` แสดงเวลาที่ใช้ import module ของแต่ละ subcommand และ package หนักที่ถูกโหลด
+(ดูละเอียดระดับ module ได้ด้วย `python -X importtime scripts/cli.py ...`)
+"""
+import argparse
+import importlib
+import sys
+import time
+
+START_TIME = time.perf_counter()
+
+HEAVY_PACKAGES = ("torch", "transformers", "peft", "datasets", "bitsandbytes", "pandas", "tqdm", "numpy",
+                  "sacrebleu", "rouge_score")
+
+_import_timings = []
+
+
+def load_module(name):
+    """import module แบบ lazy และจดเวลาที่ใช้ พร้อม package หนักที่ถูกโหลดเพิ่ม"""
+    before = set(sys.modules)
+    start = time.perf_counter()
+    # สคริปต์ที่ชื่อขึ้นต้นด้วยตัวเลขต้อง import ด้วย importlib
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    loaded = [package for package in HEAVY_PACKAGES if package in sys.modules and package not in before]
+    _import_timings.append((name, elapsed, loaded))
+    return module
+
+
+def print_import_report():
+    print("\nImport report", file=sys.stderr)
+    print(f"  {'module':<28} {'seconds':>8}  heavy packages loaded", file=sys.stderr)
+    for name, elapsed, loaded in _import_timings:
+        print(f"  {name:<28} {elapsed:>8.3f}  {', '.join(loaded) or '-'}", file=sys.stderr)
+    resident = [package for package in HEAVY_PACKAGES if package in sys.modules]
+    print(f"  total import seconds: {sum(elapsed for _, elapsed, _ in _import_timings):.3f}", file=sys.stderr)
+    print(f"  heavy packages in process: {', '.join(resident) or '-'}", file=sys.stderr)
+    print(f"  wall seconds since CLI start: {time.perf_counter() - START_TIME:.3f}", file=sys.stderr)
+
+
+def prepare_command(args):
+    load_module("01_prepare_dataset").main(
+        args.raw_data,
+        args.output,
+        num_proc=args.num_proc,
+        dedup=not args.no_dedup,
+        tokenizer=args.tokenizer,
+        max_tokens=args.max_tokens,
+        near_dup_threshold=args.near_dup_threshold,
+    )
+
+
+def train_command(args):
+    load_module("02_train_model").main(
+        dataset_path=args.dataset,
+        model_name=args.base_model,
+        output_dir=args.output_dir,
+        num_epochs=args.epochs,
+        mode=args.mode,
+        device=args.device,
+        batch_size=args.batch_size,
+        gradient_accumulation_steps=args.grad_accum,
+        autotune=args.autotune,
+    )
+
+
+def eval_command(args):
+    load_module("03_evaluate_model").main(
+        base_model=args.base_model,
+        adapter_path=args.adapter_path,
+        test_dataset_path=args.dataset,
+        num_samples=args.num_samples or None,
+        batch_token_budget=args.batch_token_budget or None,
+        perplexity_only=args.perplexity_only,
+        response_only_perplexity=args.response_only,
+        result_log=args.result_log or None,
+        resume=not args.no_resume,
+        device=args.device,
+        precision=args.precision,
+        output_dir=args.output_dir,
+        num_workers=args.num_workers,
+        scaling=[int(count) for count in args.scaling.split(",")] if args.scaling else None,
+        adaptive=args.adaptive,
+        ci_targets=load_module("adaptive_eval").parse_ci_targets(args.ci_target) if args.ci_target else None,
+        max_seconds=args.max_seconds,
+        max_generated_tokens=args.max_generated_tokens,
+        min_samples=args.min_samples,
+    )
+
+
+def metrics_command(args):
+    """คำนวณ metrics ใหม่จาก CSV หรือ result log (ไม่ import torch/transformers)"""
+    eval_report = load_module("eval_report")
+    results = eval_report.load_saved_results(args.results, fingerprint=args.fingerprint)
+    metrics = eval_report.recompute_metrics(results, num_proc=args.num_proc)
+    eval_report.print_metrics_summary(metrics)
+    if not args.no_save:
+        eval_report.save_results(args.output_dir, results, metrics, filename_prefix=args.prefix)
+
+
+def chat_command(args):
+    load_module("04_inference").main(
+        base_model_name=args.base_model,
+        adapter_path=args.adapter_path,
+        device=args.device,
+        precision=args.precision,
+        speculative=args.speculative,
+        num_draft_tokens=args.num_draft_tokens,
+        multi_turn=args.multi_turn,
+        history_strategy=args.history_strategy,
+        response_cache=not args.no_response_cache,
+        response_cache_path=args.response_cache_path,
+        greedy=args.greedy,
+    )
+
+
+def serve_command(args):
+    load_module("server").main(args.forwarded)
+
+
+def export_command(args):
+    load_module("05_export_merged_model").main(args.forwarded)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CLI ของ pipeline fine-tune, evaluate และ serve ChatBot")
+    parser.add_argument("--import-report", action="store_true",
+                        help="แสดงเวลา import และ package หนักที่ถูกโหลดเมื่อจบคำสั่ง")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prepare = subparsers.add_parser("prepare", help="แปลงข้อมูลดิบเป็น dataset (01_prepare_dataset.py)")
+    prepare.add_argument("--raw-data", default="data/raw_data.json")
+    prepare.add_argument("--output", default="data/processed_dataset")
+    prepare.add_argument("--num-proc", type=int, default=None)
+    prepare.add_argument("--no-dedup", action="store_true", help="ไม่ตัด record ที่ซ้ำ/เกือบซ้ำ")
+    prepare.add_argument("--near-dup-threshold", type=float, default=0.8)
+    prepare.add_argument("--tokenizer", default=None,
+                         help="tokenizer (ชื่อ/path เดียวกับ train --base-model) สำหรับกรอง record ที่ยาวเกิน "
+                              "--max-tokens (default = ไม่กรอง)")
+    prepare.add_argument("--max-tokens", type=int, default=512)
+    prepare.set_defaults(func=prepare_command)
+
+    train = subparsers.add_parser("train", help="เทรน LoRA adapter (02_train_model.py)")
+    train.add_argument("--dataset", default="data/processed_dataset")
+    train.add_argument("--base-model", default="meta-llama/Llama-2-7b-hf")
+    train.add_argument("--output-dir", default="./results")
+    train.add_argument("--epochs", type=int, default=3)
+    train.add_argument("--mode", default="max_length", choices=["max_length", "dynamic", "packed"],
+                       help="packed/dynamic ลด padding แต่จำนวน step (warmup, eval) เปลี่ยนตามจำนวน sequence")
+    train.add_argument("--device", default="auto", choices=["auto", "cuda", "cpu"])
+    train.add_argument("--batch-size", type=int, default=4)
+    train.add_argument("--grad-accum", type=int, default=4)
+    train.add_argument("--autotune", action="store_true",
+                       help="ลอง batch size x gradient accumulation ที่ effective batch เท่ากันแล้วใช้ชุดที่เร็วที่สุด")
+    train.set_defaults(func=train_command)
+
+    evaluate = subparsers.add_parser("eval", help="ประเมินโมเดล (03_evaluate_model.py)")
+    evaluate.add_argument("--base-model", default="meta-llama/Llama-2-7b-hf")
+    evaluate.add_argument("--adapter-path", default="./results/final_model")
+    evaluate.add_argument("--dataset", default="data/processed_dataset")
+    evaluate.add_argument("--output-dir", default="./evaluation_results")
+    evaluate.add_argument("--num-samples", type=int, default=100, help="0 = ทั้งหมด")
+    evaluate.add_argument("--batch-token-budget", type=int, default=16384, help="0 = generate ทีละ sample")
+    evaluate.add_argument("--perplexity-only", action="store_true")
+    evaluate.add_argument("--response-only", action="store_true", help="คิด perplexity เฉพาะ token ของ response")
+    evaluate.add_argument("--result-log", default="./evaluation_results/model_evaluation_log.jsonl",
+                          help="'' = เก็บผลใน memory")
+    evaluate.add_argument("--no-resume", action="store_true")
+    evaluate.add_argument("--device", default="auto", choices=["auto", "cuda", "cpu"])
+    evaluate.add_argument("--precision", default=None, choices=["int8", "fp16", "bf16", "fp32"])
+    evaluate.add_argument("--num-workers", type=int, default=1,
+                          help="จำนวน worker process ที่ประเมินแบบ data parallel (แต่ละตัวโหลดโมเดลของตัวเอง)")
+    evaluate.add_argument("--scaling", default=None,
+                          help="จำนวน worker คั่นด้วย comma (เช่น 1,2,4) วัด speedup และ scaling efficiency")
+    evaluate.add_argument("--adaptive", action="store_true",
+                          help="สุ่ม sample แบบ stratified และหยุดเมื่อ CI แคบพอ (--num-samples เป็น budget สูงสุด)")
+    evaluate.add_argument("--ci-target", action="append", default=None, metavar="METRIC=WIDTH",
+                          help="ความกว้าง CI สูงสุดของ metric (ซ้ำได้ default perplexity=1.0 และ rougeL=0.05)")
+    evaluate.add_argument("--max-seconds", type=float, default=None, help="budget เวลาของโหมด adaptive")
+    evaluate.add_argument("--max-generated-tokens", type=int, default=None, help="budget token ของโหมด adaptive")
+    evaluate.add_argument("--min-samples", type=int, default=30)
+    evaluate.set_defaults(func=eval_command)
+
+    metrics = subparsers.add_parser("metrics", help="คำนวณ metrics ใหม่จากผลที่บันทึกไว้โดยไม่โหลดโมเดล")
+    metrics.add_argument("results", help="*_results_*.csv หรือ result log (.jsonl)")
+    metrics.add_argument("--fingerprint", default=None, help="fingerprint ใน result log (None = ครั้งล่าสุด)")
+    metrics.add_argument("--num-proc", type=int, default=None, help="จำนวน worker ของ ROUGE/BLEU (None = ไม่เกิน 4)")
+    metrics.add_argument("--output-dir", default="./evaluation_results")
+    metrics.add_argument("--prefix", default="recomputed")
+    metrics.add_argument("--no-save", action="store_true", help="แสดงผลอย่างเดียว ไม่เขียนไฟล์")
+    metrics.set_defaults(func=metrics_command)
+
+    chat = subparsers.add_parser("chat", help="แชทกับโมเดลใน terminal (04_inference.py)")
+    chat.add_argument("--base-model", default="meta-llama/Llama-2-7b-hf")
+    chat.add_argument("--adapter-path", default=None, help="None = ./results/merged_model ถ้ามี ไม่เช่นนั้น final_model")
+    chat.add_argument("--device", default="auto", choices=["auto", "cuda", "cpu"])
+    chat.add_argument("--precision", default=None, choices=["int8", "fp16", "bf16", "fp32"])
+    chat.add_argument("--speculative", default=None,
+                      help="speculative decoding: prompt_lookup หรือ path ของ draft model ขนาดเล็ก (None = ปิด)")
+    chat.add_argument("--num-draft-tokens", type=int, default=10, help="จำนวน token ที่ draft เสนอต่อรอบ")
+    chat.add_argument("--multi-turn", action="store_true",
+                      help="ต่อบทสนทนาข้าม turn (เก็บ KV cache ของ session ไว้ prefill เฉพาะ token ใหม่)")
+    chat.add_argument("--history-strategy", default="window", choices=["window", "summarize"],
+                      help="วิธีย่อ history ที่ยาวเกิน budget: ตัด turn เก่าทิ้ง หรือให้โมเดลสรุป")
+    chat.add_argument("--greedy", action="store_true", help="greedy decoding (คำตอบซ้ำได้และใช้ response cache)")
+    chat.add_argument("--no-response-cache", action="store_true")
+    chat.add_argument("--response-cache-path", default=None, help="sqlite ของ response cache (None = memory เท่านั้น)")
+    chat.set_defaults(func=chat_command)
+
+    # serve และ export ส่ง argument ที่เหลือต่อให้ parser ของสคริปต์เอง (รวม --help)
+    serve = subparsers.add_parser("serve", help="OpenAI-compatible server (server.py)", add_help=False)
+    serve.set_defaults(func=serve_command, forward=True)
+
+    export = subparsers.add_parser("export", help="merge adapter แล้ว export (05_export_merged_model.py)",
+                                   add_help=False)
+    export.set_defaults(func=export_command, forward=True)
+
+    args, forwarded = parser.parse_known_args(argv)
+    if forwarded and not getattr(args, "forward", False):
+        parser.error(f"unrecognized arguments: {' '.join(forwarded)}")
+    args.forwarded = forwarded
+    try:
+        args.func(args)
+    finally:
+        if args.import_report:
+            print_import_report()
+
+
+if __name__ == "__main__":
+    main()
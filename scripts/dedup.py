@@ -0,0 +1,340 @@
+"""
+ไฟล์สำหรับลบ record ซ้ำและ record ที่ยาวเกิน ก่อนแบ่ง train/test
+
+- exact duplicate: hash ของ instruction/input/output ที่ normalize แล้ว
+  (NFC, casefold, ตัดเครื่องหมายวรรคตอน/สัญลักษณ์/อักขระควบคุมเช่น zero-width space, ยุบช่องว่าง)
+- near duplicate: MinHash ของ shingle ระดับตัวอักษร (ภาษาไทยไม่เว้นวรรคระหว่างคำ จึงไม่ใช้ shingle ระดับคำ)
+  หา candidate ด้วย LSH (signature 128 ค่าแบ่งเป็น 32 band band ละ 4 ค่า) แล้วยืนยันด้วย Jaccard ที่ประมาณจาก signature
+  คู่ที่ Jaccard 0.8 เป็น candidate เกือบทุกคู่ 0.5 ราว 87% และ 0.3 ราว 23%
+- ยาวเกิน: จำนวน token ของ text ทั้ง record เกิน max_length ของ tokenize_dataset (ถูกตัดท้ายคำตอบตอนเทรน)
+
+index ของ LSH อยู่ใน sqlite บน disk หน่วยความจำจึงไม่โตตามจำนวน record
+record ที่คล้ายกันแต่ไม่ถึงเกณฑ์ near duplicate (Jaccard >= group_threshold) ถูกรวมเป็นกลุ่มเดียวกัน
+และ group_split แบ่ง train/test ทีละกลุ่ม record ที่คล้ายกันจึงไม่อยู่คนละฝั่งของ split
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import unicodedata
+import zlib
+
+import numpy as np
+
+from prompt_template import parse_example
+from response_cache import normalize_text
+
+NUM_PERM = 128
+NUM_BANDS = 32
+SHINGLE_SIZE = 5
+
+# permutation ของ MinHash แบบ multiply-shift: 32 bit บนของ (a * h + b) mod 2^64 โดย h เป็น crc32 ของ shingle
+_rng = np.random.default_rng(1)
+_PERM_A = _rng.integers(0, 1 << 63, size=NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_PERM_B = _rng.integers(0, 1 << 63, size=NUM_PERM, dtype=np.uint64)
+
+# เหตุผลที่ record ถูกตัดทิ้ง
+TOO_LONG = "too_long"
+EXACT_DUPLICATE = "exact_duplicate"
+NEAR_DUPLICATE = "near_duplicate"
+
+
+def normalize_for_dedup(text):
+    """normalize text ไทย/อังกฤษสำหรับเทียบความซ้ำ"""
+    text = normalize_text(text)
+    text = "".join(
+        " " if unicodedata.category(char)[0] in "PSZ" else char
+        for char in text
+        if unicodedata.category(char) != "Cf"
+    )
+    return " ".join(text.split())
+
+
+def record_text(text):
+    """เนื้อหาของ record (instruction/input/output) โดยไม่รวม preamble และ marker ของ template"""
+    return normalize_for_dedup(" ".join(parse_example(text)))
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def minhash(text, size=SHINGLE_SIZE):
+    """MinHash signature (uint32 จำนวน NUM_PERM ค่า) ของ shingle ใน text"""
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text, size)), dtype=np.uint64
+    )
+    values = (hashes[None, :] * _PERM_A[:, None] + _PERM_B[:, None]) >> np.uint64(32)
+    return values.min(axis=1).astype(np.uint32)
+
+
+def dedup_features(examples, tokenizer=None, with_minhash=True):
+    """
+    คำนวณ feature สำหรับ deduplicate (ใช้กับ dataset.map แบบ batched)
+
+    Returns:
+        dedup_hash, minhash (ถ้า with_minhash) และ num_tokens (ถ้ามี tokenizer)
+    """
+    features = {}
+    if with_minhash:
+        texts = [record_text(text) for text in examples["text"]]
+        features["dedup_hash"] = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest() for text in texts]
+        features["minhash"] = [minhash(text) for text in texts]
+    if tokenizer is not None:
+        features["num_tokens"] = [len(ids) for ids in tokenizer(examples["text"])["input_ids"]]
+    return features
+
+
+class LSHIndex:
+    """
+    index ของ exact hash และ LSH band ของ MinHash signature บน sqlite
+
+    Args:
+        path: ไฟล์ sqlite (None = ไฟล์ชั่วคราวที่ถูกลบเมื่อ close)
+        num_bands: จำนวน band (NUM_PERM ต้องหารลงตัว)
+    """
+
+    def __init__(self, path=None, num_bands=NUM_BANDS):
+        if NUM_PERM % num_bands:
+            raise ValueError(f"num_bands ต้องหาร {NUM_PERM} ลงตัว")
+        self.num_bands = num_bands
+        self.rows = NUM_PERM // num_bands
+        self.tempdir = None
+        if path is None:
+            self.tempdir = tempfile.TemporaryDirectory(prefix="dedup_index_")
+            path = os.path.join(self.tempdir.name, "index.sqlite")
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        # index ที่เหลือจากรอบก่อนใช้ไม่ได้ (id คือตำแหน่ง record ของ dataset รอบนั้น)
+        for table in ("exact", "buckets", "signatures"):
+            self.db.execute(f"DROP TABLE IF EXISTS {table}")
+        self.db.execute("CREATE TABLE exact (hash TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.execute(
+            "CREATE TABLE buckets (band INTEGER, key INTEGER, id INTEGER, PRIMARY KEY (band, key, id)) WITHOUT ROWID"
+        )
+        self.db.execute("CREATE TABLE signatures (id INTEGER PRIMARY KEY, minhash BLOB NOT NULL)")
+
+    def band_keys(self, signature):
+        return [
+            int.from_bytes(
+                hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8).digest(),
+                "little",
+                signed=True,
+            )
+            for band in range(self.num_bands)
+        ]
+
+    def seen_hashes(self, hashes):
+        placeholders = ",".join("?" * len(hashes))
+        return {row[0] for row in self.db.execute(f"SELECT hash FROM exact WHERE hash IN ({placeholders})", hashes)}
+
+    def bucket_members(self, band, keys):
+        """{key: [id, ...]} ของ bucket ใน band ที่มีอยู่แล้ว"""
+        members = {}
+        placeholders = ",".join("?" * len(keys))
+        for key, record_id in self.db.execute(
+            f"SELECT key, id FROM buckets WHERE band = ? AND key IN ({placeholders})", [band, *keys]
+        ):
+            members.setdefault(key, []).append(record_id)
+        return members
+
+    def signatures(self, ids):
+        placeholders = ",".join("?" * len(ids))
+        return {
+            record_id: np.frombuffer(blob, dtype=np.uint32)
+            for record_id, blob in self.db.execute(
+                f"SELECT id, minhash FROM signatures WHERE id IN ({placeholders})", list(ids)
+            )
+        }
+
+    def add(self, hashes, entries):
+        """
+        Args:
+            hashes: exact hash ของ record ที่เก็บไว้
+            entries: list ของ (id, signature, band_keys)
+        """
+        self.db.executemany("INSERT OR IGNORE INTO exact (hash) VALUES (?)", [(h,) for h in hashes])
+        self.db.executemany(
+            "INSERT OR IGNORE INTO buckets (band, key, id) VALUES (?, ?, ?)",
+            [(band, key, record_id) for record_id, _, keys in entries for band, key in enumerate(keys)],
+        )
+        self.db.executemany(
+            "INSERT INTO signatures (id, minhash) VALUES (?, ?)",
+            [(record_id, signature.tobytes()) for record_id, signature, _ in entries],
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+        if self.tempdir is not None:
+            self.tempdir.cleanup()
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            # root เป็น id ที่น้อยกว่า (record แรกของกลุ่ม)
+            self.parent[max(a, b)] = min(a, b)
+
+
+def deduplicate(features, threshold=0.8, group_threshold=0.5, max_tokens=None, index_path=None,
+                num_bands=NUM_BANDS, batch_size=1000):
+    """
+    เลือก record ที่เก็บไว้ตามลำดับเดิม (record แรกของชุดที่ซ้ำกันถูกเก็บ)
+
+    Args:
+        features: dataset ที่มี column จาก dedup_features (ไม่มี dedup_hash = ไม่ deduplicate)
+        threshold: Jaccard ขั้นต่ำที่ถือว่าเป็น near duplicate
+        group_threshold: Jaccard ขั้นต่ำที่ record ที่เก็บไว้ถูกรวมกลุ่มเดียวกันสำหรับ group_split
+        max_tokens: ตัด record ที่มี token เกินนี้ (ต้องมี column num_tokens)
+        index_path: ไฟล์ sqlite ของ LSH index (None = ไฟล์ชั่วคราว)
+
+    Returns:
+        (keep, groups, report): ตำแหน่ง record ที่เก็บไว้, id กลุ่มของแต่ละ record ที่เก็บไว้ และสถิติ
+    """
+    with_minhash = "dedup_hash" in features.column_names
+    with_tokens = "num_tokens" in features.column_names
+    columns = [name for name in ("dedup_hash", "minhash", "num_tokens") if name in features.column_names]
+
+    removed = {TOO_LONG: 0, EXACT_DUPLICATE: 0, NEAR_DUPLICATE: 0}
+    tokens_removed = {TOO_LONG: 0, EXACT_DUPLICATE: 0, NEAR_DUPLICATE: 0}
+    tokens_in = 0
+    keep = []
+    groups = UnionFind(len(features))
+    index = LSHIndex(index_path, num_bands) if with_minhash else None
+
+    try:
+        offset = 0
+        for batch in features.select_columns(columns).with_format("numpy").iter(batch_size=batch_size):
+            size = len(batch[columns[0]])
+            num_tokens = batch["num_tokens"] if with_tokens else np.zeros(size, dtype=np.int64)
+            tokens_in += int(num_tokens.sum())
+
+            if with_minhash:
+                hashes = [str(h) for h in batch["dedup_hash"]]
+                signatures = [np.asarray(signature, dtype=np.uint32) for signature in batch["minhash"]]
+                seen = index.seen_hashes(hashes)
+                keys = [index.band_keys(signature) for signature in signatures]
+                # bucket ที่มีอยู่ใน index ต่อ band และ record ของ batch นี้ที่เพิ่งเก็บ (ยังไม่ได้เขียนลง index)
+                members = [index.bucket_members(band, [k[band] for k in keys]) for band in range(num_bands)]
+                pending = {}
+                pending_hashes = []
+                pending_entries = []
+
+            for row in range(size):
+                record_id = offset + row
+                tokens = int(num_tokens[row])
+                if max_tokens is not None and tokens > max_tokens:
+                    removed[TOO_LONG] += 1
+                    tokens_removed[TOO_LONG] += tokens
+                    continue
+                if not with_minhash:
+                    keep.append(record_id)
+                    continue
+
+                if hashes[row] in seen:
+                    removed[EXACT_DUPLICATE] += 1
+                    tokens_removed[EXACT_DUPLICATE] += tokens
+                    continue
+
+                candidates = set()
+                for band, key in enumerate(keys[row]):
+                    candidates.update(members[band].get(key, ()))
+                    candidates.update(pending.get((band, key), ()))
+                known = {
+                    candidate: signature for candidate, signature, _ in pending_entries if candidate in candidates
+                }
+                stored = candidates.difference(known)
+                if stored:
+                    known.update(index.signatures(stored))
+                similarity = {
+                    candidate: float(np.mean(signature == signatures[row])) for candidate, signature in known.items()
+                }
+                if similarity and max(similarity.values()) >= threshold:
+                    removed[NEAR_DUPLICATE] += 1
+                    tokens_removed[NEAR_DUPLICATE] += tokens
+                    continue
+
+                keep.append(record_id)
+                seen.add(hashes[row])
+                pending_hashes.append(hashes[row])
+                pending_entries.append((record_id, signatures[row], keys[row]))
+                for band, key in enumerate(keys[row]):
+                    pending.setdefault((band, key), []).append(record_id)
+                for candidate, value in similarity.items():
+                    if value >= group_threshold:
+                        groups.union(candidate, record_id)
+
+            if with_minhash and pending_entries:
+                index.add(pending_hashes, pending_entries)
+            offset += size
+    finally:
+        if index is not None:
+            index.close()
+
+    keep = np.asarray(keep, dtype=np.int64)
+    group_ids = np.asarray([groups.find(record_id) for record_id in keep], dtype=np.int64)
+    group_sizes = np.unique(group_ids, return_counts=True)[1]
+    report = {
+        "records_in": len(features),
+        "records_out": len(keep),
+        "records_removed": dict(removed),
+        "groups": int(len(group_sizes)),
+        # union-find แบบ single linkage ต่อ record ที่คล้ายกันเป็นทอด ๆ กลุ่มจึงใหญ่มากได้
+        "largest_group": int(group_sizes.max()) if len(group_sizes) else 0,
+    }
+    if with_tokens:
+        report["tokens_in"] = tokens_in
+        report["tokens_removed"] = dict(tokens_removed)
+        report["tokens_removed_total"] = sum(tokens_removed.values())
+        report["tokens_out"] = tokens_in - report["tokens_removed_total"]
+    return keep, group_ids, report
+
+
+def group_split(groups, test_size=0.1, seed=42):
+    """
+    แบ่ง train/test ทีละกลุ่ม (กลุ่มเดียวกันอยู่ฝั่งเดียวกันเสมอ)
+
+    สุ่มลำดับกลุ่มแล้วใส่กลุ่มที่ยังไม่ทำให้ test เกิน test_size ของ record จนเต็ม
+    กลุ่มที่ใส่แล้วเกินถูกข้ามไปอยู่ใน train (กลุ่มใหญ่จาก union-find จึงไม่ทำให้ test บวม)
+    ถ้าไม่มีกลุ่มไหนใส่ได้เลย test เป็นกลุ่มที่เล็กที่สุด (เมื่อมีมากกว่าหนึ่งกลุ่ม)
+    ตำแหน่งใน split ถูกสุ่มลำดับเหมือน train_test_split
+
+    Returns:
+        (train_positions, test_positions): ตำแหน่งใน groups
+    """
+    rng = np.random.default_rng(seed)
+    unique, inverse, counts = np.unique(groups, return_inverse=True, return_counts=True)
+    order = rng.permutation(len(unique))
+    n_test = int(np.ceil(test_size * len(groups)))
+    chosen = []
+    total = 0
+    for group in order:
+        if total >= n_test:
+            break
+        if total + counts[group] <= n_test:
+            chosen.append(group)
+            total += counts[group]
+    if not chosen and n_test and len(unique) > 1:
+        chosen.append(int(np.argmin(counts)))
+    is_test = np.isin(inverse, chosen)
+    train_positions = rng.permutation(np.flatnonzero(~is_test))
+    test_positions = rng.permutation(np.flatnonzero(is_test))
+    return train_positions, test_positions
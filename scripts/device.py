@@ -0,0 +1,154 @@
+"""
+ไฟล์สำหรับเลือก device และโหลดโมเดล + LoRA adapter ตาม device/precision
+
+CUDA: int8 (bitsandbytes), fp16, bf16, fp32
+CPU: fp32, bf16 (weights เป็น bfloat16) หรือ int8 (PyTorch dynamic quantization ของ nn.Linear)
+
+โมเดลที่ merge adapter แล้ว (จาก 05_export_merged_model.py) โหลดจาก safetensors แบบ memory-map ได้โดยตรง
+"""
+import os
+import time
+import warnings
+
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM
+
+PRECISIONS = {
+    "cuda": ("int8", "fp16", "bf16", "fp32"),
+    "cpu": ("int8", "bf16", "fp32"),
+}
+
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+# ไฟล์ที่ 05_export_merged_model.py เขียนไว้ใน directory ของโมเดลที่ merge แล้ว
+MERGED_MODEL_META = "merged_model_meta.json"
+
+
+def is_merged_model(path):
+    """path เป็นโมเดลที่ export จาก 05_export_merged_model.py หรือไม่"""
+    return path is not None and os.path.isfile(os.path.join(path, MERGED_MODEL_META))
+
+
+def resolve_model_paths(base_model_name, adapter_path):
+    """
+    ถ้า adapter_path เป็นโมเดลที่ merge แล้ว ให้โหลด directory นั้นแทนโมเดลฐาน + adapter
+
+    Returns:
+        (model_path, adapter_path) โดย adapter_path เป็น None เมื่อไม่ต้องสร้าง PeftModel
+    """
+    if is_merged_model(adapter_path):
+        return adapter_path, None
+    return base_model_name, adapter_path
+
+
+def resolve_device(device="auto"):
+    """'auto' = cuda ถ้ามี GPU ไม่เช่นนั้น cpu"""
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    if device not in PRECISIONS:
+        raise ValueError(f"device ต้องเป็น auto, cuda หรือ cpu (ได้ {device!r})")
+    return device
+
+
+def resolve_precision(device, precision="auto"):
+    """'auto' = fp16 บน cuda, fp32 บน cpu"""
+    if precision in (None, "auto"):
+        return "fp16" if device == "cuda" else "fp32"
+    if precision not in PRECISIONS[device]:
+        raise ValueError(f"precision {precision!r} ใช้กับ {device} ไม่ได้ (เลือกจาก {PRECISIONS[device]})")
+    return precision
+
+
+def quantize_linear_int8(model):
+    """
+    Dynamic int8 quantization ของ nn.Linear ทุกตัวยกเว้น lm_head (weights int8, activation quantize ตอนรัน)
+
+    ใช้ torchao ถ้าติดตั้งไว้ ไม่เช่นนั้นใช้ torch.ao.quantization.quantize_dynamic
+    """
+    output_embeddings = model.get_output_embeddings()
+    try:
+        from torchao.quantization import Int8DynamicActivationInt8WeightConfig, quantize_
+
+        quantize_(model, Int8DynamicActivationInt8WeightConfig(),
+                  filter_fn=lambda module, name: isinstance(module, torch.nn.Linear) and module is not output_embeddings)
+        return model
+    except ImportError:
+        pass
+
+    with warnings.catch_warnings():
+        # torch.ao.quantization ถูก deprecate เพื่อย้ายไป torchao แต่ยังใช้ได้
+        warnings.simplefilter("ignore")
+        for _, child in model.named_children():
+            if child is not output_embeddings:
+                torch.ao.quantization.quantize_dynamic(child, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def load_model(base_model_name, adapter_path, device="auto", precision="auto", num_threads=None,
+               compile_model=False, merge_adapter=False):
+    """
+    โหลดโมเดลฐาน + LoRA adapter ตาม device/precision
+
+    adapter_path=None คือโหลด base_model_name อย่างเดียว (เช่นโมเดลที่ merge แล้ว) ด้วย safetensors
+    แบบ memory-map และ low_cpu_mem_usage ไม่ต้องสร้าง PeftModel
+
+    Args:
+        device: auto, cuda หรือ cpu
+        precision: auto, int8, fp16, bf16, fp32 (int8 บน CPU จะ merge adapter แล้ว quantize)
+        num_threads: จำนวน intra-op thread ของ PyTorch บน CPU (None = ค่า default)
+        compile_model: ครอบ forward ด้วย torch.compile
+        merge_adapter: merge LoRA เข้า weights ของโมเดลฐาน (เร็วขึ้นแต่สลับ adapter ไม่ได้)
+
+    Returns:
+        (model, info) โดย info เป็น dict: device, precision, num_threads, compiled, merged, load_seconds
+    """
+    start_time = time.perf_counter()
+    device = resolve_device(device)
+    precision = resolve_precision(device, precision)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if device == "cuda":
+        model_kwargs = {"device_map": "auto"}
+        if precision == "int8":
+            from transformers import BitsAndBytesConfig
+            model_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+            model_kwargs["torch_dtype"] = torch.float16
+        else:
+            model_kwargs["torch_dtype"] = DTYPES[precision]
+    else:
+        # int8 บน CPU โหลดเป็น fp32 ก่อนแล้วค่อย quantize
+        model_kwargs = {"torch_dtype": DTYPES.get(precision, torch.float32)}
+
+    if adapter_path is None:
+        # safetensors ถูก mmap จึงไม่ต้องอ่านทั้งไฟล์เข้า memory ก่อน และหลาย process ใช้ page cache ร่วมกัน
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model_name, low_cpu_mem_usage=True, use_safetensors=True, **model_kwargs
+        )
+        merged = True
+    else:
+        base_model = AutoModelForCausalLM.from_pretrained(base_model_name, **model_kwargs)
+        model = PeftModel.from_pretrained(base_model, adapter_path)
+        merged = merge_adapter or (device == "cpu" and precision == "int8")
+        if merged:
+            model = model.merge_and_unload()
+    if device == "cpu" and precision == "int8":
+        model = quantize_linear_int8(model)
+    model.eval()
+
+    if compile_model:
+        target = model.get_base_model() if hasattr(model, "get_base_model") else model
+        target.forward = torch.compile(target.forward, dynamic=True)
+
+    info = {
+        "device": device,
+        "precision": precision,
+        "num_threads": torch.get_num_threads(),
+        "compiled": compile_model,
+        "merged": merged,
+        "load_seconds": time.perf_counter() - start_time,
+    }
+    print(f"Model loaded on {device} ({precision}, threads={info['num_threads']}, "
+          f"compiled={compile_model}) in {info['load_seconds']:.1f}s")
+    return model, info
@@ -0,0 +1,311 @@
+"""
+ไฟล์สำหรับคำนวณ metrics ของการประเมินแบบ incremental
+
+ModelEvaluator ส่งผลแต่ละ sample เข้ามาระหว่างที่ยัง generate อยู่ ROUGE และ BLEU sufficient statistics
+คำนวณใน process pool ส่วนตัว engine เก็บเฉพาะตัวเลขของแต่ละ sample (ไม่เก็บข้อความ)
+ค่าที่ได้จาก compute() เท่ากับการคำนวณทีละ sample หลัง generate เสร็จทุกตัว
+"""
+import math
+import multiprocessing
+import os
+from collections import deque
+
+import numpy as np
+
+ROUGE_TYPES = ["rouge1", "rouge2", "rougeL"]
+
+# จำนวน worker process สูงสุดเมื่อไม่ระบุ num_proc
+# pool ถูก fork หลัง torch โหลดแล้ว (memory ของโมเดลและ thread pool ติดไปทุก process) จึงใช้ pool เล็ก
+DEFAULT_NUM_PROC = 4
+
+_worker_rouge = None
+_worker_bleu = None
+
+
+def _init_worker(use_rouge, use_bleu):
+    global _worker_rouge, _worker_bleu
+    if use_rouge:
+        from rouge_score import rouge_scorer
+        _worker_rouge = rouge_scorer.RougeScorer(ROUGE_TYPES, use_stemmer=True)
+    if use_bleu:
+        from sacrebleu.metrics import BLEU
+        _worker_bleu = BLEU()
+
+
+def score_chunk(pairs):
+    """
+    คำนวณ metrics ต่อ sample ของ chunk (รันใน worker process)
+
+    Args:
+        pairs: list ของ (expected_output, predicted_output)
+
+    Returns:
+        list ของ dict: pred_length, expected_length, rouge (list ของ fmeasure หรือ None), bleu_stats
+    """
+    scored = []
+    for expected, predicted in pairs:
+        item = {
+            "pred_length": len(predicted.split()),
+            "expected_length": len(expected.split()),
+            "rouge": None,
+            "bleu_stats": None,
+        }
+        if _worker_rouge is not None:
+            scores = _worker_rouge.score(expected, predicted)
+            item["rouge"] = [scores[name].fmeasure for name in ROUGE_TYPES]
+        if _worker_bleu is not None:
+            # sufficient statistics ของ sample นี้: [sys_len, ref_len, matches ต่อ n-gram..., totals ต่อ n-gram...]
+            score = _worker_bleu.corpus_score([predicted], [[expected]])
+            item["bleu_stats"] = [score.sys_len, score.ref_len, *score.counts, *score.totals]
+        scored.append(item)
+    return scored
+
+
+def corpus_bleu(stats):
+    """corpus BLEU จากผลรวม sufficient statistics ของทุก sample (None = ไม่มี sample ได้ 0)"""
+    if stats is None:
+        return 0.0
+    from sacrebleu.metrics import BLEU
+    bleu = BLEU()
+    order = bleu.max_ngram_order
+    stats = [int(value) for value in stats]
+    return BLEU.compute_bleu(
+        correct=stats[2:2 + order],
+        total=stats[2 + order:2 + 2 * order],
+        sys_len=stats[0],
+        ref_len=stats[1],
+        smooth_method=bleu.smooth_method,
+        smooth_value=bleu.smooth_value,
+        effective_order=bleu.effective_order,
+        max_ngram_order=order,
+    ).score
+
+
+def perplexity_stats(values):
+    """
+    สถิติ perplexity ไม่นับแถวที่ไม่มี token ให้คิด (nan เช่น response ถูกตัดหมดตอน truncate)
+    perplexity_unscored คือจำนวนแถวที่ไม่นับ
+    """
+    values = np.asarray(values, dtype=np.float64)
+    scored = values[~np.isnan(values)]
+    if not len(scored):
+        stats = {name: float("nan") for name in ("avg_perplexity", "std_perplexity", "min_perplexity", "max_perplexity")}
+    else:
+        stats = {
+            "avg_perplexity": np.mean(scored),
+            "std_perplexity": np.std(scored),
+            "min_perplexity": np.min(scored),
+            "max_perplexity": np.max(scored),
+        }
+    stats["perplexity_unscored"] = int(len(values) - len(scored))
+    return stats
+
+
+class RunningStat:
+    """mean/std แบบ running (Welford) สำหรับรายงานระหว่างทาง"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+
+class MetricsEngine:
+    """
+    รวม metrics ของการประเมินทีละ sample
+
+    เก็บค่าต่อ sample เป็น numpy array ขนาดคงที่ (ตามลำดับ sample_id) เพื่อให้ค่าเฉลี่ยสุดท้าย
+    และ bootstrap ได้ผลตรงกับการคำนวณจาก list ของ results
+    BLEU เก็บเฉพาะผลรวมของ n-gram statistics จึงเท่ากับ corpus BLEU
+    """
+
+    def __init__(self, num_samples, num_proc=None, chunk_size=32, bootstrap_samples=1000, confidence=0.95, seed=42):
+        self.num_samples = num_samples
+        self.num_proc = num_proc if num_proc is not None else min(DEFAULT_NUM_PROC, os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.bootstrap_samples = bootstrap_samples
+        self.confidence = confidence
+        self.seed = seed
+
+        try:
+            import rouge_score  # noqa: F401
+            self.use_rouge = True
+        except ImportError:
+            self.use_rouge = False
+        try:
+            import sacrebleu  # noqa: F401
+            self.use_bleu = True
+        except ImportError:
+            self.use_bleu = False
+
+        self.perplexity = np.full(num_samples, np.nan)
+        self.pred_length = np.zeros(num_samples, dtype=np.int64)
+        self.expected_length = np.zeros(num_samples, dtype=np.int64)
+        self.rouge = {name: np.full(num_samples, np.nan) for name in ROUGE_TYPES}
+        self.bleu_stats = None
+        self.completed = np.zeros(num_samples, dtype=bool)
+        self.running = {name: RunningStat() for name in ["perplexity"] + ROUGE_TYPES}
+
+        self.pending_ids = []
+        self.pending_pairs = []
+        self.in_flight = deque()
+        self.pool = None
+        if self.num_proc > 1:
+            self.pool = multiprocessing.Pool(
+                self.num_proc, initializer=_init_worker, initargs=(self.use_rouge, self.use_bleu)
+            )
+        else:
+            _init_worker(self.use_rouge, self.use_bleu)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, sample_id, expected_output, predicted_output, perplexity):
+        """ส่งผลของ sample หนึ่งตัวเข้า engine (คำนวณจริงเมื่อครบ chunk)"""
+        self.perplexity[sample_id] = np.nan if perplexity is None else perplexity
+        if perplexity is not None and not math.isnan(perplexity):
+            self.running["perplexity"].add(perplexity)
+        self.pending_ids.append(sample_id)
+        self.pending_pairs.append((expected_output, predicted_output))
+        if len(self.pending_pairs) >= self.chunk_size:
+            self._submit()
+
+    def _submit(self):
+        if not self.pending_pairs:
+            return
+        ids, pairs = self.pending_ids, self.pending_pairs
+        self.pending_ids, self.pending_pairs = [], []
+        if self.pool is None:
+            self._collect(ids, score_chunk(pairs))
+            return
+        self.in_flight.append((ids, self.pool.apply_async(score_chunk, (pairs,))))
+        # เก็บผลของ chunk ที่เสร็จแล้ว ไม่รอ chunk ที่ยังคำนวณอยู่
+        while self.in_flight and self.in_flight[0][1].ready():
+            ids, result = self.in_flight.popleft()
+            self._collect(ids, result.get())
+
+    def _collect(self, ids, scored):
+        for sample_id, item in zip(ids, scored):
+            self.pred_length[sample_id] = item["pred_length"]
+            self.expected_length[sample_id] = item["expected_length"]
+            if item["rouge"] is not None:
+                for name, value in zip(ROUGE_TYPES, item["rouge"]):
+                    self.rouge[name][sample_id] = value
+                    self.running[name].add(value)
+            if item["bleu_stats"] is not None:
+                stats = np.asarray(item["bleu_stats"], dtype=np.int64)
+                self.bleu_stats = stats if self.bleu_stats is None else self.bleu_stats + stats
+            self.completed[sample_id] = True
+
+    def flush(self):
+        """รอให้ทุก chunk ที่ส่งไปคำนวณเสร็จ"""
+        self._submit()
+        while self.in_flight:
+            ids, result = self.in_flight.popleft()
+            self._collect(ids, result.get())
+
+    def truncate(self, num_samples):
+        """เหลือเฉพาะ num_samples ตำแหน่งแรก (การประเมินที่หยุดก่อนใช้ครบทุกตำแหน่ง)"""
+        self.flush()
+        self.num_samples = num_samples
+        self.perplexity = self.perplexity[:num_samples]
+        self.pred_length = self.pred_length[:num_samples]
+        self.expected_length = self.expected_length[:num_samples]
+        self.rouge = {name: values[:num_samples] for name, values in self.rouge.items()}
+        self.completed = self.completed[:num_samples]
+
+    def running_summary(self):
+        """mean/std ของ sample ที่คำนวณเสร็จแล้ว (สำหรับแสดงระหว่าง generate)"""
+        summary = {"samples_scored": int(self.completed.sum())}
+        for name, stat in self.running.items():
+            if stat.count:
+                summary[f"{name}_mean"] = stat.mean
+                summary[f"{name}_std"] = stat.std
+        return summary
+
+    def compute(self):
+        """
+        metrics ชุดเดียวกับ ModelEvaluator.calculate_metrics (ไม่มี sample: ค่าเป็น 0)
+        """
+        self.flush()
+        if not self.num_samples:
+            metrics = {name: 0.0 for name in (
+                "avg_perplexity", "std_perplexity", "min_perplexity", "max_perplexity",
+                "avg_pred_length", "avg_expected_length",
+            )}
+            metrics["perplexity_unscored"] = 0
+            metrics["bleu_score"] = 0.0 if self.use_bleu else None
+            metrics.update({name: 0.0 if self.use_rouge else None for name in ROUGE_TYPES})
+            return metrics
+        metrics = {
+            **perplexity_stats(self.perplexity),
+            "avg_pred_length": np.mean(self.pred_length),
+            "avg_expected_length": np.mean(self.expected_length),
+        }
+
+        if self.use_bleu:
+            metrics["bleu_score"] = corpus_bleu(self.bleu_stats)
+        else:
+            print("Warning: sacrebleu not installed. Skipping BLEU score calculation.")
+            metrics["bleu_score"] = None
+
+        if self.use_rouge:
+            for name in ROUGE_TYPES:
+                metrics[name] = np.mean(self.rouge[name])
+        else:
+            print("Warning: rouge-score not installed. Skipping ROUGE score calculation.")
+            for name in ROUGE_TYPES:
+                metrics[name] = None
+
+        return metrics
+
+    def confidence_intervals(self):
+        """
+        std และ bootstrap confidence interval ของค่าเฉลี่ย perplexity และ ROUGE (ไม่มี sample: dict ว่าง)
+        perplexity ที่เป็น nan (ไม่มี token ให้คิด) ไม่ถูกนับ
+        """
+        self.flush()
+        if not self.num_samples:
+            return {}
+        columns = {"perplexity": self.perplexity[~np.isnan(self.perplexity)]}
+        if self.use_rouge:
+            columns.update(self.rouge)
+
+        rng = np.random.default_rng(self.seed)
+        alpha = (1.0 - self.confidence) / 2
+        intervals = {}
+        for name, values in columns.items():
+            size = len(values)
+            if not size:
+                continue
+            # resample ทีละช่วง memory จึงไม่โตตาม bootstrap_samples x num_samples
+            means = []
+            step = max(1, (1 << 22) // size)
+            for start in range(0, self.bootstrap_samples, step):
+                count = min(step, self.bootstrap_samples - start)
+                indices = rng.integers(0, size, size=(count, size))
+                means.append(values[indices].mean(axis=1))
+            means = np.concatenate(means)
+            intervals[f"{name}_std"] = float(np.std(values))
+            intervals[f"{name}_ci_low"] = float(np.quantile(means, alpha))
+            intervals[f"{name}_ci_high"] = float(np.quantile(means, 1.0 - alpha))
+        return intervals
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
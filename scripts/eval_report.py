@@ -0,0 +1,182 @@
+"""
+ไฟล์สำหรับสรุปและบันทึกผลการประเมิน (metrics summary, CSV/JSON/report)
+
+ไม่ import torch/transformers จึงใช้คำนวณ metrics ใหม่จากผลที่บันทึกไว้ได้โดยไม่ต้องโหลดโมเดล
+(ไฟล์ CSV จาก save_results หรือ JSONL จาก result log)
+"""
+import csv
+import itertools
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from eval_metrics import MetricsEngine, perplexity_stats
+from result_log import LoggedResults, read_log_index
+
+
+def load_saved_results(path, fingerprint=None):
+    """
+    โหลดผลการประเมินที่บันทึกไว้
+
+    Args:
+        path: *_results_*.csv จาก save_results หรือ result log (.jsonl)
+        fingerprint: ของ result log (None = การประเมินครั้งล่าสุดใน log)
+
+    Returns:
+        list ของ results (CSV) หรือ LoggedResults (JSONL)
+    """
+    if path.endswith(".jsonl"):
+        fingerprint, offsets = read_log_index(path, fingerprint)
+        if not offsets:
+            raise ValueError(f"ไม่พบผลใน {path} (fingerprint={fingerprint})")
+        print(f"Loaded {len(offsets)} results from {path} (fingerprint {fingerprint})")
+        return LoggedResults(path, offsets)
+
+    results = []
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            row["sample_id"] = int(row["sample_id"])
+            row["perplexity"] = float(row["perplexity"])
+            results.append(row)
+    print(f"Loaded {len(results)} results from {path}")
+    return results
+
+
+def perplexity_metrics(results):
+    """
+    คำนวณสถิติ perplexity (ใช้ได้กับผลจาก score_dataset ที่ไม่มี predicted_output)
+    """
+    return perplexity_stats([r["perplexity"] for r in results])
+
+
+def recompute_metrics(results, num_proc=None):
+    """
+    คำนวณ metrics ใหม่จากผลที่บันทึกไว้ (ชุดเดียวกับ streaming metrics ของ evaluate_on_dataset รวม confidence interval)
+
+    ผลที่ไม่มี predicted_output (perplexity only) จะได้เฉพาะสถิติ perplexity
+    """
+    first = next(iter(results), None)
+    if first is None:
+        raise ValueError("ไม่มีผลการประเมินให้คำนวณ metrics")
+    if "predicted_output" not in first:
+        return perplexity_metrics(results)
+    with MetricsEngine(len(results), num_proc=num_proc) as engine:
+        for idx, result in enumerate(results):
+            engine.add(idx, result["expected_output"], result["predicted_output"], result["perplexity"])
+        metrics = engine.compute()
+        metrics.update(engine.confidence_intervals())
+    return metrics
+
+
+def print_metrics_summary(metrics):
+    """
+    แสดงสรุป metrics
+    """
+    print("\n" + "="*80)
+    print("EVALUATION METRICS SUMMARY")
+    print("="*80)
+
+    print(f"\nPerplexity:")
+    print(f"  Average: {metrics['avg_perplexity']:.4f}")
+    print(f"  Std Dev: {metrics['std_perplexity']:.4f}")
+    print(f"  Min: {metrics['min_perplexity']:.4f}")
+    print(f"  Max: {metrics['max_perplexity']:.4f}")
+    if "perplexity_ci_low" in metrics:
+        print(f"  95% CI (bootstrap): [{metrics['perplexity_ci_low']:.4f}, {metrics['perplexity_ci_high']:.4f}]")
+    if metrics.get("perplexity_unscored"):
+        print(f"  Not scored (no response tokens after truncation): {metrics['perplexity_unscored']}")
+
+    if "avg_pred_length" in metrics:
+        print(f"\nResponse Length:")
+        print(f"  Avg Predicted: {metrics['avg_pred_length']:.2f} words")
+        print(f"  Avg Expected: {metrics['avg_expected_length']:.2f} words")
+
+    if metrics.get('bleu_score'):
+        print(f"\nBLEU Score: {metrics['bleu_score']:.4f}")
+
+    if metrics.get('rouge1'):
+        print(f"\nROUGE Scores:")
+        print(f"  ROUGE-1: {metrics['rouge1']:.4f}")
+        print(f"  ROUGE-2: {metrics['rouge2']:.4f}")
+        print(f"  ROUGE-L: {metrics['rougeL']:.4f}")
+        if "rougeL_ci_low" in metrics:
+            print(f"  ROUGE-L 95% CI (bootstrap): [{metrics['rougeL_ci_low']:.4f}, {metrics['rougeL_ci_high']:.4f}]")
+
+    if "adaptive_samples" in metrics:
+        print(f"\nAdaptive Evaluation:")
+        print(f"  Samples: {metrics['adaptive_samples']} of {metrics['adaptive_dataset_size']} "
+              f"({metrics['adaptive_fraction']:.1%}), stopped by {metrics['adaptive_stop_reason']}")
+        for name in ["perplexity", "rouge1", "rouge2", "rougeL"]:
+            if f"{name}_stratified_mean" in metrics:
+                print(f"  {name}: {metrics[f'{name}_stratified_mean']:.4f} "
+                      f"[{metrics[f'{name}_stratified_ci_low']:.4f}, {metrics[f'{name}_stratified_ci_high']:.4f}]")
+
+    print("="*80 + "\n")
+
+
+def save_results(output_dir, results, metrics, filename_prefix="evaluation"):
+    """
+    บันทึกผลการประเมิน (CSV ของทุก sample, metrics JSON และรายงานสรุป)
+
+    results เป็น list หรือ LoggedResults จาก result log ก็ได้ (เขียน CSV ทีละ record ไม่โหลดทั้งหมดเข้า memory)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    # บันทึกผล results ทั้งหมด
+    results_file = os.path.join(output_dir, f"{filename_prefix}_results_{timestamp}.csv")
+    num_results = 0
+    with open(results_file, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = None
+        for result in results:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(result), lineterminator="\n")
+                writer.writeheader()
+            writer.writerow(result)
+            num_results += 1
+    print(f"\nResults saved to: {results_file}")
+
+    # บันทึก metrics
+    metrics_file = os.path.join(output_dir, f"{filename_prefix}_metrics_{timestamp}.json")
+    with open(metrics_file, 'w', encoding='utf-8') as f:
+        json.dump(metrics, f, indent=2, ensure_ascii=False)
+    print(f"Metrics saved to: {metrics_file}")
+
+    # สร้างรายงานสรุป
+    report_file = os.path.join(output_dir, f"{filename_prefix}_report_{timestamp}.txt")
+    with open(report_file, 'w', encoding='utf-8') as f:
+        f.write("="*80 + "\n")
+        f.write("MODEL EVALUATION REPORT\n")
+        f.write("="*80 + "\n\n")
+        f.write(f"Evaluation Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"Number of Samples: {num_results}\n\n")
+
+        f.write("METRICS:\n")
+        f.write("-"*80 + "\n")
+        for key, value in metrics.items():
+            if value is not None:
+                if isinstance(value, float):
+                    f.write(f"{key}: {value:.4f}\n")
+                else:
+                    f.write(f"{key}: {value}\n")
+
+        f.write("\n" + "="*80 + "\n")
+        f.write("SAMPLE PREDICTIONS\n")
+        f.write("="*80 + "\n\n")
+
+        # เพิ่มตัวอย่าง 5 samples
+        for i, result in enumerate(itertools.islice(results, 5)):
+            f.write(f"\n--- Sample {i+1} ---\n")
+            f.write(f"Instruction: {result['instruction']}\n")
+            f.write(f"Input: {result['input']}\n")
+            f.write(f"Expected: {result['expected_output']}\n")
+            if "predicted_output" in result:
+                f.write(f"Predicted: {result['predicted_output']}\n")
+            f.write(f"Perplexity: {result['perplexity']:.2f}\n")
+            f.write("-"*80 + "\n")
+
+    print(f"Report saved to: {report_file}")
+
+    return results_file, metrics_file, report_file
@@ -0,0 +1,186 @@
+"""
+ไฟล์สำหรับจับเวลาแต่ละช่วงของ generation (tokenize, prefill, decode, detokenize, postprocess)
+
+เก็บเป็น histogram แบบสะสม ส่งออกเป็น Prometheus text format หรือ JSON
+และมีโหมด torch.profiler trace สำหรับดู request เดียวแบบละเอียด
+"""
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+MEMORY_MB_BUCKETS = (0.25, 1, 4, 16, 64, 256, 1024, 4096)
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Histogram:
+    """Histogram แบบ Prometheus (bucket สะสม, sum, count)"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """คู่ (upper bound, จำนวนสะสม) รวม +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): total for bound, total in self.cumulative()},
+        }
+
+
+class Instrumentation:
+    """
+    Registry ของ histogram ของ generation
+
+    enabled=False ทำให้ phase() คืน context ว่าง (ต้นทุนเกือบศูนย์) ใช้เป็นค่า default ได้
+    ชื่อ phase ถูกเก็บเป็น histogram "<phase>_seconds"
+    """
+
+    def __init__(self, enabled=True, namespace="chatbot"):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.tracing = False
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            return histogram
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        if not self.enabled:
+            return
+        histogram = self.histogram(name, buckets)
+        with self.lock:
+            histogram.observe(value)
+
+    def phase(self, name):
+        """context manager จับเวลาช่วง name ด้วย monotonic clock"""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        label = torch.profiler.record_function(name) if self.tracing else _NULL_CONTEXT
+        start = time.perf_counter()
+        with label:
+            yield
+        self.observe(f"{name}_seconds", time.perf_counter() - start)
+
+    def step_timer(self):
+        """StoppingCriteria สำหรับ model.generate ที่จับเวลา prefill และแต่ละ decode step (None ถ้าปิดอยู่)"""
+        return GenerationStepTimer(self) if self.enabled else None
+
+    def record_request(self, prompt_tokens, generated_tokens, kv_cache_bytes=None):
+        """บันทึกจำนวน token และหน่วยความจำ KV cache ของ request หนึ่งตัว"""
+        self.observe("prompt_tokens", prompt_tokens, TOKEN_BUCKETS)
+        self.observe("generated_tokens", generated_tokens, TOKEN_BUCKETS)
+        if kv_cache_bytes is not None:
+            self.observe("kv_cache_mb", kv_cache_bytes / (1024 * 1024), MEMORY_MB_BUCKETS)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def to_dict(self):
+        with self.lock:
+            return {name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())}
+
+    def dump_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def to_prometheus(self):
+        """ข้อความตาม Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{self.namespace}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for bound, total in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f'{metric}_bucket{{le="{le}"}} {total}')
+                lines.append(f"{metric}_sum {histogram.sum!r}")
+                lines.append(f"{metric}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    @contextlib.contextmanager
+    def profile(self, trace_path):
+        """
+        รันโค้ดภายใต้ torch.profiler แล้วบันทึก Chrome trace ลง trace_path
+        แต่ละ phase จะปรากฏเป็น record_function ชื่อเดียวกันใน trace
+        """
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        enabled = self.enabled
+        self.enabled = True
+        self.tracing = True
+        try:
+            with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as profiler:
+                yield profiler
+        finally:
+            self.tracing = False
+            self.enabled = enabled
+        profiler.export_chrome_trace(trace_path)
+        print(f"Profiler trace saved to: {trace_path}")
+
+
+class GenerationStepTimer(StoppingCriteria):
+    """
+    StoppingCriteria ที่ไม่หยุด generate แต่จับเวลา
+
+    generate เรียก stopping criteria หลังได้ token ใหม่ทุก step ครั้งแรกคือจบ prefill
+    ครั้งถัดไปคือจบแต่ละ decode step
+    """
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.last_time = None
+        self.steps = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.perf_counter()
+        if self.last_time is None:
+            self.first_token_time = now
+            self.instrumentation.observe("prefill_seconds", now - self.start_time)
+        else:
+            self.instrumentation.observe("decode_step_seconds", now - self.last_time)
+        self.last_time = now
+        self.steps += 1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def finish(self):
+        """บันทึกเวลา decode ทั้งหมดหลัง prefill (เรียกหลัง generate จบ)"""
+        if self.first_token_time is not None:
+            self.instrumentation.observe("decode_seconds", time.perf_counter() - self.first_token_time)
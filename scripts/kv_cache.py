@@ -0,0 +1,102 @@
+"""
+Helper สำหรับจัดการ KV cache (DynamicCache) ของ transformers ระดับ tensor
+"""
+import torch
+from transformers import DynamicCache
+
+
+def cache_tensors(past_key_values):
+    """คืน list ของ (keys, values) ต่อ layer รูป [batch, heads, seq, head_dim]"""
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        return [(layer.keys, layer.values) for layer in layers]
+    return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+
+
+def build_cache(tensors):
+    """สร้าง DynamicCache ใหม่จาก list ของ (keys, values)"""
+    past_key_values = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(tensors):
+        past_key_values.update(keys, values, layer_idx)
+    return past_key_values
+
+
+def cache_nbytes(past_key_values):
+    """ขนาด (bytes) ของ tensor ทั้งหมดใน KV cache"""
+    return sum(
+        t.numel() * t.element_size()
+        for pair in cache_tensors(past_key_values)
+        for t in pair
+        if t is not None
+    )
+
+
+def kv_bytes_per_token(model):
+    """ขนาด KV cache (bytes) ต่อ token ต่อแถว คำนวณจาก config ของโมเดล"""
+    config = model.config
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    element_size = torch.tensor([], dtype=model.dtype).element_size()
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * element_size
+
+
+def pad_cache_left(past_key_values, attention_mask, length):
+    """
+    เติม padding ด้านซ้ายของ cache และ attention_mask ให้ยาว length
+
+    Returns:
+        (past_key_values, attention_mask) ชุดใหม่
+    """
+    padding = length - attention_mask.shape[1]
+    if padding <= 0:
+        return past_key_values, attention_mask
+
+    tensors = [
+        (
+            torch.nn.functional.pad(keys, (0, 0, padding, 0)),
+            torch.nn.functional.pad(values, (0, 0, padding, 0)),
+        )
+        for keys, values in cache_tensors(past_key_values)
+    ]
+    attention_mask = torch.nn.functional.pad(attention_mask, (padding, 0))
+    return build_cache(tensors), attention_mask
+
+
+def concat_caches(first, first_mask, second, second_mask):
+    """
+    รวม cache สองชุดตามแกน batch (pad ซ้ายให้ความยาวเท่ากันก่อน)
+
+    Returns:
+        (past_key_values, attention_mask) ที่มี batch = batch ของ first + batch ของ second
+    """
+    length = max(first_mask.shape[1], second_mask.shape[1])
+    first, first_mask = pad_cache_left(first, first_mask, length)
+    second, second_mask = pad_cache_left(second, second_mask, length)
+
+    tensors = [
+        (torch.cat([k1, k2], dim=0), torch.cat([v1, v2], dim=0))
+        for (k1, v1), (k2, v2) in zip(cache_tensors(first), cache_tensors(second))
+    ]
+    return build_cache(tensors), torch.cat([first_mask, second_mask], dim=0)
+
+
+def select_rows(past_key_values, attention_mask, rows):
+    """
+    เลือกเฉพาะแถวที่ระบุ และตัดคอลัมน์ซ้ายที่ทุกแถวเป็น padding ทิ้ง
+
+    Returns:
+        (past_key_values, attention_mask) ชุดใหม่
+    """
+    index = torch.tensor(rows, device=attention_mask.device)
+    attention_mask = attention_mask.index_select(0, index)
+
+    # คอลัมน์ที่ไม่มีแถวไหน attend แล้ว ไม่ต้องเก็บไว้
+    used = attention_mask.sum(dim=0).nonzero()
+    start = int(used[0]) if len(used) else attention_mask.shape[1]
+
+    tensors = [
+        (keys.index_select(0, index)[:, :, start:], values.index_select(0, index)[:, :, start:])
+        for keys, values in cache_tensors(past_key_values)
+    ]
+    return build_cache(tensors), attention_mask[:, start:]
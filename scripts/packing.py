@@ -0,0 +1,124 @@
+"""
+ไฟล์สำหรับ sequence packing: รวมหลาย example ให้เต็ม max_length โดย attention ไม่ข้าม example
+"""
+import torch
+
+
+def pack_sequences(sequences, max_length):
+    """
+    จัด sequence ลง bin ขนาด max_length แบบ best-fit decreasing
+
+    Args:
+        sequences: list ของ list token id (ยาวไม่เกิน max_length)
+        max_length: ความยาวของแต่ละ packed sequence
+
+    Returns:
+        list ของ bin แต่ละ bin เป็น list ของ index ใน sequences
+    """
+    order = sorted(range(len(sequences)), key=lambda idx: len(sequences[idx]), reverse=True)
+
+    bins = []
+    # bins_by_space[space] = index ของ bin ที่เหลือที่ว่าง space token
+    bins_by_space = [[] for _ in range(max_length + 1)]
+    for idx in order:
+        length = len(sequences[idx])
+        for space in range(length, max_length + 1):
+            if bins_by_space[space]:
+                bin_idx = bins_by_space[space].pop()
+                break
+        else:
+            bin_idx = len(bins)
+            bins.append([])
+            space = max_length
+
+        bins[bin_idx].append(idx)
+        bins_by_space[space - length].append(bin_idx)
+
+    return bins
+
+
+def pack_examples(input_ids, max_length):
+    """
+    Pack token ของหลาย example เป็น row ละไม่เกิน max_length
+
+    Returns:
+        dict ของ list: input_ids, labels, position_ids, seq_lens
+        labels ของ token แรกของแต่ละ example เป็น -100 (ไม่ให้ทำนายข้าม example)
+    """
+    sequences = [ids[:max_length] for ids in input_ids if ids]
+    packed = {"input_ids": [], "labels": [], "position_ids": [], "seq_lens": []}
+
+    for bin_indices in pack_sequences(sequences, max_length):
+        row_ids, row_labels, row_positions, row_lens = [], [], [], []
+        for idx in bin_indices:
+            ids = sequences[idx]
+            row_ids.extend(ids)
+            row_labels.extend([-100] + ids[1:])
+            row_positions.extend(range(len(ids)))
+            row_lens.append(len(ids))
+        packed["input_ids"].append(row_ids)
+        packed["labels"].append(row_labels)
+        packed["position_ids"].append(row_positions)
+        packed["seq_lens"].append(row_lens)
+
+    return packed
+
+
+class PackedDataCollator:
+    """
+    Collator สำหรับ dataset ที่ pack แล้ว
+
+    สร้าง attention mask แบบ 4D (block-diagonal causal) ให้แต่ละ token เห็นเฉพาะ example ของตัวเอง
+    และ position_ids เริ่มนับใหม่ทุก example จึงได้ผลเท่ากับรันแต่ละ example แยกกัน
+    """
+
+    def __init__(self, tokenizer, dtype=torch.float32, pad_to_length=None):
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.dtype = dtype
+        self.pad_to_length = pad_to_length
+
+    def __call__(self, features):
+        length = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_length:
+            length = max(length, self.pad_to_length)
+
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, length), -100, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, length), dtype=torch.long)
+        # ค่า min ของ dtype = ห้าม attend, 0 = attend (รูปแบบเดียวกับ mask ภายในของ transformers)
+        attention_mask = torch.full((batch_size, 1, length, length), torch.finfo(self.dtype).min, dtype=self.dtype)
+
+        for row, feature in enumerate(features):
+            n = len(feature["input_ids"])
+            input_ids[row, :n] = torch.tensor(feature["input_ids"])
+            labels[row, :n] = torch.tensor(feature["labels"])
+            position_ids[row, :n] = torch.tensor(feature["position_ids"])
+
+            start = 0
+            for seq_len in feature["seq_lens"]:
+                end = start + seq_len
+                causal = torch.ones((seq_len, seq_len), dtype=torch.bool).tril()
+                attention_mask[row, 0, start:end, start:end].masked_fill_(causal, 0.0)
+                start = end
+            # padding ท้าย row ให้เห็นตัวเอง เพื่อไม่ให้ softmax ทั้งแถวเป็น -inf
+            padding = torch.arange(n, length)
+            attention_mask[row, 0, padding, padding] = 0.0
+
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask,
+        }
+
+
+def padding_stats(real_lengths, padded_lengths):
+    """สถิติ padding: จำนวน token จริง, token ทั้งหมดหลัง pad และสัดส่วน padding"""
+    real_tokens = int(sum(real_lengths))
+    total_tokens = int(sum(padded_lengths))
+    return {
+        "real_tokens": real_tokens,
+        "total_tokens": total_tokens,
+        "padding_ratio": 1.0 - real_tokens / total_tokens if total_tokens else 0.0,
+    }
@@ -0,0 +1,158 @@
+"""
+ไฟล์สำหรับ cache KV state ของ prompt prefix ที่ใช้ซ้ำ (เช่น preamble ของ Alpaca template)
+"""
+import copy
+from collections import OrderedDict
+
+import torch
+
+from kv_cache import cache_nbytes
+from prompt_template import PROMPT_PREAMBLE
+
+
+class PrefixCache:
+    """
+    เก็บ KV cache ของ prefix ที่ encode แล้ว ใช้ซ้ำข้าม request และข้ามแถวใน batch
+
+    จำกัดหน่วยความจำด้วย max_memory_mb และไล่ entry ที่ไม่ได้ใช้นานที่สุดออก (LRU)
+    LoRA ที่ q_proj/v_proj ทำให้ KV ต่างกันตาม adapter จึงเก็บแยกตาม adapter (ดู adapters.AdapterRegistry)
+    """
+
+    def __init__(self, model, tokenizer, max_memory_mb=256):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_reused = 0
+
+    def lookup(self, prefix, adapter=None):
+        """
+        คืน entry ของ prefix (คำนวณ KV ครั้งแรกที่เจอ)
+
+        Args:
+            adapter: ชื่อ adapter ของ PeftModel ที่ใช้คำนวณ KV (None = adapter ที่ active อยู่)
+
+        Returns:
+            dict: input_ids (1 x P), past_key_values, nbytes
+        """
+        key = (prefix, adapter)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.model.device)
+        adapter_kwargs = {"adapter_names": [adapter]} if adapter is not None else {}
+        with torch.no_grad():
+            outputs = self.model(input_ids=prefix_ids, use_cache=True, **adapter_kwargs)
+
+        entry = {
+            "input_ids": prefix_ids,
+            "past_key_values": outputs.past_key_values,
+            "nbytes": cache_nbytes(outputs.past_key_values),
+        }
+        if entry["nbytes"] <= self.max_memory_bytes:
+            self.entries[key] = entry
+            self.memory_bytes += entry["nbytes"]
+            self._evict()
+        return entry
+
+    def discard_adapter(self, adapter):
+        """ลบ entry ที่คำนวณด้วย adapter นี้ (เมื่อ adapter ถูก unload หรือเปลี่ยน weights)"""
+        for key in [key for key in self.entries if key[1] == adapter]:
+            self.memory_bytes -= self.entries.pop(key)["nbytes"]
+
+    def _evict(self):
+        while self.memory_bytes > self.max_memory_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.memory_bytes -= entry["nbytes"]
+            self.evictions += 1
+
+    def prepare_inputs(self, prompts, prefix=PROMPT_PREAMBLE, max_length=None, adapter=None):
+        """
+        Tokenize prompts และแนบ KV cache ของ prefix สำหรับ model.generate
+
+        ทุกแถวเริ่มด้วย prefix ตำแหน่งเดียวกัน แล้วตามด้วย padding และส่วนที่เหลือของ prompt
+        (pad ตรงกลาง, attention_mask = 0) position_ids ที่ generate คำนวณจาก attention_mask
+        จึงต่อเนื่องจาก prefix เหมือน prompt ที่ไม่มี padding
+        ทุกแถวต้องใช้ adapter เดียวกัน (KV ของ prefix คำนวณด้วย adapter นั้น)
+
+        Returns:
+            dict: input_ids, attention_mask, past_key_values (ไม่มี past_key_values ถ้า prompt ไม่ได้ขึ้นต้นด้วย prefix)
+        """
+        encoded = self.tokenizer(prompts, truncation=max_length is not None, max_length=max_length)["input_ids"]
+
+        if not all(prompt.startswith(prefix) for prompt in prompts):
+            return self._pad_left(encoded)
+        return self.prepare_token_inputs(encoded, prefix, adapter=adapter)
+
+    def prepare_token_inputs(self, encoded, prefix=PROMPT_PREAMBLE, adapter=None):
+        """
+        เหมือน prepare_inputs แต่รับ token id ที่ tokenize ไว้แล้ว (เช่นจาก token artifact)
+        ทุกแถวต้องเป็น prompt ที่ขึ้นต้นด้วย prefix
+        """
+        entry = self.lookup(prefix, adapter)
+        prefix_ids = entry["input_ids"][0].tolist()
+
+        # จำนวน token แรกที่ตรงกับ prefix ในทุกแถว (token รอยต่ออาจ merge กับข้อความถัดไป)
+        # ต้องเหลือ token ให้ generate ประมวลผลอย่างน้อย 1 ตัวต่อแถว
+        shared = len(prefix_ids)
+        for ids in encoded:
+            common = 0
+            while common < min(len(ids) - 1, shared) and ids[common] == prefix_ids[common]:
+                common += 1
+            shared = min(shared, common)
+        if shared == 0:
+            return self._pad_left(encoded)
+
+        past_key_values = copy.deepcopy(entry["past_key_values"])
+        if shared < len(prefix_ids):
+            # ค่าติดลบ = จำนวน token ที่ตัดออกจากท้าย (ค่าบวกแบบเดิม deprecated)
+            past_key_values.crop(shared - past_key_values.get_seq_length())
+        if len(encoded) > 1:
+            past_key_values.batch_repeat_interleave(len(encoded))
+        self.tokens_reused += shared * len(encoded)
+
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        longest = max(len(ids) for ids in encoded)
+        input_ids = []
+        attention_mask = []
+        for ids in encoded:
+            padding = longest - len(ids)
+            input_ids.append(ids[:shared] + [pad_id] * padding + ids[shared:])
+            attention_mask.append([1] * shared + [0] * padding + [1] * (len(ids) - shared))
+
+        device = self.model.device
+        return {
+            "input_ids": torch.tensor(input_ids, device=device),
+            "attention_mask": torch.tensor(attention_mask, device=device),
+            "past_key_values": past_key_values,
+        }
+
+    def _pad_left(self, encoded):
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        longest = max(len(ids) for ids in encoded)
+        device = self.model.device
+        return {
+            "input_ids": torch.tensor([[pad_id] * (longest - len(ids)) + ids for ids in encoded], device=device),
+            "attention_mask": torch.tensor([[0] * (longest - len(ids)) + [1] * len(ids) for ids in encoded], device=device),
+        }
+
+    def stats(self):
+        """สถิติของ cache"""
+        lookups = self.hits + self.misses
+        return {
+            "prefix_cache_hits": self.hits,
+            "prefix_cache_misses": self.misses,
+            "prefix_cache_hit_rate": self.hits / lookups if lookups else 0.0,
+            "prefix_cache_evictions": self.evictions,
+            "prefix_cache_entries": len(self.entries),
+            "prefix_cache_memory_mb": self.memory_bytes / (1024 * 1024),
+            "prefix_tokens_reused": self.tokens_reused,
+        }
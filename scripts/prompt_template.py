@@ -0,0 +1,69 @@
+"""
+Alpaca prompt template ที่ใช้ร่วมกันทั้งตอนเตรียมข้อมูล เทรน ประเมิน และ inference
+"""
+
+# ส่วนหัวที่ทุก prompt ขึ้นต้นเหมือนกัน (ใช้เป็น key ของ prefix KV cache)
+PROMPT_PREAMBLE = "Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.\n\n"
+
+RESPONSE_MARKER = "### Response:"
+
+
+def build_turn(instruction, input_text, response=None):
+    """
+    หนึ่ง turn ของ template (ไม่รวม preamble)
+    response=None คือ turn ที่รอ generate คำตอบ ถ้ามี response จะต่อท้ายเป็น turn ที่จบแล้ว (ใช้ใน multi-turn)
+    """
+    turn = f"""### Instruction:
+{instruction}
+
+### Input:
+{input_text}
+
+{RESPONSE_MARKER}
+"""
+    if response is not None:
+        turn += f"{response}\n\n"
+    return turn
+
+
+def build_prompt(instruction, input_text):
+    """สร้าง prompt (ไม่รวมคำตอบ) สำหรับ generate"""
+    return PROMPT_PREAMBLE + build_turn(instruction, input_text)
+
+
+def build_chat_prompt(history, instruction, input_text):
+    """prompt ที่มี turn ก่อนหน้า history = [(instruction, input, response)] เรียงจากเก่าไปใหม่"""
+    return PROMPT_PREAMBLE + "".join(build_turn(*turn) for turn in history) + build_turn(instruction, input_text)
+
+
+def format_example(instruction, input_text, output):
+    """สร้าง text เต็ม (prompt + คำตอบ) สำหรับเทรน"""
+    return build_prompt(instruction, input_text) + output
+
+
+def parse_example(text):
+    """
+    แยก instruction, input และ output ออกจาก text ที่สร้างด้วย format_example
+
+    Returns:
+        (instruction, input_text, output)
+    """
+    instruction = ""
+    input_text = ""
+    output = ""
+
+    for part in text.split("### "):
+        if part.startswith("Instruction:"):
+            instruction = part.replace("Instruction:", "").strip()
+        elif part.startswith("Input:"):
+            input_text = part.replace("Input:", "").strip()
+        elif part.startswith("Response:"):
+            output = part.replace("Response:", "").strip()
+
+    return instruction, input_text, output
+
+
+def response_char_offset(text):
+    """ตำแหน่งตัวอักษรแรกหลัง "### Response:" (0 ถ้าไม่มี marker)"""
+    marker = text.rfind(RESPONSE_MARKER)
+    return marker + len(RESPONSE_MARKER) if marker >= 0 else 0
@@ -0,0 +1,171 @@
+"""
+ไฟล์สำหรับ cache คำตอบของ ChatBot (in-memory LRU + TTL และ tier บน disk แบบ sqlite)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """normalize text ก่อนทำ key: Unicode NFC, casefold, ยุบช่องว่างซ้ำ"""
+    text = unicodedata.normalize("NFC", text or "")
+    return " ".join(text.casefold().split())
+
+
+def adapter_identity(adapter_path):
+    """
+    สร้าง id ของ adapter จาก path และขนาด/เวลาแก้ไขของไฟล์ weights
+    เทรนใหม่ทับ path เดิมแล้ว cache เก่าจะไม่ถูกใช้
+    """
+    path = os.path.abspath(adapter_path)
+    files = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.startswith("adapter_") or name.endswith(".safetensors") or name.endswith(".bin"):
+                stat = os.stat(os.path.join(path, name))
+                files.append([name, stat.st_size, int(stat.st_mtime)])
+    digest = hashlib.sha256(json.dumps([path, files]).encode("utf-8")).hexdigest()
+    return digest[:16]
+
+
+def model_identity(model_path, precision):
+    """
+    id ของโมเดลฐานและ precision ที่ใช้ generate (คำตอบของ int8 ต่างจาก fp16/fp32)
+    โมเดลบน disk ใช้ไฟล์ weights แบบเดียวกับ adapter_identity ส่วนโมเดลบน Hub ใช้ชื่อ
+    """
+    base = adapter_identity(model_path) if os.path.isdir(model_path) else model_path
+    return f"{base}:{precision}"
+
+
+def make_cache_key(instruction, input_text, adapter_id, generation_params, model_id=None):
+    """key ของ cache จาก instruction/input ที่ normalize แล้ว, โมเดลฐาน/precision, adapter และ decoding parameters"""
+    payload = {
+        "instruction": normalize_text(instruction),
+        "input": normalize_text(input_text),
+        "model": model_id,
+        "adapter": adapter_id,
+        "params": generation_params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache คำตอบสองระดับ
+
+    - memory: LRU จำกัดจำนวน entry และหมดอายุตาม ttl_seconds
+    - disk (ถ้าระบุ disk_path): sqlite ที่อยู่รอดหลัง restart จำกัดจำนวน entry ด้วย max_disk_entries
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, disk_path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.db = None
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self.db = sqlite3.connect(disk_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self.db.commit()
+
+    def _expired(self, created, now):
+        return self.ttl_seconds is not None and now - created > self.ttl_seconds
+
+    def get(self, key):
+        """คืนคำตอบที่ cache ไว้ หรือ None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if not self._expired(created, now):
+                    self.entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self.entries[key]
+                self.expirations += 1
+
+            if self.db is not None:
+                row = self.db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, created = row
+                    if not self._expired(created, now):
+                        self.db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                        self.db.commit()
+                        self._put_memory(key, value, created)
+                        self.disk_hits += 1
+                        return value
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.db.commit()
+                    self.expirations += 1
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """บันทึกคำตอบลง memory และ disk"""
+        now = time.time()
+        with self.lock:
+            self._put_memory(key, value, now)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created, last_access) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                # เกินขนาดที่กำหนด ลบ entry ที่ไม่ได้ใช้นานที่สุด
+                self.db.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+                self.db.commit()
+
+    def _put_memory(self, key, value, created):
+        self.entries[key] = (value, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+
+    def stats(self):
+        """สถิติของ cache"""
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            disk_entries = (
+                self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] if self.db is not None else 0
+            )
+            return {
+                "response_cache_memory_hits": self.memory_hits,
+                "response_cache_disk_hits": self.disk_hits,
+                "response_cache_misses": self.misses,
+                "response_cache_hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "response_cache_evictions": self.evictions,
+                "response_cache_expirations": self.expirations,
+                "response_cache_entries": len(self.entries),
+                "response_cache_disk_entries": disk_entries,
+            }
@@ -0,0 +1,147 @@
+"""
+ไฟล์สำหรับบันทึกผลการประเมินทีละ sample ลง JSONL แบบ append-only (crash-safe และ resume ได้)
+
+แต่ละบรรทัดเป็น result หนึ่ง sample พร้อม fingerprint ของ config การประเมิน
+บรรทัดสุดท้ายที่เขียนไม่ครบ (เช่น process ถูก kill กลางทาง) จะถูกข้าม
+"""
+import hashlib
+import json
+import os
+
+
+def evaluation_fingerprint(config):
+    """fingerprint ของ config การประเมิน (โมเดล, adapter, dataset, generation parameters)"""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def read_log_index(path, fingerprint=None):
+    """
+    อ่าน index (sample_id -> offset) ของ log แบบอ่านอย่างเดียว ไม่แก้ไฟล์
+
+    fingerprint=None คือใช้ fingerprint ของ record สุดท้ายใน log (การประเมินครั้งล่าสุด)
+
+    Returns:
+        (fingerprint, offsets)
+    """
+    indexes = {}
+    if not os.path.exists(path):
+        return fingerprint, {}
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            if record is not None and (fingerprint is None or record.get("fingerprint") == fingerprint):
+                latest = record.get("fingerprint")
+                indexes.setdefault(latest, {})[record["sample_id"]] = offset
+            offset += len(line)
+    if fingerprint is None:
+        fingerprint = latest if indexes else None
+    return fingerprint, indexes.get(fingerprint, {})
+
+
+class ResultLog:
+    """
+    Log ของ result แบบ append-only
+
+    ทุก record ถูก flush + fsync ทันทีที่เขียน อ่านกลับด้วย index (sample_id -> offset ในไฟล์)
+    จึงไม่ต้องโหลดทุก result เข้า memory ถ้า sample_id ซ้ำ record ที่เขียนหลังสุดเป็นตัวที่ใช้
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._repair_tail()
+        self.offsets = self._build_index()
+        self.file = open(path, "ab")
+
+    def _repair_tail(self):
+        """ตัดบรรทัดสุดท้ายที่เขียนไม่ครบออก เพื่อให้ record ใหม่เริ่มที่บรรทัดใหม่"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # หา newline ตัวสุดท้ายแล้วตัดส่วนหลังจากนั้นทิ้ง
+            position = size
+            while position > 0:
+                step = min(65536, position)
+                f.seek(position - step)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(position - step + newline + 1)
+                    return
+                position -= step
+            f.truncate(0)
+
+    def _build_index(self):
+        return read_log_index(self.path, self.fingerprint)[1]
+
+    def completed_ids(self):
+        """sample_id ที่มีผลใน log แล้วสำหรับ fingerprint นี้"""
+        return set(self.offsets)
+
+    def append(self, result):
+        """เขียน result ลง log และ fsync ก่อน return"""
+        record = {"fingerprint": self.fingerprint, **result}
+        line = (json.dumps(record, ensure_ascii=False, default=float) + "\n").encode("utf-8")
+        offset = self.file.seek(0, os.SEEK_END)
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.offsets[result["sample_id"]] = offset
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def results(self):
+        """view ของ result ทั้งหมดตามลำดับ sample_id (อ่านจากไฟล์ทีละ record)"""
+        return LoggedResults(self.path, self.offsets)
+
+
+class LoggedResults:
+    """
+    Sequence ของ result ที่อ่านจาก log ตามลำดับ sample_id
+
+    ใช้แทน list ของ results ได้ (len, index, iterate) โดยเก็บใน memory แค่ offset
+    """
+
+    def __init__(self, path, offsets):
+        self.path = path
+        self.sample_ids = sorted(offsets)
+        self.offsets = dict(offsets)
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def _read(self, f, sample_id):
+        f.seek(self.offsets[sample_id])
+        record = json.loads(f.readline())
+        record.pop("fingerprint", None)
+        return record
+
+    def __getitem__(self, index):
+        with open(self.path, "rb") as f:
+            return self._read(f, self.sample_ids[index])
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            for sample_id in self.sample_ids:
+                yield self._read(f, sample_id)
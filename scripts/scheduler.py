@@ -0,0 +1,446 @@
+"""
+ไฟล์สำหรับ continuous batching: รับ request ใหม่เข้า decode batch ที่กำลังรันอยู่ทุก step
+"""
+import collections
+import itertools
+import queue
+import threading
+import time
+
+import torch
+from transformers import DynamicCache
+
+from instrumentation import TOKEN_BUCKETS, Instrumentation
+from kv_cache import concat_caches, kv_bytes_per_token, select_rows
+from stopping import STOP_SEQUENCES, StopSequenceFilter, resolve_stop_sequences
+from streaming import IncrementalDetokenizer
+
+
+class GenerationRequest:
+    """
+    สถานะของ request หนึ่งตัวใน scheduler
+
+    callback ถูกเรียกจาก thread ของ scheduler ด้วย event dict:
+        {"type": "token", "text": ...}
+        {"type": "done", "finish_reason": "stop" | "length" | "cancelled", "usage": {...}, "tokens_saved": ...}
+        {"type": "error", "error": ...}
+
+    finish_reason "stop" คือเจอ eos หรือ stop sequence (text ตั้งแต่ stop sequence ไม่ถูกส่งออก)
+    tokens_saved คือ max_tokens - token ที่ generate เมื่อหยุดที่ stop sequence
+    """
+
+    def __init__(self, request_id, prompt, max_tokens, temperature, top_p, callback, tokenizer, adapter=None,
+                 stop_sequences=STOP_SEQUENCES):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.adapter = adapter
+        # ชื่อ adapter ที่ acquire จาก AdapterRegistry แล้ว (None = ยังไม่ได้ acquire)
+        self.adapter_name = None
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.callback = callback
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.stop_filter = StopSequenceFilter(stop_sequences)
+        self.tokens_saved = 0
+        self.generated_ids = []
+        self.prompt_tokens = 0
+        self.started = False
+        self.cancelled = False
+        self.finish_reason = None
+        self.submit_time = time.perf_counter()
+        self.first_token_time = None
+
+    def cancel(self):
+        """ยกเลิก request (เช่น client ตัดการเชื่อมต่อ) แถวจะถูกเอาออกใน step ถัดไป"""
+        self.cancelled = True
+
+    def emit_text(self, text):
+        # ตัดช่องว่างหน้า response เหมือน .strip() ใน ChatBot.generate_response
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return
+            self.started = True
+        self.callback({"type": "token", "text": text})
+
+    def finish(self, reason):
+        self.finish_reason = reason
+        if reason != "cancelled":
+            remaining = self.stop_filter.add(self.detokenizer.flush()) + self.stop_filter.flush()
+            if remaining:
+                self.emit_text(remaining)
+        self.callback({
+            "type": "done",
+            "finish_reason": reason,
+            "usage": {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": len(self.generated_ids),
+                "total_tokens": self.prompt_tokens + len(self.generated_ids),
+            },
+            "time_to_first_token": (
+                self.first_token_time - self.submit_time if self.first_token_time is not None else None
+            ),
+            "tokens_saved": self.tokens_saved,
+        })
+
+
+class ContinuousBatchScheduler:
+    """
+    Scheduler ที่รัน decode loop ของหลาย request พร้อมกันใน batch เดียว
+
+    ทุก step จะ prefill request ที่รออยู่ (ถ้า batch ยังไม่เต็ม) แล้วต่อเข้า batch ที่กำลัง decode
+    โดย pad KV cache ด้านซ้ายให้ยาวเท่ากัน แถวที่จบแล้วถูกเอาออกทันทีเพื่อคืนที่ให้ request ใหม่
+
+    ถ้าส่ง adapters (AdapterRegistry) มา แต่ละ request เลือก LoRA adapter ของตัวเองได้
+    request ต่าง adapter decode อยู่ใน batch เดียวกัน (prefill แยกกลุ่มตาม adapter เพราะ KV ของ prefix ต่างกัน)
+
+    แถวที่เจอ stop sequence (default คือ marker "### " ของ template) จบทันทีและคืนที่ใน batch
+
+    prompt ที่ยาวเกิน context (max_length, default คือ max_position_embeddings ของโมเดล) ได้ error เฉพาะ request นั้น
+    และ max_tokens ถูกลดให้ prompt + response ไม่เกิน context
+    ถ้า prefill ของกลุ่มล้มเหลว จะ prefill ใหม่ทีละ request เพื่อให้ error เฉพาะ request ที่เป็นต้นเหตุ
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, prefix_cache=None, instrumentation=None, adapters=None,
+                 stop_sequences=STOP_SEQUENCES, max_length=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length or getattr(model.config, "max_position_embeddings", None)
+        self.prefix_cache = prefix_cache
+        self.adapters = adapters
+        self.stop_sequences = tuple(stop_sequences)
+        self.instrumentation = instrumentation or Instrumentation(enabled=False)
+        self.kv_bytes_per_token = kv_bytes_per_token(model)
+        self.waiting = queue.Queue()
+        self.pending = collections.deque()
+        self.request_ids = itertools.count()
+
+        # สถานะของ batch ที่กำลัง decode (แถวตรงกับ self.active)
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+        self.positions = None
+
+        self.thread = None
+        self.running = False
+        self.num_steps = 0
+        self.num_completed = 0
+        self.batch_size_sum = 0
+        self.stop_sequence_stops = 0
+        self.tokens_saved = 0
+
+    def submit(self, prompt, max_tokens=256, temperature=0.7, top_p=0.9, callback=None, adapter=None, stop=None):
+        """
+        ส่ง prompt เข้าคิว คืน GenerationRequest
+
+        adapter: ชื่อ adapter ใน AdapterRegistry (None = adapter default ของโมเดล)
+        stop: stop sequence เพิ่มเติมของ request นี้ (str หรือ list)
+        """
+        request = GenerationRequest(
+            next(self.request_ids), prompt, max_tokens, temperature, top_p,
+            callback or (lambda event: None), self.tokenizer, adapter,
+            resolve_stop_sequences(stop, self.stop_sequences),
+        )
+        self.waiting.put(request)
+        return request
+
+    def generate(self, prompt, max_tokens=256, temperature=0.7, top_p=0.9, adapter=None, stop=None):
+        """Generate แบบ blocking ผ่าน scheduler (ต้อง start() ก่อน) คืน text ของ response"""
+        events = queue.Queue()
+        self.submit(prompt, max_tokens, temperature, top_p, callback=events.put, adapter=adapter, stop=stop)
+
+        text = ""
+        while True:
+            event = events.get()
+            if event["type"] == "token":
+                text += event["text"]
+            elif event["type"] == "error":
+                raise RuntimeError(event["error"])
+            else:
+                return text.strip()
+
+    def start(self):
+        """เริ่ม decode loop ใน background thread"""
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            if not self.active and not self.pending:
+                # ไม่มีงานใน batch รอ request ใหม่
+                try:
+                    self.pending.append(self.waiting.get(timeout=0.1))
+                except queue.Empty:
+                    continue
+            self.step()
+
+    def step(self):
+        """หนึ่งรอบของ scheduler: admit request ใหม่ แล้ว decode 1 token ให้ทุกแถว"""
+        try:
+            with torch.no_grad():
+                self._admit()
+                if self.active:
+                    self._decode()
+        except Exception as e:
+            for request in self.active:
+                self._release(request)
+                request.callback({"type": "error", "error": str(e)})
+            self._reset()
+
+    def _admit(self):
+        requests = []
+        while len(self.active) + len(requests) < self.max_batch_size:
+            if self.pending:
+                request = self.pending.popleft()
+            else:
+                try:
+                    request = self.waiting.get_nowait()
+                except queue.Empty:
+                    break
+            if request.cancelled:
+                self._finish(request, "cancelled")
+                continue
+            try:
+                self._check_length(request)
+            except ValueError as e:
+                request.callback({"type": "error", "error": str(e)})
+                continue
+            if self.adapters is not None:
+                try:
+                    request.adapter_name = self.adapters.acquire(request.adapter)
+                except KeyError as e:
+                    request.callback({"type": "error", "error": str(e)})
+                    continue
+            requests.append(request)
+        if not requests:
+            return
+
+        # prefill ทีละกลุ่มของ adapter แล้วต่อเข้า batch เดียวกัน
+        groups = collections.defaultdict(list)
+        for request in requests:
+            groups[request.adapter_name].append(request)
+        for adapter, group in groups.items():
+            try:
+                self._prefill(group, adapter)
+            except Exception as e:
+                if len(group) == 1:
+                    self._fail(group[0], e)
+                    continue
+                # prefill ทีละ request: error เฉพาะ request ที่เป็นต้นเหตุ ไม่กระทบแถวที่ decode อยู่
+                for request in group:
+                    if request.generated_ids or request.finish_reason is not None:
+                        # ส่ง token ไปแล้วก่อนล้มเหลว prefill ซ้ำไม่ได้
+                        self._fail(request, e)
+                        continue
+                    try:
+                        self._prefill([request], adapter)
+                    except Exception as e:
+                        self._fail(request, e)
+
+    def _check_length(self, request):
+        """ตรวจความยาว prompt และลด max_tokens ให้ไม่เกิน context (ValueError ถ้า prompt ยาวเกิน)"""
+        if not self.max_length:
+            return
+        prompt_tokens = len(self.tokenizer(request.prompt)["input_ids"])
+        if prompt_tokens >= self.max_length:
+            raise ValueError(f"prompt ยาว {prompt_tokens} token เกิน context ของโมเดล ({self.max_length} token)")
+        request.max_tokens = min(request.max_tokens, self.max_length - prompt_tokens)
+
+    def _fail(self, request, error):
+        """แจ้ง error ของ request ที่ prefill ไม่สำเร็จ (ยังไม่ได้เข้า batch)"""
+        if request in self.active or request.finish_reason is not None:
+            return
+        self._release(request)
+        request.callback({"type": "error", "error": str(error)})
+
+    def _prefill(self, requests, adapter=None):
+        """prefill prompt ของ requests (adapter เดียวกัน) แล้วต่อเข้า decode batch"""
+        prompts = [request.prompt for request in requests]
+        with self.instrumentation.phase("tokenize"):
+            if self.prefix_cache is not None:
+                inputs = self.prefix_cache.prepare_inputs(prompts, adapter=adapter)
+            else:
+                padding_side = self.tokenizer.padding_side
+                self.tokenizer.padding_side = "left"
+                try:
+                    inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+                finally:
+                    self.tokenizer.padding_side = padding_side
+
+        attention_mask = inputs["attention_mask"]
+        past_key_values = inputs.get("past_key_values")
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        past_length = past_key_values.get_seq_length()
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        adapter_kwargs = {"adapter_names": [adapter] * len(requests)} if adapter is not None else {}
+        with self.instrumentation.phase("prefill"):
+            outputs = self.model(
+                input_ids=inputs["input_ids"][:, past_length:],
+                attention_mask=attention_mask,
+                position_ids=position_ids[:, past_length:],
+                past_key_values=past_key_values,
+                use_cache=True,
+                **adapter_kwargs,
+            )
+        for request, length in zip(requests, attention_mask.sum(dim=-1).tolist()):
+            request.prompt_tokens = length
+
+        next_tokens = self._sample(outputs.logits[:, -1], requests)
+        positions = attention_mask.sum(dim=-1)
+        keep = self._accept(requests, next_tokens)
+        if not keep:
+            return
+
+        past_key_values, attention_mask = select_rows(outputs.past_key_values, attention_mask, keep)
+        next_tokens = next_tokens[keep]
+        positions = positions[keep]
+        requests = [requests[row] for row in keep]
+
+        if self.active:
+            self.past_key_values, self.attention_mask = concat_caches(
+                self.past_key_values, self.attention_mask, past_key_values, attention_mask
+            )
+            self.next_tokens = torch.cat([self.next_tokens, next_tokens])
+            self.positions = torch.cat([self.positions, positions])
+        else:
+            self.past_key_values, self.attention_mask = past_key_values, attention_mask
+            self.next_tokens, self.positions = next_tokens, positions
+        self.active.extend(requests)
+
+    def _decode(self):
+        attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.active), 1))], dim=1)
+        adapter_kwargs = {}
+        if self.adapters is not None:
+            adapter_kwargs["adapter_names"] = [request.adapter_name for request in self.active]
+        with self.instrumentation.phase("decode_step"):
+            outputs = self.model(
+                input_ids=self.next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=self.positions[:, None],
+                past_key_values=self.past_key_values,
+                use_cache=True,
+                **adapter_kwargs,
+            )
+        self.num_steps += 1
+        self.batch_size_sum += len(self.active)
+
+        next_tokens = self._sample(outputs.logits[:, -1], self.active)
+        keep = self._accept(self.active, next_tokens)
+        if not keep:
+            self._reset()
+            return
+
+        if len(keep) < len(self.active):
+            self.past_key_values, self.attention_mask = select_rows(outputs.past_key_values, attention_mask, keep)
+        else:
+            self.past_key_values, self.attention_mask = outputs.past_key_values, attention_mask
+        self.next_tokens = next_tokens[keep]
+        self.positions = self.positions[keep] + 1
+        self.active = [self.active[row] for row in keep]
+
+    def _accept(self, requests, next_tokens):
+        """บันทึก token ที่ sample ได้ให้แต่ละ request คืน index ของแถวที่ยังไม่จบ"""
+        keep = []
+        now = time.perf_counter()
+        for row, (request, token_id) in enumerate(zip(requests, next_tokens.tolist())):
+            if request.cancelled:
+                self._finish(request, "cancelled")
+                continue
+            if token_id == self.tokenizer.eos_token_id:
+                self._finish(request, "stop")
+                continue
+
+            if request.first_token_time is None:
+                request.first_token_time = now
+            request.generated_ids.append(token_id)
+            with self.instrumentation.phase("detokenize"):
+                text = request.stop_filter.add(request.detokenizer.add(token_id))
+            if text:
+                request.emit_text(text)
+
+            if request.stop_filter.stopped:
+                # เจอ stop sequence: จบแถวนี้ทันทีและคืนที่ใน batch ให้ request ถัดไป
+                request.tokens_saved = max(request.max_tokens - len(request.generated_ids), 0)
+                self._finish(request, "stop")
+            elif len(request.generated_ids) >= request.max_tokens:
+                self._finish(request, "length")
+            else:
+                keep.append(row)
+        return keep
+
+    def _release(self, request):
+        if request.adapter_name is not None:
+            self.adapters.release(request.adapter_name)
+            request.adapter_name = None
+
+    def _finish(self, request, reason):
+        self._release(request)
+        request.finish(reason)
+        self.num_completed += 1
+        if request.stop_filter.stopped:
+            self.stop_sequence_stops += 1
+            self.tokens_saved += request.tokens_saved
+            self.instrumentation.observe("stop_tokens_saved", request.tokens_saved, TOKEN_BUCKETS)
+        if self.instrumentation.enabled and reason != "cancelled":
+            if request.first_token_time is not None:
+                self.instrumentation.observe("time_to_first_token_seconds", request.first_token_time - request.submit_time)
+            self.instrumentation.observe("request_seconds", time.perf_counter() - request.submit_time)
+            total_tokens = request.prompt_tokens + len(request.generated_ids)
+            self.instrumentation.record_request(
+                request.prompt_tokens, len(request.generated_ids), total_tokens * self.kv_bytes_per_token
+            )
+
+    def _sample(self, logits, requests):
+        """sample token ถัดไปของแต่ละแถวตาม temperature / top_p ของ request นั้น"""
+        next_tokens = []
+        for row, request in enumerate(requests):
+            row_logits = logits[row].float()
+            if not request.temperature or request.temperature <= 0:
+                next_tokens.append(int(row_logits.argmax()))
+                continue
+
+            probs = torch.softmax(row_logits / request.temperature, dim=-1)
+            if request.top_p < 1.0:
+                sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+                # ตัด token ที่ความน่าจะเป็นสะสม (ไม่รวมตัวเอง) เกิน top_p
+                remove = sorted_probs.cumsum(dim=-1) - sorted_probs > request.top_p
+                sorted_probs[remove] = 0.0
+                probs = torch.zeros_like(probs).scatter_(0, sorted_ids, sorted_probs)
+            next_tokens.append(int(torch.multinomial(probs, 1)))
+        return torch.tensor(next_tokens, device=logits.device)
+
+    def _reset(self):
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+        self.positions = None
+
+    def stats(self):
+        """สถิติของ scheduler"""
+        stats = {
+            "active_requests": len(self.active),
+            "waiting_requests": self.waiting.qsize() + len(self.pending),
+            "completed_requests": self.num_completed,
+            "decode_steps": self.num_steps,
+            "avg_batch_size": self.batch_size_sum / self.num_steps if self.num_steps else 0.0,
+            "stop_sequence_stops": self.stop_sequence_stops,
+            "tokens_saved": self.tokens_saved,
+        }
+        if self.adapters is not None:
+            stats.update(self.adapters.stats())
+        return stats
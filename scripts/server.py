@@ -0,0 +1,395 @@
+"""
+ไฟล์สำหรับรัน inference server แบบ OpenAI-compatible (/v1/chat/completions) ด้วย ChatBot
+
+ใช้ asyncio ของ standard library รับ HTTP และส่ง request เข้า ContinuousBatchScheduler
+รองรับ streaming แบบ Server-Sent Events (stream: true)
+และ /metrics สำหรับ Prometheus (histogram เวลาแต่ละ phase, จำนวน token, KV cache ต่อ request)
+LoRA adapter หลายตัวบนโมเดลฐานเดียวกัน: ลงทะเบียนด้วย --adapter แล้วเลือกด้วยฟิลด์ "model" ของ request
+messages ก่อนหน้า (คู่ user/assistant) เป็น turn ก่อนหน้าของ prompt ตัด turn เก่าทิ้งเมื่อเกิน --max-prompt-tokens
+ชื่อโมเดลอื่นที่ไม่รู้จัก (เช่น llama-3.3-70b-versatile ที่ backend ส่งมาเป็น default) ใช้โมเดลหลัก
+คำถามซ้ำแบบ greedy (temperature 0) ตอบจาก response cache ของ ChatBot โดยไม่เข้า scheduler
+
+ตัวอย่าง:
+    python scripts/server.py --base-model meta-llama/Llama-2-7b-hf --adapter-path ./results/final_model \
+        --adapter hr=./results/hr_model --adapter finance=./results/finance_model
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import time
+import uuid
+
+from prompt_template import build_chat_prompt
+from stopping import resolve_stop_sequences
+
+HTTP_STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+def message_text(message):
+    """ดึง text จาก message ที่ content เป็น string หรือ list ของ parts แบบ OpenAI"""
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content)
+
+
+def messages_to_prompt(messages):
+    """
+    แปลง messages แบบ OpenAI เป็น (history, instruction, input) ของ Alpaca template
+
+    user message ล่าสุดเป็น instruction ส่วน system message ใช้เป็น input
+    user/assistant ก่อนหน้าเป็น history [(instruction, "", response)] เรียงจากเก่าไปใหม่
+    (user หลายข้อความติดกันรวมเป็น instruction เดียว)
+    """
+    last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=None)
+    history = []
+    pending = []
+    for message in messages[:last_user]:
+        role = message.get("role")
+        if role == "user":
+            pending.append(message_text(message))
+        elif role == "assistant":
+            history.append(("\n".join(pending), "", message_text(message)))
+            pending = []
+    if last_user is not None:
+        pending.append(message_text(messages[last_user]))
+    instruction = "\n".join(pending)
+    input_text = "\n".join(message_text(m) for m in messages if m.get("role") == "system")
+    return history, instruction, input_text
+
+
+class ChatCompletionServer:
+    """
+    HTTP server ขนาดเล็กที่แปลง /v1/chat/completions เป็น request ของ scheduler
+
+    ถ้าส่ง chatbot ที่มี response_cache มา จะตอบคำถามซ้ำจาก cache (key เดียวกับ ChatBot.cache_key)
+    sampling (temperature > 0) cache เฉพาะเมื่อ cache_sampled=True
+    history ที่ทำให้ prompt ยาวเกิน max_prompt_tokens ถูกตัด turn เก่าทิ้ง (None = ไม่ตัด)
+    """
+
+    def __init__(self, scheduler, model_name="chatbot", max_tokens_limit=512, chatbot=None, cache_sampled=False,
+                 max_prompt_tokens=1536):
+        self.scheduler = scheduler
+        self.model_name = model_name
+        self.max_tokens_limit = max_tokens_limit
+        self.max_prompt_tokens = max_prompt_tokens
+        self.chatbot = chatbot
+        self.cache_sampled = cache_sampled
+        self.response_cache = chatbot.response_cache if chatbot is not None else None
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        self.scheduler.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving {self.model_name} on http://{host}:{port}/v1/chat/completions")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.scheduler.stop()
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await self.read_request(reader)
+            if path == "/health":
+                stats = self.scheduler.stats()
+                if self.response_cache is not None:
+                    stats.update(self.response_cache.stats())
+                await self.send_json(writer, 200, {"status": "ok", **stats})
+            elif path == "/metrics":
+                await self.send_text(writer, 200, self.scheduler.instrumentation.to_prometheus(),
+                                     "text/plain; version=0.0.4; charset=utf-8")
+            elif path == "/v1/models":
+                await self.send_json(writer, 200, {
+                    "object": "list",
+                    "data": [{"id": name, "object": "model", "owned_by": "local"} for name in self.model_names()],
+                })
+            elif path == "/v1/chat/completions":
+                if method != "POST":
+                    await self.send_error(writer, 405, "Only POST is supported")
+                else:
+                    await self.chat_completions(writer, body)
+            else:
+                await self.send_error(writer, 404, f"Unknown path: {path}")
+        except (ValueError, json.JSONDecodeError) as e:
+            await self.send_error(writer, 400, str(e))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            await self.send_error(writer, 500, str(e))
+        finally:
+            writer.close()
+
+    def model_names(self):
+        """ชื่อโมเดลที่เลือกได้ด้วยฟิลด์ model: โมเดลหลัก + adapter ที่ลงทะเบียนไว้"""
+        adapters = self.scheduler.adapters
+        return [self.model_name] + (sorted(adapters.paths) if adapters is not None else [])
+
+    def resolve_adapter(self, model):
+        """ชื่อ adapter ของฟิลด์ model (None = โมเดลหลัก รวมถึงชื่อที่ไม่ใช่ adapter ที่ลงทะเบียนไว้)"""
+        adapters = self.scheduler.adapters
+        if adapters is not None and model in adapters.paths:
+            return model
+        return None
+
+    def build_prompt(self, history, instruction, input_text):
+        """prompt ของ request และ history ที่เหลือหลังตัด turn เก่าให้อยู่ใน max_prompt_tokens"""
+        history = list(history)
+        prompt = build_chat_prompt(history, instruction, input_text)
+        if self.max_prompt_tokens is None:
+            return history, prompt
+        while history and len(self.scheduler.tokenizer(prompt)["input_ids"]) > self.max_prompt_tokens:
+            history.pop(0)
+            prompt = build_chat_prompt(history, instruction, input_text)
+        return history, prompt
+
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            raise ConnectionError("empty request")
+        method, target, _ = request_line.split(" ", 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        body = await reader.readexactly(length) if length else b""
+        return method, target.split("?", 1)[0], body
+
+    async def chat_completions(self, writer, body):
+        payload = json.loads(body or b"{}")
+        messages = payload.get("messages")
+        if not isinstance(messages, list) or not messages:
+            raise ValueError("messages ต้องเป็น list ที่ไม่ว่าง")
+
+        history, instruction, input_text = messages_to_prompt(messages)
+        history, prompt = self.build_prompt(history, instruction, input_text)
+        adapter = self.resolve_adapter(payload.get("model"))
+        model_name = adapter or self.model_name
+        max_tokens = min(int(payload.get("max_tokens") or 256), self.max_tokens_limit)
+        temperature = float(payload.get("temperature", 0.7))
+        top_p = float(payload.get("top_p", 0.9))
+
+        events = asyncio.Queue()
+        request = None
+        key = None
+        if self.response_cache is not None:
+            # scheduler ใช้ greedy เมื่อ temperature <= 0
+            stop_sequences = resolve_stop_sequences(payload.get("stop"), self.scheduler.stop_sequences)
+            key = self.chatbot.cache_key(instruction, input_text, max_tokens, temperature, top_p, temperature > 0,
+                                         self.cache_sampled, adapter, stop_sequences, history)
+        cached = self.response_cache.get(key) if key is not None else None
+        if cached is not None:
+            events.put_nowait({"type": "token", "text": cached})
+            events.put_nowait({
+                "type": "done",
+                "finish_reason": "stop",
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            key = None
+        else:
+            # event จาก thread ของ scheduler ส่งกลับเข้า event loop
+            loop = asyncio.get_running_loop()
+            request = self.scheduler.submit(
+                prompt,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                callback=lambda event: loop.call_soon_threadsafe(events.put_nowait, event),
+                adapter=adapter,
+                stop=payload.get("stop"),
+            )
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        try:
+            if payload.get("stream"):
+                text, event = await self.stream_completion(writer, events, completion_id, created, model_name)
+            else:
+                text, event = await self.full_completion(writer, events, completion_id, created, model_name)
+        except (ConnectionError, asyncio.CancelledError):
+            if request is not None:
+                request.cancel()
+            raise
+        if key is not None and event.get("finish_reason") in ("stop", "length"):
+            self.response_cache.put(key, text.strip())
+
+    async def full_completion(self, writer, events, completion_id, created, model_name):
+        """ส่ง response ทั้งก้อน คืน (text, event สุดท้าย)"""
+        text = ""
+        while True:
+            event = await events.get()
+            if event["type"] == "token":
+                text += event["text"]
+            elif event["type"] == "error":
+                await self.send_error(writer, 500, event["error"])
+                return text, event
+            else:
+                break
+
+        await self.send_json(writer, 200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model_name,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text.strip()},
+                "finish_reason": event["finish_reason"],
+            }],
+            "usage": event["usage"],
+        })
+        return text, event
+
+    async def stream_completion(self, writer, events, completion_id, created, model_name):
+        """ส่ง response แบบ Server-Sent Events คืน (text, event สุดท้าย)"""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model_name,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        await self.send_event(writer, chunk({"role": "assistant", "content": ""}))
+        text = ""
+        while True:
+            event = await events.get()
+            if event["type"] == "token":
+                text += event["text"]
+                await self.send_event(writer, chunk({"content": event["text"]}))
+            elif event["type"] == "error":
+                await self.send_event(writer, {"error": {"message": event["error"]}})
+                break
+            else:
+                final = chunk({}, event["finish_reason"])
+                final["usage"] = event["usage"]
+                await self.send_event(writer, final)
+                break
+
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+        return text, event
+
+    async def send_event(self, writer, data):
+        writer.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+        await writer.drain()
+
+    async def send_json(self, writer, status, data):
+        await self.send_text(writer, status, json.dumps(data, ensure_ascii=False), "application/json; charset=utf-8")
+
+    async def send_text(self, writer, status, text, content_type):
+        body = text.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_STATUS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    async def send_error(self, writer, status, message):
+        try:
+            await self.send_json(writer, status, {"error": {"message": message}})
+        except ConnectionError:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible inference server สำหรับ ChatBot")
+    parser.add_argument("--base-model", default="meta-llama/Llama-2-7b-hf")
+    parser.add_argument("--model-name", default="chatbot",
+                        help="ชื่อโมเดลหลักใน /v1/models และ response (ชื่อที่ไม่ใช่ adapter ใช้โมเดลหลักทั้งหมด)")
+    parser.add_argument("--adapter-path", default="./results/final_model",
+                        help="LoRA adapter หรือโมเดลที่ merge แล้วจาก 05_export_merged_model.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-tokens-limit", type=int, default=512)
+    parser.add_argument("--max-prompt-tokens", type=int, default=1536,
+                        help="ความยาว prompt สูงสุด (token) เมื่อมี history ยาวกว่านี้ตัด turn เก่าทิ้ง")
+    parser.add_argument("--no-8bit", action="store_true", help="โหลดโมเดลโดยไม่ใช้ int8 (ไม่มีผลถ้าระบุ --precision)")
+    parser.add_argument("--device", default="auto", choices=["auto", "cuda", "cpu"])
+    parser.add_argument("--precision", default=None, choices=["int8", "fp16", "bf16", "fp32"],
+                        help="บน CPU: int8 = dynamic quantization, bf16 = weights bfloat16")
+    parser.add_argument("--threads", type=int, default=None, help="จำนวน intra-op thread ของ PyTorch บน CPU")
+    parser.add_argument("--compile", action="store_true", help="ครอบ forward ของโมเดลด้วย torch.compile")
+    parser.add_argument("--no-metrics", action="store_true", help="ปิดการจับเวลาแต่ละ phase (/metrics จะว่าง)")
+    parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH",
+                        help="ลงทะเบียน LoRA adapter เพิ่ม (ใช้ซ้ำได้) เลือกด้วยฟิลด์ model ของ request")
+    parser.add_argument("--adapter-memory-mb", type=float, default=256,
+                        help="หน่วยความจำรวมของ adapter ที่โหลดพร้อมกัน (LRU)")
+    parser.add_argument("--no-response-cache", action="store_true", help="ไม่ตอบคำถามซ้ำจาก response cache")
+    parser.add_argument("--response-cache-path", default=None,
+                        help="sqlite ของ response cache (อยู่รอดหลัง restart, None = memory เท่านั้น)")
+    parser.add_argument("--response-cache-ttl", type=float, default=3600, help="อายุของคำตอบใน cache (วินาที)")
+    parser.add_argument("--cache-sampled", action="store_true",
+                        help="cache คำตอบของ request ที่ temperature > 0 ด้วย (default cache เฉพาะ greedy)")
+    args = parser.parse_args(argv)
+    adapters = {}
+    for item in args.adapter:
+        name, separator, path = item.partition("=")
+        if not separator or not name or not path:
+            parser.error(f"--adapter ต้องอยู่ในรูป NAME=PATH (ได้ {item!r})")
+        adapters[name] = path
+
+    # import torch/transformers หลัง parse argument (--help ไม่ต้องรอโหลด)
+    from instrumentation import Instrumentation
+    from response_cache import ResponseCache
+    from scheduler import ContinuousBatchScheduler
+
+    # ชื่อไฟล์ขึ้นต้นด้วยตัวเลข จึง import ด้วย importlib
+    inference = importlib.import_module("04_inference")
+    instrumentation = Instrumentation(enabled=not args.no_metrics)
+    chatbot = inference.ChatBot(
+        args.base_model,
+        args.adapter_path,
+        load_in_8bit=not args.no_8bit,
+        instrumentation=instrumentation,
+        device=args.device,
+        precision=args.precision,
+        num_threads=args.threads,
+        compile_model=args.compile,
+        adapters=adapters,
+        adapter_memory_mb=args.adapter_memory_mb,
+        response_cache=(
+            None if args.no_response_cache
+            else ResponseCache(ttl_seconds=args.response_cache_ttl, disk_path=args.response_cache_path)
+        ),
+    )
+
+    scheduler = ContinuousBatchScheduler(
+        chatbot.model,
+        chatbot.tokenizer,
+        max_batch_size=args.max_batch_size,
+        prefix_cache=chatbot.prefix_cache,
+        instrumentation=instrumentation,
+        adapters=chatbot.adapters,
+    )
+    server = ChatCompletionServer(scheduler, model_name=args.model_name, max_tokens_limit=args.max_tokens_limit,
+                                  chatbot=chatbot, cache_sampled=args.cache_sampled,
+                                  max_prompt_tokens=args.max_prompt_tokens)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+ไฟล์สำหรับบทสนทนาหลาย turn ของ ChatBot พร้อม KV cache ของแต่ละ session
+
+prompt ของ turn ใหม่คือ preamble + turn ก่อนหน้า (instruction/input/คำตอบ) + turn ปัจจุบัน ตาม Alpaca template
+KV cache ของ session เก็บไว้ข้าม turn แล้วใช้ซ้ำเท่าที่ token ของ prompt ใหม่ตรงกับ token ที่ cache ไว้
+จึง prefill เฉพาะ token ใหม่ของ turn นั้น
+
+history ที่ยาวเกิน max_prompt_tokens ถูกตัด turn เก่าทิ้ง (window) หรือสรุปรวมเป็น turn เดียว (summarize)
+KV cache ถูกไล่ออกเมื่อ session ไม่ได้ใช้เกิน idle_seconds (ลบทั้ง session) หรือหน่วยความจำรวมเกิน max_memory_mb
+(ลบเฉพาะ KV ของ session ที่ไม่ได้ใช้นานที่สุด history ยังอยู่ turn ถัดไปจึง prefill ใหม่ทั้ง prompt)
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from kv_cache import cache_nbytes
+from prompt_template import PROMPT_PREAMBLE, build_turn
+
+WINDOW = "window"
+SUMMARIZE = "summarize"
+
+SUMMARY_INSTRUCTION = "Summarize the conversation so far."
+
+
+def conversation_text(turns, summary=None):
+    """แปลง turn เป็น text สำหรับให้โมเดลสรุป"""
+    lines = [summary] if summary else []
+    for instruction, input_text, response in turns:
+        lines.append(f"User: {instruction}" + (f"\n{input_text}" if input_text else ""))
+        lines.append(f"Assistant: {response}")
+    return "\n".join(lines)
+
+
+class Session:
+    """history และ KV cache ของบทสนทนาหนึ่งชุด (ใช้ได้ครั้งละหนึ่ง turn)"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.turns = []
+        self.summary = None
+        # token ที่ past_key_values ครอบคลุม (prompt + คำตอบของ turn ล่าสุด ยกเว้น token สุดท้าย)
+        self.token_ids = None
+        self.past_key_values = None
+        self.nbytes = 0
+        self.adapter_key = None
+        self.last_used = time.monotonic()
+        # จำนวน token ของ prompt ล่าสุดที่ prefill ใหม่และที่ใช้ซ้ำจาก KV cache
+        self.last_prefill = None
+
+
+class SessionStore:
+    """
+    เก็บ session ของบทสนทนาหลาย turn
+
+    Args:
+        tokenizer: tokenizer ของโมเดล
+        max_prompt_tokens: จำนวน token สูงสุดของ prompt (ไม่รวมคำตอบที่จะ generate)
+        max_memory_mb: หน่วยความจำรวมของ KV cache ทุก session
+        idle_seconds: ลบ session ที่ไม่ได้ใช้นานกว่านี้
+        strategy: WINDOW (ตัด turn เก่าทิ้ง) หรือ SUMMARIZE (สรุป turn เก่าด้วย summarize)
+        summarize: function(text, adapter, max_tokens) -> สรุปของ text (ต้องส่งมาเมื่อใช้ SUMMARIZE)
+    """
+
+    def __init__(self, tokenizer, max_prompt_tokens=1536, max_memory_mb=512, idle_seconds=1800, strategy=WINDOW,
+                 summarize=None):
+        if strategy not in (WINDOW, SUMMARIZE):
+            raise ValueError(f"strategy ต้องเป็น {WINDOW} หรือ {SUMMARIZE} (ได้ {strategy!r})")
+        if strategy == SUMMARIZE and summarize is None:
+            raise ValueError("strategy summarize ต้องส่ง summarize มาด้วย")
+        self.tokenizer = tokenizer
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.idle_seconds = idle_seconds
+        self.strategy = strategy
+        self.summarize = summarize
+        self.sessions = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.cache_hits = 0
+        self.prefill_tokens = 0
+        self.prefill_tokens_saved = 0
+        self.idle_evictions = 0
+        self.memory_evictions = 0
+        self.truncations = 0
+        self.summaries = 0
+
+    def get(self, session_id):
+        """คืน session (สร้างใหม่ถ้ายังไม่มีหรือหมดอายุแล้ว)"""
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = Session(session_id)
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            return session
+
+    def reset(self, session_id):
+        """ลบ history และ KV cache ของ session"""
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                self._drop_cache(session)
+
+    def _expire(self):
+        deadline = time.monotonic() - self.idle_seconds
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_used > deadline:
+                break
+            del self.sessions[session.session_id]
+            self._drop_cache(session)
+            self.idle_evictions += 1
+
+    def _drop_cache(self, session):
+        self.memory_bytes -= session.nbytes
+        session.token_ids = None
+        session.past_key_values = None
+        session.nbytes = 0
+
+    def _evict(self):
+        # session ที่ไม่ได้ใช้นานที่สุดอยู่หน้าสุดของ OrderedDict
+        for session in list(self.sessions.values()):
+            if self.memory_bytes <= self.max_memory_bytes:
+                break
+            if session.past_key_values is not None:
+                self._drop_cache(session)
+                self.memory_evictions += 1
+
+    def _render(self, session, current_turn):
+        parts = [PROMPT_PREAMBLE]
+        if session.summary:
+            parts.append(build_turn(SUMMARY_INSTRUCTION, "", session.summary))
+        parts.extend(build_turn(*turn) for turn in session.turns)
+        parts.append(current_turn)
+        return "".join(parts)
+
+    def _count_tokens(self, text):
+        return len(self.tokenizer(text)["input_ids"])
+
+    def build_prompt(self, session, instruction, input_text, adapter=None):
+        """
+        prompt ของ turn ใหม่ภายใต้ max_prompt_tokens
+
+        เมื่อเกิน budget จะตัด turn เก่าจนเหลือไม่เกิน 3/4 ของ budget ในครั้งเดียว
+        (prompt ที่ขึ้นต้นต่างจากเดิมใช้ KV cache ซ้ำไม่ได้ ตัดทีละมากจึงให้หลาย turn ถัดไปยังใช้ cache ต่อได้)
+        SUMMARIZE สรุป turn ที่ถูกตัดรวมกับสรุปเดิมด้วย adapter ของ request (ยาวไม่เกิน 1/4 ของ budget)
+        """
+        current_turn = build_turn(instruction, input_text)
+        prompt = self._render(session, current_turn)
+        if not session.turns or self._count_tokens(prompt) <= self.max_prompt_tokens:
+            return prompt
+
+        target = self.max_prompt_tokens * 3 // 4
+        dropped = []
+        while session.turns and self._count_tokens(prompt) > target:
+            dropped.append(session.turns.pop(0))
+            prompt = self._render(session, current_turn)
+        self.truncations += 1
+
+        if self.strategy == SUMMARIZE:
+            session.summary = self.summarize(
+                conversation_text(dropped, session.summary), adapter, self.max_prompt_tokens // 4
+            )
+            self.summaries += 1
+            prompt = self._render(session, current_turn)
+        return prompt
+
+    def prepare_inputs(self, session, prompt, prefix_cache, adapter_key=None, adapter_name=None, reuse_cache=True):
+        """
+        Tokenize prompt และแนบ KV cache ของ session ส่วนที่ token ตรงกับ prompt (ต้องเหลือ token ให้ generate อย่างน้อย 1)
+
+        ถ้าใช้ KV ของ session ไม่ได้ (turn แรก, ถูกไล่ออก, เปลี่ยน adapter) ใช้ KV ของ preamble จาก prefix_cache
+        KV ที่แนบไปถูก generate ต่อเติม session จึงไม่ถือ KV นั้นอีกจนกว่าจะ update
+
+        Args:
+            adapter_key: ค่าที่ระบุ adapter ที่ใช้คำนวณ KV (KV ของ adapter อื่นใช้ซ้ำไม่ได้)
+            adapter_name: ชื่อ adapter สำหรับ adapter_names ของ prefix_cache
+            reuse_cache: False = ไม่แนบ KV ใดเลย ทั้งของ session และ preamble (เช่น speculative decoding)
+        """
+        prompt_ids = self.tokenizer(prompt)["input_ids"]
+        with self.lock:
+            past_key_values = None
+            shared = 0
+            if reuse_cache and session.past_key_values is not None and session.adapter_key == adapter_key:
+                limit = min(len(session.token_ids), len(prompt_ids) - 1)
+                while shared < limit and session.token_ids[shared] == prompt_ids[shared]:
+                    shared += 1
+                if shared:
+                    past_key_values = session.past_key_values
+                    self.cache_hits += 1
+            self._drop_cache(session)
+
+            self.turns += 1
+            self.prefill_tokens += len(prompt_ids) - shared
+            self.prefill_tokens_saved += shared
+            session.last_prefill = {"prompt_tokens": len(prompt_ids), "reused_tokens": shared}
+
+        device = prefix_cache.model.device
+        if past_key_values is None:
+            if not reuse_cache:
+                return {
+                    "input_ids": torch.tensor([prompt_ids], device=device),
+                    "attention_mask": torch.ones((1, len(prompt_ids)), dtype=torch.long, device=device),
+                }
+            return prefix_cache.prepare_token_inputs([prompt_ids], adapter=adapter_name)
+
+        if shared < past_key_values.get_seq_length():
+            past_key_values.crop(shared - past_key_values.get_seq_length())
+        return {
+            "input_ids": torch.tensor([prompt_ids], device=device),
+            "attention_mask": torch.ones((1, len(prompt_ids)), dtype=torch.long, device=device),
+            "past_key_values": past_key_values,
+        }
+
+    def update(self, session, instruction, input_text, response, sequence_ids, past_key_values, adapter_key=None):
+        """
+        บันทึก turn ที่จบแล้วและ KV cache จาก generate (return_dict_in_generate=True)
+
+        Args:
+            sequence_ids: token ทั้งหมดของแถว (prompt + คำตอบ) จาก outputs.sequences
+            past_key_values: outputs.past_key_values
+        """
+        with self.lock:
+            session.turns.append((instruction, input_text, response))
+            session.last_used = time.monotonic()
+            self._drop_cache(session)
+            if past_key_values is None:
+                return
+            nbytes = cache_nbytes(past_key_values)
+            if nbytes > self.max_memory_bytes or session.session_id not in self.sessions:
+                return
+            session.token_ids = list(sequence_ids[:past_key_values.get_seq_length()])
+            session.past_key_values = past_key_values
+            session.nbytes = nbytes
+            session.adapter_key = adapter_key
+            self.memory_bytes += nbytes
+            self._evict()
+
+    def stats(self):
+        """สถิติของ session และ prefill ที่ประหยัดได้จาก KV cache"""
+        with self.lock:
+            prompt_tokens = self.prefill_tokens + self.prefill_tokens_saved
+            return {
+                "sessions": len(self.sessions),
+                "sessions_cached": sum(session.past_key_values is not None for session in self.sessions.values()),
+                "session_turns": self.turns,
+                "session_cache_hits": self.cache_hits,
+                "session_prefill_tokens": self.prefill_tokens,
+                "session_prefill_tokens_saved": self.prefill_tokens_saved,
+                "session_prefill_saved_ratio": self.prefill_tokens_saved / prompt_tokens if prompt_tokens else 0.0,
+                "session_memory_mb": self.memory_bytes / (1024 * 1024),
+                "session_idle_evictions": self.idle_evictions,
+                "session_memory_evictions": self.memory_evictions,
+                "session_truncations": self.truncations,
+                "session_summaries": self.summaries,
+            }
@@ -0,0 +1,323 @@
+"""
+ไฟล์สำหรับประเมินโมเดลแบบ data parallel ด้วย worker process หลายตัว
+
+- แบ่ง sample เป็นหน่วยงาน (batch ตาม token budget ของ make_length_buckets หรือทีละ sample) แบบ deterministic
+  หน่วยงานยาวสุดมาก่อน และแต่ละหน่วยงาน seed RNG ของตัวเอง ผลจึงไม่ขึ้นกับจำนวน worker
+- worker แต่ละตัวโหลดโมเดลของตัวเอง (โมเดลที่ merge แล้วจาก 05_export_merged_model.py ถูก mmap
+  จึงใช้ page cache ของ weights ร่วมกัน) บน CPU แต่ละตัวได้ core ต่อเนื่องกันคนละชุด บน CUDA ได้ GPU คนละตัว
+- worker ดึงหน่วยงานจาก queue เอง ตัวที่ได้ sample ยาวจึงไม่ทำให้ตัวอื่นรอ
+- process หลักรวมผลตามลำดับ sample_id (result log + MetricsEngine) แล้ว save_results เหมือนโหมดปกติ
+
+ตัวอย่าง:
+    python scripts/cli.py eval --num-workers 4 --precision bf16
+    python scripts/cli.py eval --scaling 1,2,4 --num-samples 200
+"""
+import json
+import math
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from datetime import datetime
+
+# process หลักไม่โหลดโมเดล torch/transformers ถูก import ในฟังก์ชันที่ใช้
+
+
+def worker_devices(num_workers, device):
+    """
+    แบ่ง hardware ให้ worker แต่ละตัว
+
+    Returns:
+        list ของ dict ต่อ worker: cuda_device (index ของ GPU หรือ None) และ cpus (core ที่ pin ไว้ หรือ None)
+    """
+    import torch
+
+    if device == "cuda":
+        count = torch.cuda.device_count()
+        return [{"cuda_device": rank % count, "cpus": None} for rank in range(num_workers)]
+
+    # core ต่อเนื่องกันมักอยู่ socket/NUMA node เดียวกัน
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    per_worker = max(len(cpus) // num_workers, 1)
+    return [
+        {"cuda_device": None, "cpus": cpus[rank * per_worker:(rank + 1) * per_worker] or cpus}
+        for rank in range(num_workers)
+    ]
+
+
+def _worker(rank, config, assignment, tasks, outputs):
+    """process ของ worker: โหลดโมเดลแล้ว generate + คำนวณ perplexity ของหน่วยงานจาก tasks จนเจอ None"""
+    try:
+        if assignment["cuda_device"] is not None:
+            # ต้องตั้งก่อนเริ่มใช้ CUDA
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(assignment["cuda_device"])
+        num_threads = None
+        if assignment["cpus"] is not None:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, assignment["cpus"])
+            num_threads = len(assignment["cpus"])
+
+        import importlib
+
+        import torch
+
+        evaluation = importlib.import_module("03_evaluate_model")
+        start_time = time.perf_counter()
+        evaluator = evaluation.ModelEvaluator(
+            base_model_name=config["base_model"],
+            adapter_path=config["adapter_path"],
+            output_dir=config["output_dir"],
+            device=config["device"],
+            precision=config["precision"],
+            num_threads=num_threads,
+        )
+        outputs.put(("ready", rank, time.perf_counter() - start_time))
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            unit_id, unit = task
+            start_time = time.perf_counter()
+            # seed ต่อหน่วยงาน: sampling ได้ผลเดิมไม่ว่าหน่วยงานจะไปอยู่ที่ worker ไหน
+            torch.manual_seed(config["seed"] + unit_id)
+            samples = [sample for _, sample in unit]
+            evaluator.stop_sequence_stops = evaluator.tokens_saved = 0
+            responses, token_counts = evaluator.generate_samples(samples)
+            perplexities = evaluator.score_samples(samples, response_only=config["response_only"])
+            outputs.put((
+                "results", rank, unit_id,
+                [(idx, response, perplexity) for (idx, _), response, perplexity in zip(unit, responses, perplexities)],
+                {
+                    "tokens": sum(token_counts),
+                    "seconds": time.perf_counter() - start_time,
+                    "stop_sequence_stops": evaluator.stop_sequence_stops,
+                    "tokens_saved": evaluator.tokens_saved,
+                },
+            ))
+    except Exception:
+        outputs.put(("error", rank, traceback.format_exc()))
+
+
+def evaluate_sharded(base_model, adapter_path, test_dataset_path, num_workers=2, num_samples=None,
+                     batch_token_budget=16384, max_batch_size=32, response_only=False, result_log=None, resume=False,
+                     device="auto", precision=None, output_dir="./evaluation_results", metrics_num_proc=None, seed=42):
+    """
+    ประเมินโมเดลด้วย worker process num_workers ตัว (เหมือน ModelEvaluator.evaluate_on_dataset + streaming metrics)
+
+    Args:
+        batch_token_budget: token ต่อหน่วยงาน (None = หน่วยงานละ sample) หน่วยงานหนึ่งมีไม่เกิน
+            ceil(จำนวน sample / (num_workers * 4)) sample ให้ทุก worker มีงานจนเกือบจบ
+        result_log, resume: ดู ModelEvaluator.evaluate_on_dataset (fingerprint เดียวกับโหมด process เดียว)
+        device, precision: ของทุก worker (None = int8 เหมือน ModelEvaluator)
+        seed: seed ของหน่วยงานแรก (หน่วยงานที่ i ใช้ seed + i)
+
+    Returns:
+        (results, metrics) results ตามลำดับ sample_id และ metrics รวม confidence interval,
+        throughput, เวลาโหลดและ utilization ของแต่ละ worker
+    """
+    import importlib
+
+    from transformers import AutoTokenizer
+
+    from device import resolve_device, resolve_model_paths, resolve_precision
+    from eval_metrics import MetricsEngine
+    from result_log import ResultLog
+    from token_artifact import load_or_build_token_artifact
+
+    evaluation = importlib.import_module("03_evaluate_model")
+    device = resolve_device(device)
+    precision = resolve_precision(device, "int8" if precision is None else precision)
+
+    model_path, tokenizer_path = resolve_model_paths(base_model, adapter_path)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path or model_path)
+    test_dataset = load_or_build_token_artifact(test_dataset_path, tokenizer, max_length=512)["test"]
+    dataset = evaluation.load_test_dataset(test_dataset, num_samples)
+    samples = evaluation.prepare_samples(dataset)
+    print(f"\nEvaluating on {len(samples)} samples with {num_workers} workers...")
+
+    pending = list(range(len(samples)))
+    results = [None] * len(samples)
+    log = None
+    if result_log:
+        fingerprint = evaluation.make_evaluation_fingerprint(base_model, adapter_path, dataset, response_only, precision)
+        log = ResultLog(result_log, fingerprint)
+        if resume:
+            completed = log.completed_ids()
+            pending = [idx for idx in pending if idx not in completed]
+            print(f"Resuming from {result_log}: {len(samples) - len(pending)} samples already evaluated")
+
+    # หน่วยงานยาวสุดมาก่อน (longest processing time first) งานชิ้นท้ายๆ จึงสั้นและกระจายได้ทั่วถึง
+    lengths = evaluation.prompt_lengths(samples, tokenizer, pending) if pending else []
+    if batch_token_budget:
+        # อย่างน้อยราว 4 หน่วยงานต่อ worker (bucket ใหญ่ไม่กี่ก้อนทำให้ worker ที่เหลือว่าง)
+        unit_size = max(1, math.ceil(len(pending) / (num_workers * 4)))
+        buckets = evaluation.make_length_buckets(lengths, batch_token_budget,
+                                                 max_new_tokens=evaluation.GENERATION_PARAMS["max_tokens"],
+                                                 max_batch_size=min(max_batch_size, unit_size))
+    else:
+        buckets = [[position] for position in sorted(range(len(pending)), key=lambda p: lengths[p], reverse=True)]
+    units = [[(pending[position], samples[pending[position]]) for position in bucket] for bucket in buckets]
+
+    config = {
+        "base_model": base_model,
+        "adapter_path": adapter_path,
+        "output_dir": output_dir,
+        "device": device,
+        "precision": precision,
+        "response_only": response_only,
+        "seed": seed,
+    }
+    # spawn: process ลูกไม่สืบทอด thread pool ของ torch/tokenizers จาก process หลัก
+    context = multiprocessing.get_context("spawn")
+    tasks = context.Queue()
+    outputs = context.Queue()
+    for task in enumerate(units):
+        tasks.put(task)
+    for _ in range(num_workers):
+        tasks.put(None)
+
+    # ไม่ต้องโหลดโมเดลถ้าทุก sample มีผลใน result log แล้ว
+    workers = [
+        context.Process(target=_worker, args=(rank, config, assignment, tasks, outputs), daemon=True)
+        for rank, assignment in enumerate(worker_devices(num_workers, device))
+    ] if units else []
+    for worker in workers:
+        worker.start()
+
+    worker_stats = [
+        {"worker": rank, "load_seconds": None, "units": 0, "samples": 0, "tokens": 0, "busy_seconds": 0.0}
+        for rank in range(num_workers)
+    ]
+    totals = {"tokens": 0, "stop_sequence_stops": 0, "tokens_saved": 0}
+    start_time = None
+    remaining = len(units)
+    engine = MetricsEngine(len(samples), num_proc=metrics_num_proc)
+    if log is not None and resume:
+        for result in log.results():
+            engine.add(result["sample_id"], result["expected_output"], result["predicted_output"], result["perplexity"])
+
+    try:
+        while remaining:
+            try:
+                message = outputs.get(timeout=5)
+            except queue.Empty:
+                dead = [rank for rank, worker in enumerate(workers) if worker.exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError(f"worker {dead} หยุดทำงาน (exit code {workers[dead[0]].exitcode})")
+                continue
+
+            kind, rank = message[0], message[1]
+            if kind == "error":
+                raise RuntimeError(f"worker {rank} ล้มเหลว:\n{message[2]}")
+            if kind == "ready":
+                worker_stats[rank]["load_seconds"] = message[2]
+                # นับเวลาประเมินตั้งแต่ worker ตัวแรกพร้อม (ไม่รวมเวลาโหลดโมเดล)
+                if start_time is None:
+                    start_time = time.perf_counter()
+                continue
+
+            _, rank, unit_id, unit_results, unit_stats = message
+            for idx, prediction, perplexity in unit_results:
+                sample = samples[idx]
+                result = {
+                    "sample_id": idx,
+                    "instruction": sample["instruction"],
+                    "input": sample["input"],
+                    "expected_output": sample["expected_output"],
+                    "predicted_output": prediction,
+                    "perplexity": perplexity,
+                }
+                if log is not None:
+                    log.append(result)
+                else:
+                    results[idx] = result
+                engine.add(idx, sample["expected_output"], prediction, perplexity)
+            stats = worker_stats[rank]
+            stats["units"] += 1
+            stats["samples"] += len(unit_results)
+            stats["tokens"] += unit_stats["tokens"]
+            stats["busy_seconds"] += unit_stats["seconds"]
+            for name in totals:
+                totals[name] += unit_stats[name]
+            remaining -= 1
+
+        elapsed = time.perf_counter() - start_time if start_time is not None else 0.0
+        with engine:
+            metrics = engine.compute()
+            metrics.update(engine.confidence_intervals())
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        if log is not None:
+            log.close()
+
+    for stats in worker_stats:
+        stats["utilization"] = stats["busy_seconds"] / elapsed if elapsed > 0 else 0.0
+    metrics.update({
+        "generation_mode": "sharded",
+        "num_workers": num_workers,
+        "generation_seconds": elapsed,
+        "samples_per_sec": len(pending) / elapsed if elapsed > 0 else 0.0,
+        "tokens_per_sec": totals["tokens"] / elapsed if elapsed > 0 else 0.0,
+        "stop_sequence_stops": totals["stop_sequence_stops"],
+        "tokens_saved": totals["tokens_saved"],
+        "worker_utilization": (
+            sum(stats["busy_seconds"] for stats in worker_stats) / (num_workers * elapsed) if elapsed > 0 else 0.0
+        ),
+        "workers": worker_stats,
+    })
+    print(f"Generation throughput (sharded, {num_workers} workers): "
+          f"{metrics['samples_per_sec']:.2f} samples/sec, {metrics['tokens_per_sec']:.2f} tokens/sec, "
+          f"utilization {metrics['worker_utilization']:.0%}")
+
+    return (log.results() if log is not None else results), metrics
+
+
+def scaling_study(worker_counts, output_dir="./evaluation_results", **kwargs):
+    """
+    ประเมินชุด sample เดียวกันด้วยจำนวน worker แต่ละค่า แล้วรายงาน speedup และ scaling efficiency
+    เทียบกับจำนวน worker ที่น้อยที่สุด (efficiency = speedup / อัตราส่วนจำนวน worker)
+
+    kwargs ส่งต่อให้ evaluate_sharded (ไม่ใช้ result log เพื่อให้ทุกรอบประเมินครบทุก sample)
+
+    Returns:
+        list ของ dict ต่อจำนวน worker
+    """
+    kwargs.update({"result_log": None, "resume": False})
+    rows = []
+    for num_workers in sorted(set(worker_counts)):
+        _, metrics = evaluate_sharded(num_workers=num_workers, output_dir=output_dir, **kwargs)
+        rows.append({
+            "num_workers": num_workers,
+            "generation_seconds": metrics["generation_seconds"],
+            "samples_per_sec": metrics["samples_per_sec"],
+            "tokens_per_sec": metrics["tokens_per_sec"],
+            "worker_utilization": metrics["worker_utilization"],
+        })
+
+    baseline = rows[0]
+    for row in rows:
+        speedup = row["samples_per_sec"] / baseline["samples_per_sec"] if baseline["samples_per_sec"] else 0.0
+        row["speedup"] = speedup
+        row["scaling_efficiency"] = speedup * baseline["num_workers"] / row["num_workers"]
+
+    print("\n" + "=" * 80)
+    print("SCALING EFFICIENCY")
+    print("=" * 80)
+    print(f"{'workers':>8} {'seconds':>10} {'samples/s':>10} {'tokens/s':>10} {'speedup':>8} {'efficiency':>10} "
+          f"{'util':>6}")
+    for row in rows:
+        print(f"{row['num_workers']:>8} {row['generation_seconds']:>10.2f} {row['samples_per_sec']:>10.2f} "
+              f"{row['tokens_per_sec']:>10.2f} {row['speedup']:>7.2f}x {row['scaling_efficiency']:>10.0%} "
+              f"{row['worker_utilization']:>6.0%}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    report_file = os.path.join(output_dir, f"scaling_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+    print(f"\nScaling report saved to: {report_file}")
+    return rows
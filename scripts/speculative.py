@@ -0,0 +1,152 @@
+"""
+ไฟล์สำหรับ speculative (assisted) decoding ของ ChatBot
+
+draft เสนอ token ล่วงหน้าหลายตัว แล้วโมเดลหลักตรวจทั้งหมดใน forward pass เดียว
+draft เป็นโมเดลเล็กที่ใช้ tokenizer เดียวกัน หรือ prompt lookup (n-gram จาก prompt เหมาะกับคำตอบที่ลอกช่วงจาก input)
+
+ใช้ assisted generation ของ transformers: greedy ได้ token เหมือนไม่ใช้ speculative ทุกตัว
+และ sampling ได้ distribution เดียวกัน (ตรวจ draft ด้วย speculative sampling)
+"""
+import time
+
+import torch
+from transformers import StoppingCriteria
+
+PROMPT_LOOKUP = "prompt_lookup"
+
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+TOKENS_PER_PASS_BUCKETS = (1, 1.5, 2, 3, 4, 6, 8, 12, 16)
+
+
+class SpeculativeDecoder:
+    """
+    ตั้งค่า speculative decoding ของ model.generate และเก็บ baseline วินาทีต่อ token ของ decoding ปกติ
+    สำหรับคำนวณ speedup ต่อ request
+
+    Args:
+        method: PROMPT_LOOKUP หรือ draft model ที่โหลดแล้ว
+        num_draft_tokens: จำนวน token ที่ draft เสนอต่อรอบ
+    """
+
+    def __init__(self, method, num_draft_tokens=10):
+        self.method = method
+        self.num_draft_tokens = num_draft_tokens
+        self.plain_seconds = 0.0
+        self.plain_tokens = 0
+
+    @property
+    def name(self):
+        return PROMPT_LOOKUP if self.method == PROMPT_LOOKUP else "draft_model"
+
+    def generate_kwargs(self):
+        """argument ของ model.generate (รองรับ batch size 1 เท่านั้น)"""
+        if self.method == PROMPT_LOOKUP:
+            return {"prompt_lookup_num_tokens": self.num_draft_tokens}
+        return {"assistant_model": self.method, "num_assistant_tokens": self.num_draft_tokens}
+
+    def tracker(self, model, prompt_length, speculative=True):
+        """
+        StoppingCriteria ที่นับ forward pass และ token ที่รับจาก draft ของ request หนึ่งตัว
+        (speculative=False คือวัด decoding ปกติเป็น baseline)
+        """
+        return SpeculationTracker(model, prompt_length, self.num_draft_tokens if speculative else 0)
+
+    def finish(self, tracker):
+        """
+        สรุปผลของ request
+
+        decoding ปกติใช้เป็น baseline วินาทีต่อ token
+        speedup = baseline / วินาทีต่อ token ของ request นี้
+        ถ้ายังไม่มี baseline ใช้ค่าประมาณ: เวลาเฉลี่ยของ forward pass ของโมเดลหลัก x จำนวน token / เวลา decode
+        (ถือว่า pass ที่ตรวจหลาย token ใช้เวลาใกล้กับ decode หนึ่ง token) และ speedup_measured = False
+        """
+        stats = tracker.finish()
+        if not tracker.max_draft_tokens:
+            self.plain_seconds += stats["decode_seconds"]
+            self.plain_tokens += stats["decode_tokens"]
+            stats["speedup"] = 1.0
+            return stats
+
+        stats["method"] = self.name
+        stats["speedup"] = None
+        stats["speedup_measured"] = bool(self.plain_tokens)
+        if stats["decode_tokens"] and stats["decode_seconds"] > 0:
+            if self.plain_tokens:
+                baseline = self.plain_seconds / self.plain_tokens
+            else:
+                baseline = stats["target_pass_seconds"]
+            stats["speedup"] = baseline * stats["decode_tokens"] / stats["decode_seconds"]
+        return stats
+
+
+class SpeculationTracker(StoppingCriteria):
+    """
+    StoppingCriteria ที่ไม่หยุด generate แต่นับผลของ speculative decoding
+
+    assisted generation เรียก stopping criteria หนึ่งครั้งต่อ forward pass ของโมเดลหลัก
+    แต่ละ pass ได้ token ที่ draft เสนอและผ่านการตรวจ บวก token ของโมเดลหลักอีกหนึ่งตัว
+    จำนวน token ที่ draft เสนอนับจาก logits ที่โมเดลหลักคำนวณต่อ pass (hook ที่ lm_head)
+    """
+
+    def __init__(self, model, prompt_length, max_draft_tokens):
+        self.max_draft_tokens = max_draft_tokens
+        self.length = prompt_length
+        self.passes = 0
+        self.generated = 0
+        self.accepted = 0
+        self.proposed = 0
+        self.first_pass_time = None
+        self.first_pass_tokens = 0
+        self.last_time = None
+        self.pass_start = None
+        self.pass_seconds = []
+        self.hooks = []
+        if max_draft_tokens:
+            self.hooks = [
+                model.get_input_embeddings().register_forward_pre_hook(self._start_pass),
+                model.get_output_embeddings().register_forward_hook(self._end_pass),
+            ]
+
+    def _start_pass(self, module, inputs):
+        self.pass_start = time.perf_counter()
+
+    def _end_pass(self, module, inputs, output):
+        if self.pass_start is not None:
+            self.pass_seconds.append(time.perf_counter() - self.pass_start)
+        # lm_head คำนวณ logits ของ candidate ทุกตัว + ตำแหน่งถัดไป
+        self.proposed += min(inputs[0].shape[1] - 1, self.max_draft_tokens)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.perf_counter()
+        emitted = input_ids.shape[1] - self.length
+        self.length = input_ids.shape[1]
+        self.passes += 1
+        self.generated += emitted
+        self.accepted += max(emitted - 1, 0)
+        if self.first_pass_time is None:
+            self.first_pass_time = now
+            self.first_pass_tokens = emitted
+        self.last_time = now
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    def finish(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        # pass แรกรวม prefill จึงไม่นับในเวลาเฉลี่ยต่อ pass
+        decode_passes = self.pass_seconds[1:]
+        # ไม่นับ pass แรก (prefill) ในเวลา decode
+        decode_tokens = self.generated - self.first_pass_tokens
+        decode_seconds = self.last_time - self.first_pass_time if self.first_pass_time is not None else 0.0
+        return {
+            "generated_tokens": self.generated,
+            "target_passes": self.passes,
+            "draft_tokens_proposed": self.proposed,
+            "draft_tokens_accepted": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+            "tokens_per_pass": self.generated / self.passes if self.passes else 0.0,
+            "decode_tokens": decode_tokens,
+            "decode_seconds": decode_seconds,
+            "decode_tokens_per_sec": decode_tokens / decode_seconds if decode_seconds > 0 else 0.0,
+            "target_pass_seconds": sum(decode_passes) / len(decode_passes) if decode_passes else 0.0,
+        }
@@ -0,0 +1,156 @@
+"""
+ไฟล์สำหรับหยุด generate ทันทีที่เจอ stop sequence แทนการ generate จนครบ max_new_tokens แล้วค่อยตัด text
+
+โมเดลที่เทรนด้วย Alpaca template มักขึ้น "### Instruction:" ชุดใหม่ต่อจากคำตอบ
+token ที่ generate ถูก detokenize ทีละ token แล้วตรวจ stop sequence ที่ text
+(stop sequence เดียวกันถูก tokenize ต่างกันได้ตาม context จึงไม่เทียบที่ระดับ token id)
+แต่ละแถวของ batch หยุดแยกกัน และนับ token ที่ไม่ต้อง generate (max_new_tokens - token ที่ generate จริง)
+"""
+import torch
+from transformers import StoppingCriteria
+
+from prompt_template import RESPONSE_MARKER
+from streaming import IncrementalDetokenizer
+
+# marker ของ template ที่ไม่ควรอยู่ในคำตอบ
+STOP_SEQUENCES = ("### Instruction:", "### Input:", RESPONSE_MARKER)
+
+# finish reason ของแต่ละแถว
+STOP_SEQUENCE = "stop_sequence"
+EOS = "eos"
+LENGTH = "length"
+
+
+def resolve_stop_sequences(stop=None, defaults=STOP_SEQUENCES):
+    """รวม stop ของ request (str หรือ list แบบ OpenAI) กับ stop sequence ของ template"""
+    if isinstance(stop, str):
+        stop = [stop]
+    sequences = list(defaults)
+    for sequence in stop or ():
+        if not isinstance(sequence, str):
+            raise ValueError("stop ต้องเป็น string หรือ list ของ string")
+        if sequence and sequence not in sequences:
+            sequences.append(sequence)
+    return tuple(sequences)
+
+
+def truncate_at_stop(text, stop_sequences=STOP_SEQUENCES):
+    """ตัด text ที่ stop sequence แรก"""
+    positions = [text.find(sequence) for sequence in stop_sequences if sequence in text]
+    return text[:min(positions)] if positions else text
+
+
+class StopSequenceFilter:
+    """
+    ตรวจ stop sequence จาก text ที่ได้ทีละ chunk และคืนเฉพาะ text ก่อน stop sequence
+
+    text ส่วนท้ายที่อาจเป็นต้นของ stop sequence (เช่น "###") ถูกกักไว้จนรู้ว่าใช่หรือไม่
+    ผู้อ่าน stream จึงไม่เห็น text ที่จะถูกตัดทิ้งทีหลัง
+    """
+
+    def __init__(self, stop_sequences=STOP_SEQUENCES):
+        self.stop_sequences = tuple(sequence for sequence in stop_sequences if sequence)
+        self.held = ""
+        self.stopped = False
+
+    def add(self, text):
+        """เพิ่ม text แล้วคืนส่วนที่ส่งออกได้ (self.stopped = True เมื่อเจอ stop sequence)"""
+        if self.stopped:
+            return ""
+        text = self.held + text
+        self.held = ""
+        stop = truncate_at_stop(text, self.stop_sequences)
+        if len(stop) < len(text):
+            self.stopped = True
+            return stop
+
+        hold = 0
+        for sequence in self.stop_sequences:
+            for length in range(min(len(sequence) - 1, len(text)), hold, -1):
+                if text.endswith(sequence[:length]):
+                    hold = length
+                    break
+        if hold:
+            self.held = text[-hold:]
+            return text[:-hold]
+        return text
+
+    def flush(self):
+        """คืน text ที่กักไว้เมื่อ generate จบโดยไม่เจอ stop sequence"""
+        text, self.held = self.held, ""
+        return "" if self.stopped else text
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    StoppingCriteria ของ model.generate ที่หยุดแต่ละแถวเมื่อเจอ stop sequence หรือ eos
+
+    generate เติม pad ให้แถวที่หยุดแล้ว และจบทั้ง batch เมื่อทุกแถวหยุด
+    ตรวจเฉพาะ token ใหม่ตั้งแต่ครั้งก่อน (assisted generation เพิ่มได้หลาย token ต่อครั้ง)
+
+    Args:
+        tokenizer: tokenizer ของโมเดล
+        prompt_length: ความยาว input_ids ของ prompt (รวม padding)
+        stop_sequences: stop sequence ที่ตรวจ
+    """
+
+    def __init__(self, tokenizer, prompt_length, stop_sequences=STOP_SEQUENCES):
+        self.tokenizer = tokenizer
+        self.stop_sequences = stop_sequences
+        self.prompt_length = prompt_length
+        self.length = prompt_length
+        self.rows = None
+        self.done = None
+        self.finish_reasons = None
+        self.generated_tokens = None
+
+    def _start(self, batch_size):
+        self.rows = [
+            (IncrementalDetokenizer(self.tokenizer), StopSequenceFilter(self.stop_sequences))
+            for _ in range(batch_size)
+        ]
+        self.done = [False] * batch_size
+        self.finish_reasons = [None] * batch_size
+        self.generated_tokens = [0] * batch_size
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.rows is None:
+            self._start(input_ids.shape[0])
+        new_tokens = input_ids[:, self.length:].tolist()
+        self.length = input_ids.shape[1]
+        for row, token_ids in enumerate(new_tokens):
+            if self.done[row]:
+                continue
+            detokenizer, stop_filter = self.rows[row]
+            for token_id in token_ids:
+                self.generated_tokens[row] += 1
+                if token_id == self.tokenizer.eos_token_id:
+                    self.done[row] = True
+                    self.finish_reasons[row] = EOS
+                    break
+                stop_filter.add(detokenizer.add(token_id))
+                if stop_filter.stopped:
+                    self.done[row] = True
+                    self.finish_reasons[row] = STOP_SEQUENCE
+                    break
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+    def finish(self, max_new_tokens):
+        """
+        สรุปผลของแต่ละแถว
+
+        Returns:
+            list ของ dict: finish_reason, generated_tokens, tokens_saved
+            (tokens_saved นับเฉพาะแถวที่หยุดเพราะ stop sequence)
+        """
+        if self.rows is None:
+            return []
+        results = []
+        for reason, generated in zip(self.finish_reasons, self.generated_tokens):
+            reason = reason or LENGTH
+            results.append({
+                "finish_reason": reason,
+                "generated_tokens": generated,
+                "tokens_saved": max(max_new_tokens - generated, 0) if reason == STOP_SEQUENCE else 0,
+            })
+        return results
@@ -0,0 +1,128 @@
+"""
+ไฟล์สำหรับ streaming token ออกจาก model.generate ทีละ chunk
+"""
+import contextlib
+import queue
+import time
+
+from transformers.generation.streamers import BaseStreamer
+
+
+class IncrementalDetokenizer:
+    """
+    แปลง token id เป็น text ทีละ token โดยไม่ปล่อยตัวอักษรที่ยังไม่ครบ byte
+
+    ภาษาไทยหนึ่งตัวอักษรใช้ 3 bytes ใน UTF-8 และ tokenizer แบบ byte-level อาจแยกไว้คนละ token
+    ถ้า decode แล้วลงท้ายด้วย U+FFFD แปลว่ายังไม่ครบ จะรอ token ถัดไปก่อน
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_id):
+        """เพิ่ม token แล้วคืน text ใหม่ที่พร้อมแสดง ('' ถ้ายังไม่ครบตัวอักษร)"""
+        self.token_ids.append(token_id)
+
+        # decode ซ้อนกับ token ก่อนหน้า เพื่อให้ช่องว่างหน้าคำ (เช่น SentencePiece "▁") ถูกต้อง
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self):
+        """คืน text ที่ค้างอยู่ทั้งหมดเมื่อ generate จบ"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class TokenStreamer(BaseStreamer):
+    """
+    Streamer สำหรับ model.generate ที่ส่ง chunk ออกทาง iterator พร้อม latency
+
+    แต่ละ chunk เป็น dict:
+        text: text ใหม่ที่ decode ได้
+        num_tokens: จำนวน token ที่ generate แล้วทั้งหมด
+        time_to_first_token: วินาทีตั้งแต่เริ่มจนได้ token แรก
+        token_latency: วินาทีระหว่าง token ก่อนหน้ากับ token ล่าสุดของ chunk นี้
+
+    stop_filter: StopSequenceFilter ที่ตัด text ตั้งแต่ stop sequence ออก (None = ไม่ตัด)
+    """
+
+    def __init__(self, tokenizer, skip_prompt=True, timeout=None, instrumentation=None, stop_filter=None):
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.stop_filter = stop_filter
+        self.instrumentation = instrumentation
+        self.skip_prompt = skip_prompt
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.start_time = time.perf_counter()
+        self.last_token_time = None
+        self.time_to_first_token = None
+        self.num_tokens = 0
+        self.prompt_seen = False
+
+    def put(self, value):
+        # generate ส่ง prompt มาเป็นครั้งแรก
+        if self.skip_prompt and not self.prompt_seen:
+            self.prompt_seen = True
+            return
+
+        now = time.perf_counter()
+        if self.time_to_first_token is None:
+            self.time_to_first_token = now - self.start_time
+        token_latency = now - (self.last_token_time or self.start_time)
+        self.last_token_time = now
+
+        text = ""
+        with self.instrumentation.phase("detokenize") if self.instrumentation else contextlib.nullcontext():
+            for token_id in value.reshape(-1).tolist():
+                self.num_tokens += 1
+                text += self.detokenizer.add(token_id)
+        if self.stop_filter is not None:
+            text = self.stop_filter.add(text)
+        if text:
+            self._emit(text, token_latency)
+
+    def end(self):
+        text = self.detokenizer.flush()
+        if self.stop_filter is not None:
+            text = self.stop_filter.add(text) + self.stop_filter.flush()
+        if text:
+            self._emit(text, 0.0)
+        self.queue.put(None)
+
+    def error(self, exc):
+        """ส่ง exception จาก thread ที่รัน generate ไปยังฝั่งที่อ่าน stream"""
+        self.queue.put(exc)
+
+    def _emit(self, text, token_latency):
+        self.queue.put({
+            "text": text,
+            "num_tokens": self.num_tokens,
+            "time_to_first_token": self.time_to_first_token,
+            "token_latency": token_latency,
+        })
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.queue.get(timeout=self.timeout)
+        if chunk is None:
+            raise StopIteration()
+        if isinstance(chunk, BaseException):
+            raise chunk
+        return chunk
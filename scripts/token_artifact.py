@@ -0,0 +1,118 @@
+"""
+ไฟล์สำหรับสร้าง/โหลด dataset ที่ tokenize ไว้ล่วงหน้า ใช้ร่วมกันทั้งตอนเทรนและตอนประเมิน
+
+artifact เก็บเป็น Arrow (load_from_disk แบบ memory-map ไม่ copy) ใน directory ที่ตั้งชื่อตาม fingerprint
+ของ tokenizer, prompt template, max_length และ dataset ต้นทาง ถ้าไม่มีอะไรเปลี่ยนจะโหลดของเดิมโดยไม่ tokenize ใหม่
+
+คอลัมน์:
+    text, instruction, input, output: ข้อความเดิมและ field ที่แยกแล้ว
+    input_ids: token ของ text เต็ม (สำหรับเทรนและ perplexity)
+    response_start: index ของ token แรกของคำตอบใน input_ids
+    prompt_input_ids: token ของ prompt อย่างเดียว (สำหรับ generate)
+"""
+import hashlib
+import json
+import os
+
+from datasets import DatasetDict, load_from_disk
+
+from prompt_template import build_prompt, parse_example, response_char_offset
+
+ARTIFACT_VERSION = 1
+
+
+def tokenizer_fingerprint(tokenizer):
+    """hash ของ vocabulary/กฎการตัดคำของ tokenizer"""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # truncation/padding ใน backend เปลี่ยนตามการเรียกใช้ล่าสุด ไม่ใช่คุณสมบัติของ tokenizer
+        config = json.loads(backend.to_str())
+        config.pop("truncation", None)
+        config.pop("padding", None)
+        serialized = json.dumps(config, sort_keys=True, ensure_ascii=False)
+    else:
+        serialized = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    special = json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str)
+    return hashlib.sha256((serialized + special).encode("utf-8")).hexdigest()
+
+
+def artifact_fingerprint(dataset, tokenizer, max_length):
+    """fingerprint ของ artifact จาก tokenizer, template, max_length และ fingerprint ของ dataset แต่ละ split"""
+    payload = {
+        "version": ARTIFACT_VERSION,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "template": build_prompt("{instruction}", "{input}"),
+        "max_length": max_length,
+        "splits": {split: dataset[split]._fingerprint for split in sorted(dataset)},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:16], payload
+
+
+def response_token_start(offsets, char_offset):
+    """index ของ token แรกที่เริ่มตั้งแต่ char_offset (len(offsets) ถ้าถูกตัดหายไป)"""
+    for idx, (start, end) in enumerate(offsets):
+        if start >= char_offset and end > start:
+            return idx
+    return len(offsets)
+
+
+def build_token_artifact(dataset, tokenizer, max_length, output_path, num_proc=None):
+    """Tokenize ทุก split แล้วบันทึกลง output_path"""
+
+    def tokenize_function(examples):
+        fields = [parse_example(text) for text in examples["text"]]
+        encoded = tokenizer(
+            examples["text"],
+            truncation=True,
+            max_length=max_length,
+            return_offsets_mapping=True,
+        )
+        prompts = tokenizer(
+            [build_prompt(instruction, input_text) for instruction, input_text, _ in fields],
+            truncation=True,
+            max_length=max_length,
+        )
+        return {
+            "instruction": [f[0] for f in fields],
+            "input": [f[1] for f in fields],
+            "output": [f[2] for f in fields],
+            "input_ids": encoded["input_ids"],
+            "response_start": [
+                response_token_start(offsets, response_char_offset(text))
+                for offsets, text in zip(encoded["offset_mapping"], examples["text"])
+            ],
+            "prompt_input_ids": prompts["input_ids"],
+        }
+
+    tokenized = dataset.map(tokenize_function, batched=True, num_proc=num_proc)
+    tokenized.save_to_disk(output_path)
+    return tokenized
+
+
+def load_or_build_token_artifact(dataset, tokenizer, max_length=512, artifact_root="data/tokenized", num_proc=None):
+    """
+    โหลด artifact ที่ตรงกับ fingerprint หรือสร้างใหม่ถ้ายังไม่มี
+
+    Args:
+        dataset: DatasetDict หรือ path ที่บันทึกด้วย save_to_disk
+    """
+    if isinstance(dataset, str):
+        dataset = load_from_disk(dataset)
+    if not isinstance(dataset, DatasetDict):
+        dataset = DatasetDict({"test": dataset})
+
+    fingerprint, payload = artifact_fingerprint(dataset, tokenizer, max_length)
+    output_path = os.path.join(artifact_root, fingerprint)
+    meta_file = os.path.join(output_path, "artifact_meta.json")
+
+    if os.path.exists(meta_file):
+        print(f"Loading token artifact: {output_path}")
+        return load_from_disk(output_path)
+
+    print(f"Building token artifact: {output_path}")
+    tokenized = build_token_artifact(dataset, tokenizer, max_length, output_path, num_proc=num_proc)
+    # เขียน meta เป็นขั้นสุดท้าย artifact ที่สร้างไม่เสร็จจะไม่ถูกนำมาใช้
+    with open(meta_file, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, **payload}, f, indent=2)
+    # โหลดกลับจาก disk ให้ _fingerprint ของ split ตรงกับรอบที่โหลด artifact เดิม (key ของ result log จึงเหมือนกัน)
+    return load_from_disk(output_path)
@@ -0,0 +1,293 @@
+"""
+ไฟล์สำหรับวัด throughput และหน่วยความจำของการเทรนทีละ optimizer step
+
+TelemetryCallback บันทึก timeline เป็น JSONL หนึ่งบรรทัดต่อ step:
+tokens/sec (รวม padding และเฉพาะ token จริง), สัดส่วน padding, เวลาที่รอ dataloader, เวลาคำนวณ และหน่วยความจำ
+Trainer ดึง micro-batch ทั้งหมดของ step (gradient_accumulation_steps) ก่อน on_step_begin
+เวลาตั้งแต่ callback ครั้งล่าสุดถึง on_step_begin จึงเป็นเวลาที่รอ dataloader (ไม่รวม evaluate/save ของ step ก่อน)
+
+จำนวน token ของแต่ละ batch นับโดย TelemetryCollator ที่ครอบ data collator
+(ต้องใช้ dataloader_num_workers=0 ซึ่งเป็นค่า default เพราะ collator ใน worker process ส่งค่ากลับมาไม่ได้)
+และนับเข้า step เมื่อ TelemetryTrainer เทรน batch นั้นจริง (dataloader ดึง batch ของ step ถัดไปไว้ล่วงหน้า)
+
+หน่วยความจำ: CUDA ใช้ peak ของ allocator ต่อ step, CPU ใช้ RSS ของ process (ค่าประมาณ allocator ไม่คืน memory ให้ OS ทันที)
+"""
+import json
+import os
+import resource
+import sys
+import time
+from collections import deque
+
+import numpy as np
+import torch
+from transformers import Trainer, TrainerCallback
+
+MB = 1024 * 1024
+
+
+def current_rss_mb():
+    """RSS ปัจจุบันของ process (Linux) หรือ peak RSS ถ้าอ่าน /proc ไม่ได้"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+    except (OSError, ValueError, IndexError):
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / 1024 if sys.platform != "darwin" else usage / MB
+
+
+def memory_budget_mb(device):
+    """หน่วยความจำที่ใช้ได้: 90% ของหน่วยความจำ GPU หรือ RAM ของเครื่อง"""
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory * 0.9 / MB
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.9 / MB
+
+
+def is_out_of_memory(error):
+    message = str(error).lower()
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in message or "can't allocate memory" in message
+
+
+class TelemetryCollator:
+    """
+    ครอบ data collator เพื่อนับ token ของแต่ละ batch
+
+    token จริงนับจาก feature ก่อน pad (attention_mask ถ้ามี ไม่เช่นนั้นความยาว input_ids)
+    token ทั้งหมดคือขนาดของ input_ids หลัง collate
+    batch ที่ collate แล้วรอใน pending จนกว่า consume (ตามลำดับเดียวกับ dataloader) แล้ว drain คืนเฉพาะ batch ที่ consume แล้ว
+    """
+
+    def __init__(self, collator):
+        self.collator = collator
+        self.pending = deque()
+        self.consumed = []
+
+    def __call__(self, features):
+        batch = self.collator(features)
+        real_tokens = sum(
+            sum(feature["attention_mask"]) if "attention_mask" in feature else len(feature["input_ids"])
+            for feature in features
+        )
+        sequences = sum(len(feature["seq_lens"]) if "seq_lens" in feature else 1 for feature in features)
+        self.pending.append({
+            "sequences": sequences,
+            "tokens": int(batch["input_ids"].numel()),
+            "real_tokens": int(real_tokens),
+        })
+        return batch
+
+    def consume(self):
+        """นับ batch ที่เก่าที่สุดใน pending เป็น micro-batch ที่เทรนแล้ว (เรียกหนึ่งครั้งต่อ training_step)"""
+        if self.pending:
+            self.consumed.append(self.pending.popleft())
+
+    def drain(self):
+        """สถิติของ micro-batch ที่เทรนแล้วตั้งแต่ครั้งก่อน"""
+        batches = self.consumed
+        self.consumed = []
+        return batches
+
+
+class TelemetryTrainer(Trainer):
+    """
+    Trainer ที่บอก TelemetryCollator ว่า batch ไหนถูกเทรนจริง
+
+    dataloader collate batch ล่วงหน้าก่อน step จะจบ step จึงนับเฉพาะ batch ที่ผ่าน training_step
+    dataloader ของ evaluate/predict ใช้ collator ตัวใน batch ของ eval set จึงไม่ปนกับ telemetry ของการเทรน
+    """
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if isinstance(self.data_collator, TelemetryCollator):
+            self.data_collator.consume()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def _without_telemetry(self, make_dataloader, dataset):
+        collator = self.data_collator
+        if isinstance(collator, TelemetryCollator):
+            self.data_collator = collator.collator
+        try:
+            return make_dataloader(dataset)
+        finally:
+            self.data_collator = collator
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        return self._without_telemetry(super().get_eval_dataloader, eval_dataset)
+
+    def get_test_dataloader(self, test_dataset):
+        return self._without_telemetry(super().get_test_dataloader, test_dataset)
+
+
+class TelemetryCallback(TrainerCallback):
+    """
+    TrainerCallback ที่บันทึก telemetry ทีละ optimizer step
+
+    Args:
+        collator: TelemetryCollator ที่ Trainer ใช้
+        path: ไฟล์ JSONL ของ timeline (None = เก็บใน memory เท่านั้น)
+        tags: ค่าที่ใส่ในทุกบรรทัด (เช่น config ของ autotune)
+        warmup_steps: จำนวน step แรกที่ไม่นับใน summary (compile, allocator และ cache ยังไม่นิ่ง)
+    """
+
+    def __init__(self, collator, path=None, tags=None, warmup_steps=1):
+        self.collator = collator
+        self.path = path
+        self.tags = tags or {}
+        self.warmup_steps = warmup_steps
+        self.records = []
+        self.pending = None
+        self.mark = None
+        self.step_start = None
+        self.dataloader_seconds = 0.0
+        self.device = None
+        self.file = None
+
+    def _now(self):
+        if self.device is not None and self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def _flush(self):
+        if self.pending is None:
+            return
+        self.records.append(self.pending)
+        if self.file is not None:
+            self.file.write(json.dumps(self.pending) + "\n")
+            self.file.flush()
+        self.pending = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.device = args.device
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.file = open(self.path, "w", encoding="utf-8")
+        self.mark = self._now()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._flush()
+        self.step_start = self._now()
+        self.dataloader_seconds = self.step_start - self.mark
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        end = self._now()
+        batches = self.collator.drain()
+        compute_seconds = end - self.step_start
+        step_seconds = compute_seconds + self.dataloader_seconds
+        tokens = sum(batch["tokens"] for batch in batches)
+        real_tokens = sum(batch["real_tokens"] for batch in batches)
+        if self.device.type == "cuda":
+            memory_mb = torch.cuda.memory_allocated(self.device) / MB
+            peak_memory_mb = torch.cuda.max_memory_allocated(self.device) / MB
+        else:
+            memory_mb = peak_memory_mb = current_rss_mb()
+
+        self.pending = {
+            **self.tags,
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "micro_batches": len(batches),
+            "sequences": sum(batch["sequences"] for batch in batches),
+            "tokens": tokens,
+            "real_tokens": real_tokens,
+            "padding_ratio": 1.0 - real_tokens / tokens if tokens else 0.0,
+            "step_seconds": step_seconds,
+            "compute_seconds": compute_seconds,
+            "dataloader_seconds": self.dataloader_seconds,
+            "tokens_per_sec": tokens / step_seconds if step_seconds else 0.0,
+            "effective_tokens_per_sec": real_tokens / step_seconds if step_seconds else 0.0,
+            "memory_mb": memory_mb,
+            "peak_memory_mb": peak_memory_mb,
+        }
+        self.mark = end
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        # Trainer log หลัง on_step_end ของ step เดียวกัน
+        if self.pending is not None and self.pending["step"] == state.global_step:
+            for key in ("loss", "learning_rate", "grad_norm"):
+                if logs and key in logs:
+                    self.pending[key] = logs[key]
+        self.mark = self._now()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self.mark = self._now()
+
+    def on_save(self, args, state, control, **kwargs):
+        self.mark = self._now()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self._flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        """สรุป timeline ไม่นับ warmup_steps แรก (ถ้ามี step พอ)"""
+        records = self.records[self.warmup_steps:] if len(self.records) > self.warmup_steps else self.records
+        if not records:
+            return {}
+        step_seconds = np.array([record["step_seconds"] for record in records])
+        total_seconds = float(step_seconds.sum())
+        tokens = sum(record["tokens"] for record in records)
+        real_tokens = sum(record["real_tokens"] for record in records)
+        dataloader_seconds = sum(record["dataloader_seconds"] for record in records)
+        mean = float(step_seconds.mean())
+        return {
+            "steps": len(records),
+            "tokens_per_sec": tokens / total_seconds if total_seconds else 0.0,
+            "effective_tokens_per_sec": real_tokens / total_seconds if total_seconds else 0.0,
+            "padding_ratio": 1.0 - real_tokens / tokens if tokens else 0.0,
+            "step_seconds_mean": mean,
+            "step_seconds_std": float(step_seconds.std()),
+            "step_seconds_cv": float(step_seconds.std()) / mean if mean else 0.0,
+            "step_seconds_p50": float(np.percentile(step_seconds, 50)),
+            "step_seconds_p95": float(np.percentile(step_seconds, 95)),
+            "dataloader_stall_ratio": dataloader_seconds / total_seconds if total_seconds else 0.0,
+            "peak_memory_mb": max(record["peak_memory_mb"] for record in self.records),
+        }
+
+
+def print_summary(summary):
+    print("Training telemetry:")
+    print(f"  Tokens/sec (incl. padding): {summary['tokens_per_sec']:.1f}")
+    print(f"  Effective tokens/sec: {summary['effective_tokens_per_sec']:.1f}")
+    print(f"  Padding ratio: {summary['padding_ratio']:.2%}")
+    print(f"  Step time: {summary['step_seconds_mean']:.3f}s mean, {summary['step_seconds_p95']:.3f}s p95 "
+          f"(CV {summary['step_seconds_cv']:.2%})")
+    print(f"  Dataloader stall: {summary['dataloader_stall_ratio']:.2%}")
+    print(f"  Peak memory: {summary['peak_memory_mb']:.0f} MB")
+
+
+def autotune_candidates(batch_size=4, gradient_accumulation_steps=4, max_batch_size=64):
+    """
+    (batch size, gradient accumulation) ที่ effective batch size เท่ากับค่าเดิม
+    ผลการเทรน (จำนวน optimizer step และ learning rate ต่อ example) จึงไม่เปลี่ยนตาม config ที่เลือก
+    เรียงจาก batch เล็กไปใหญ่ (RSS บน CPU ไม่ลดลงระหว่าง probe จึงต้องลองตัวที่ใช้ memory น้อยก่อน)
+    """
+    effective = batch_size * gradient_accumulation_steps
+    return [
+        (size, effective // size)
+        for size in range(1, min(effective, max_batch_size) + 1)
+        if effective % size == 0 and size & (size - 1) == 0
+    ]
+
+
+def recommend(results):
+    """config ที่ effective tokens/sec สูงสุดในบรรดาที่ใช้หน่วยความจำไม่เกิน budget (None ถ้าไม่มี)"""
+    fits = [result for result in results if result["fits"]]
+    return max(fits, key=lambda result: result["effective_tokens_per_sec"]) if fits else None
+
+
+def print_autotune(results, best):
+    print("Autotune (batch size x gradient accumulation):")
+    print(f"  {'config':>8} {'tok/s':>9} {'eff tok/s':>9} {'step s':>8} {'cv':>6} {'stall':>6} {'peak MB':>8}  fits")
+    for result in results:
+        config = f"{result['batch_size']}x{result['gradient_accumulation_steps']}"
+        if result.get("error"):
+            print(f"  {config:>8} {result['error']}")
+            continue
+        marker = "  <- recommended" if result is best else ""
+        print(f"  {config:>8} {result['tokens_per_sec']:>9.1f} {result['effective_tokens_per_sec']:>9.1f} "
+              f"{result['step_seconds_mean']:>8.3f} {result['step_seconds_cv']:>6.1%} "
+              f"{result['dataloader_stall_ratio']:>6.1%} {result['peak_memory_mb']:>8.0f}  "
+              f"{'yes' if result['fits'] else 'no'}{marker}")